@@ -0,0 +1,71 @@
+"""
+Agrégateurs incrémentaux pour la lecture en flux
+
+Les blocs (db.iter_query_chunks, snapshots.iter_snapshot_chunks) sont repliés un à un :
+seuls des compteurs et des totaux par clé (site, PDC, jour) restent en mémoire.
+"""
+
+import math
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Sequence
+
+import pandas as pd
+
+
+@dataclass
+class RunningStats:
+    """Compte, somme, min et max des valeurs non nulles vues jusqu'ici."""
+
+    count: int = 0
+    total: float = 0.0
+    minimum: float = math.inf
+    maximum: float = -math.inf
+
+    def update(self, values: pd.Series) -> None:
+        values = pd.to_numeric(values, errors="coerce").dropna()
+        if values.empty:
+            return
+        self.count += len(values)
+        self.total += float(values.sum())
+        self.minimum = min(self.minimum, float(values.min()))
+        self.maximum = max(self.maximum, float(values.max()))
+
+    def mean(self, ndigits: int, default: float = 0) -> float:
+        return round(self.total / self.count, ndigits) if self.count else default
+
+    def max(self, ndigits: int, default: float = 0) -> float:
+        return round(self.maximum, ndigits) if self.count else default
+
+    def min(self, ndigits: int, default: float = 0) -> float:
+        return round(self.minimum, ndigits) if self.count else default
+
+    def sum(self, ndigits: int, default: float = 0) -> float:
+        return round(self.total, ndigits) if self.count else default
+
+
+class GroupTotals:
+    """Totaux par clé de groupe ; le nombre de clés reste petit devant le nombre de lignes."""
+
+    def __init__(self, names: Sequence[str]):
+        self.names = list(names)
+        self.totals: dict = defaultdict(float)
+
+    def update(self, partial: pd.Series) -> None:
+        """Ajoute un résultat partiel (groupby(...).sum() ou .size() d'un bloc)."""
+        for key, value in partial.items():
+            self.totals[key] += value
+
+    def add_frame(self, df: pd.DataFrame, value: str | None = None) -> None:
+        """Groupe `df` sur les clés et ajoute la somme de `value` (ou le nombre de lignes)."""
+        if df.empty:
+            return
+        grouped = df.groupby(self.names, observed=True)
+        self.update(grouped.size() if value is None else grouped[value].sum())
+
+    def to_series(self, name: str) -> pd.Series:
+        if not self.totals:
+            return pd.Series(dtype=float, name=name)
+        series = pd.Series(dict(self.totals), name=name)
+        series.index.names = self.names
+        return series.sort_index()
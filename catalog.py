@@ -0,0 +1,180 @@
+"""
+Catalogue des dimensions de kpi_sessions : sites, PDC, types d'erreur, moments, bornes de dates
+
+Chargé une fois (agrégats de rollups.py, ou GROUP BY sur la table brute) puis complété en tâche
+de fond à partir du dernier jour connu, avec une reconstruction complète périodique.
+Pour chaque couple (site, jour), deux masques de bits indiquent quels types d'erreur et quels
+moments apparaissent : /filters/options répond sans requête SQL pour n'importe quel filtre.
+"""
+
+import asyncio
+import functools
+import operator
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+from compute import run_in_thread
+from rollups import load_session_counts
+
+CATALOG_REFRESH_SECONDS = int(os.getenv("CATALOG_REFRESH_SECONDS", "300"))
+# Reconstruction complète périodique : prend en compte les sessions corrigées ou supprimées par l'ETL
+CATALOG_REBUILD_SECONDS = int(os.getenv("CATALOG_REBUILD_SECONDS", "86400"))
+
+CATALOG_DIMENSIONS = ["day", "Site", "PDC", "type_erreur", "moment"]
+
+MOMENT_ORDER = ["Init", "Lock Connector", "CableCheck", "Charge", "Fin de charge", "Unknown"]
+
+
+def _or_bits(values) -> int:
+    return functools.reduce(operator.or_, values, 0)
+
+
+def _bit_codes(values: pd.Series, labels: list[str]) -> np.ndarray:
+    """Masque d'un bit par valeur (entiers Python : pas de limite à 64 libellés), 0 si NULL."""
+    bits = np.array([1 << i for i in range(len(labels))] + [0], dtype=object)
+    codes = pd.Categorical(values.astype(object), categories=labels).codes
+    return bits[codes]  # code -1 (NULL) -> dernier élément, 0
+
+
+def _labels_from_bits(bits: int, labels: list[str]) -> list[str]:
+    return [label for i, label in enumerate(labels) if bits >> i & 1]
+
+
+@dataclass
+class DimensionCatalog:
+    sites: list[str]
+    pdcs: dict[str, list[str]]
+    error_types: list[str]
+    moments: list[str]
+    date_min: date | None
+    date_max: date | None
+    # Une entrée par (site, jour) : code du site (-1 si NULL), jour, masques d'erreurs et de moments
+    row_sites: np.ndarray
+    row_days: np.ndarray
+    error_bits: np.ndarray
+    moment_bits: np.ndarray
+    loaded_at: float = field(default_factory=time.time)
+
+    def date_range(self) -> dict:
+        return {
+            "min": self.date_min or date.today() - timedelta(days=365),
+            "max": self.date_max or date.today(),
+        }
+
+    def options(self, site_list: list[str], date_debut: date | None, date_fin: date | None) -> dict:
+        """Types d'erreur et moments présents pour ces sites sur la plage (équivalent du SELECT DISTINCT)."""
+        mask = np.ones(len(self.row_sites), dtype=bool)
+        if site_list:
+            wanted = set(site_list)
+            codes = [i for i, site in enumerate(self.sites) if site in wanted]
+            mask &= np.isin(self.row_sites, codes)
+        if date_debut:
+            mask &= self.row_days >= np.datetime64(date_debut, "D")
+        if date_fin:
+            mask &= self.row_days <= np.datetime64(date_fin, "D")
+        return {
+            "error_types": _labels_from_bits(_or_bits(self.error_bits[mask]), self.error_types),
+            "moments": _labels_from_bits(_or_bits(self.moment_bits[mask]), self.moments),
+        }
+
+
+def _build_catalog(df: pd.DataFrame) -> DimensionCatalog:
+    site = df["Site"].astype(object)
+    sites = sorted(site.dropna().astype(str).unique().tolist())
+
+    with_pdc = df.loc[site.notna() & df["PDC"].notna(), ["Site", "PDC"]].astype(str)
+    pdcs = {s: sorted(p.unique().tolist()) for s, p in with_pdc.groupby("Site")["PDC"]}
+
+    error_types = sorted(df["type_erreur"].dropna().astype(str).unique().tolist())
+    raw_moments = df["moment"].dropna().astype(str).unique().tolist()
+    moments = [m for m in MOMENT_ORDER if m in raw_moments]
+    moments += sorted(m for m in raw_moments if m not in MOMENT_ORDER)
+
+    days = pd.to_datetime(df["day"], errors="coerce")
+    entries = pd.DataFrame(
+        {
+            "site": pd.Categorical(site, categories=sites).codes,
+            "day": days.to_numpy(dtype="datetime64[D]"),
+            "errors": _bit_codes(df["type_erreur"], error_types),
+            "moments": _bit_codes(df["moment"], moments),
+        }
+    )
+    by_site_day = entries.groupby(["site", "day"], dropna=False).agg(
+        errors=("errors", _or_bits), moments=("moments", _or_bits)
+    ).reset_index()
+
+    return DimensionCatalog(
+        sites=sites,
+        pdcs=pdcs,
+        error_types=error_types,
+        moments=moments,
+        date_min=days.min().date() if days.notna().any() else None,
+        date_max=days.max().date() if days.notna().any() else None,
+        row_sites=by_site_day["site"].to_numpy(),
+        row_days=by_site_day["day"].to_numpy(dtype="datetime64[D]"),
+        error_bits=by_site_day["errors"].to_numpy(dtype=object),
+        moment_bits=by_site_day["moments"].to_numpy(dtype=object),
+    )
+
+
+def _distinct_combinations(df: pd.DataFrame) -> pd.DataFrame:
+    """Combinaisons distinctes (jour, site, PDC, type d'erreur, moment), jour normalisé en datetime64."""
+    combinations = df[CATALOG_DIMENSIONS[1:]].astype(object)
+    combinations.insert(0, "day", pd.to_datetime(df["day"], errors="coerce").dt.normalize())
+    return combinations.drop_duplicates(ignore_index=True)
+
+
+_catalog: DimensionCatalog | None = None
+_catalog_lock = asyncio.Lock()
+# Combinaisons déjà chargées et date de la dernière lecture complète
+_combinations: pd.DataFrame | None = None
+_rebuilt_at = 0.0
+
+
+async def refresh_catalog() -> DimensionCatalog:
+    """
+    Lecture complète au premier appel (ou après CATALOG_REBUILD_SECONDS), sinon seulement des
+    jours depuis le dernier jour connu : le GROUP BY ne porte que sur les sessions récentes.
+    """
+    global _catalog, _combinations, _rebuilt_at
+    last_day = None
+    if _combinations is not None and time.time() - _rebuilt_at < CATALOG_REBUILD_SECONDS:
+        last_day = _combinations["day"].max()
+
+    if last_day is None or pd.isna(last_day):
+        df = await load_session_counts(CATALOG_DIMENSIONS)
+        _rebuilt_at = time.time()
+    else:
+        # Le dernier jour connu est relu en entier : l'union des combinaisons reste sans doublon
+        recent = await load_session_counts(CATALOG_DIMENSIONS, date_debut=last_day.date())
+        df = pd.concat([_combinations, recent[CATALOG_DIMENSIONS]], ignore_index=True)
+
+    _combinations = await run_in_thread(_distinct_combinations, df)
+    _catalog = await run_in_thread(_build_catalog, _combinations)
+    return _catalog
+
+
+async def get_catalog() -> DimensionCatalog:
+    """Catalogue courant ; chargé à la première demande si la tâche de fond ne l'a pas encore fait."""
+    if _catalog is None:
+        async with _catalog_lock:
+            if _catalog is None:
+                await refresh_catalog()
+    return _catalog
+
+
+async def catalog_refresh_loop() -> None:
+    """Rafraîchissement périodique en tâche de fond (CATALOG_REFRESH_SECONDS > 0)."""
+    while True:
+        try:
+            async with _catalog_lock:
+                await refresh_catalog()
+        except Exception as exc:
+            print(f"Rafraîchissement du catalogue en échec : {exc}")
+        await asyncio.sleep(CATALOG_REFRESH_SECONDS)
+
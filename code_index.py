@@ -0,0 +1,310 @@
+"""
+Index inversé des codes d'erreur de kpi_sessions pour l'analyse par codes
+
+- une liste de postings par (type de code, code) : numéros des sessions en erreur (is_ok = 0),
+  tableaux uint32 ; les sessions sont numérotées dans l'ordre de `Datetime start`, donc une
+  plage de jours est une tranche (searchsorted) et le site, le type d'erreur et le moment de
+  chaque numéro sont lus dans des colonnes codées
+- des compteurs par (jour, site, type d'erreur, moment, véhicule) : sessions et sessions en
+  erreur, pour le total des erreurs et les totaux par véhicule sans requête COUNT(*)
+
+Construit en tâche de fond, puis complété de façon incrémentale (watermark sur `Datetime start`/ID).
+Les sessions sans `Datetime start` ne sont pas indexées.
+"""
+
+import asyncio
+import os
+import time
+from collections import defaultdict
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from db import iter_query_chunks, query_df_async
+
+CODE_INDEX_REFRESH_SECONDS = int(os.getenv("CODE_INDEX_REFRESH_SECONDS", "60"))
+CODE_INDEX_REBUILD_SECONDS = int(os.getenv("CODE_INDEX_REBUILD_SECONDS", "86400"))
+CODE_INDEX_CHUNK_ROWS = int(os.getenv("CODE_INDEX_CHUNK_ROWS", "100000"))
+
+# Type de code (valeur du formulaire) -> colonne de kpi_sessions
+CODE_COLUMNS = {
+    "Erreur_EVI": "EVI Error Code",
+    "Erreur_DownStream": "Downstream Code PC",
+}
+
+_SESSIONS_SQL = """
+    SELECT ID, `Datetime start`, Site, type_erreur, moment, Vehicle, is_ok,
+           `EVI Error Code`, `Downstream Code PC`
+    FROM kpi_sessions
+    WHERE `Datetime start` IS NOT NULL {after}
+    ORDER BY `Datetime start`, ID
+"""
+_AFTER_WATERMARK = "AND (`Datetime start` > :wm_value OR (`Datetime start` = :wm_value AND ID > :wm_id))"
+
+_COUNTER_KEYS = ["day", "site", "type", "moment", "Vehicle"]
+
+
+def _day_numbers(values) -> np.ndarray:
+    """Jours depuis l'époque (int64) ; les dates nulles donnent une valeur négative très grande."""
+    days = pd.to_datetime(pd.Series(values), errors="coerce").to_numpy(dtype="datetime64[D]")
+    return days.astype(np.int64)
+
+
+class _Labels:
+    """Codes entiers stables des libellés (site, type d'erreur, moment), complétés au fil des ajouts."""
+
+    def __init__(self):
+        self.codes: dict = {}
+
+    def encode(self, values: pd.Series) -> np.ndarray:
+        codes, uniques = pd.factorize(values.astype(object))
+        mapping = [self.codes.setdefault(value, len(self.codes)) for value in uniques]
+        return np.array(mapping + [-1], dtype=np.int32)[codes]  # code -1 (NULL) -> -1
+
+    def lookup(self, labels: list[str]) -> np.ndarray:
+        return np.array([self.codes[label] for label in labels if label in self.codes], dtype=np.int32)
+
+
+class _Chunked:
+    """Tableau complété par blocs, concaténé à la première lecture suivant un ajout."""
+
+    def __init__(self, dtype):
+        self.dtype = dtype
+        self._parts: list[np.ndarray] = []
+
+    def append(self, values: np.ndarray) -> None:
+        if len(values):
+            self._parts.append(values.astype(self.dtype, copy=False))
+
+    def array(self) -> np.ndarray:
+        if not self._parts:
+            return np.empty(0, dtype=self.dtype)
+        if len(self._parts) > 1:
+            self._parts = [np.concatenate(self._parts)]
+        return self._parts[0]
+
+
+class CodeIndex:
+    def __init__(self):
+        self.sites = _Labels()
+        self.types = _Labels()
+        self.moments = _Labels()
+        # Une entrée par session en erreur, dans l'ordre de `Datetime start`
+        self._ids = _Chunked(object)
+        self._days = _Chunked(np.int64)
+        self._site_codes = _Chunked(np.int32)
+        self._type_codes = _Chunked(np.int32)
+        self._moment_codes = _Chunked(np.int32)
+        self._postings: dict[tuple[str, int], _Chunked] = defaultdict(lambda: _Chunked(np.uint32))
+        self._counter_parts: list[pd.DataFrame] = []
+        self.errors = 0
+        self.last_value = None
+        self.last_id = None
+        self.loaded_at = time.time()
+
+    def add(self, df: pd.DataFrame) -> None:
+        """Ajoute un bloc de sessions trié par `Datetime start` puis ID."""
+        if df.empty:
+            return
+        days = _day_numbers(df["Datetime start"])
+        site = self.sites.encode(df["Site"])
+        type_ = self.types.encode(df["type_erreur"])
+        moment = self.moments.encode(df["moment"])
+        is_error = pd.to_numeric(df["is_ok"], errors="coerce").eq(0).to_numpy()
+
+        self._counter_parts.append(
+            pd.DataFrame(
+                {
+                    "day": days,
+                    "site": site,
+                    "type": type_,
+                    "moment": moment,
+                    "Vehicle": df["Vehicle"].astype(object).to_numpy(),
+                    "nb": 1,
+                    "nb_err": is_error.astype(np.int64),
+                }
+            )
+            .groupby(_COUNTER_KEYS, dropna=False, sort=False)[["nb", "nb_err"]]
+            .sum()
+            .reset_index()
+        )
+
+        rows = np.arange(self.errors, self.errors + int(is_error.sum()), dtype=np.uint32)
+        self._ids.append(df["ID"].to_numpy(dtype=object)[is_error])
+        self._days.append(days[is_error])
+        self._site_codes.append(site[is_error])
+        self._type_codes.append(type_[is_error])
+        self._moment_codes.append(moment[is_error])
+        for code_type, column in CODE_COLUMNS.items():
+            codes = pd.to_numeric(df[column], errors="coerce").to_numpy()[is_error]
+            known = ~np.isnan(codes)
+            for code, positions in pd.Series(rows[known]).groupby(codes[known].astype(np.int64)):
+                self._postings[(code_type, int(code))].append(positions.to_numpy())
+        self.errors += len(rows)
+
+        self.last_value = df["Datetime start"].iloc[-1]
+        self.last_id = df["ID"].iloc[-1]
+
+    def _counters(self) -> pd.DataFrame:
+        if len(self._counter_parts) > 1:
+            self._counter_parts = [
+                pd.concat(self._counter_parts, ignore_index=True)
+                .groupby(_COUNTER_KEYS, dropna=False, sort=False)[["nb", "nb_err"]]
+                .sum()
+                .reset_index()
+            ]
+        if not self._counter_parts:
+            return pd.DataFrame(columns=_COUNTER_KEYS + ["nb", "nb_err"])
+        return self._counter_parts[0]
+
+    def _label_mask(self, values: np.ndarray, labels: _Labels, wanted: list[str]) -> np.ndarray | None:
+        if not wanted:
+            return None
+        return np.isin(values, labels.lookup(wanted))
+
+    def _scope_mask(
+        self,
+        days: np.ndarray,
+        site: np.ndarray,
+        type_: np.ndarray,
+        moment: np.ndarray,
+        site_list: list[str],
+        date_debut: date | None,
+        date_fin: date | None,
+        error_type_list: list[str],
+        moment_list: list[str],
+    ) -> np.ndarray:
+        mask = np.ones(len(days), dtype=bool)
+        if date_debut:
+            mask &= days >= _day_numbers([date_debut])[0]
+        if date_fin:
+            mask &= days <= _day_numbers([date_fin])[0]
+        for values, labels, wanted in (
+            (site, self.sites, site_list),
+            (type_, self.types, error_type_list),
+            (moment, self.moments, moment_list),
+        ):
+            selected = self._label_mask(values, labels, wanted)
+            if selected is not None:
+                mask &= selected
+        return mask
+
+    def lookup(
+        self,
+        code_type: str,
+        codes: list[int],
+        site_list: list[str],
+        date_debut: date | None,
+        date_fin: date | None,
+        error_type_list: list[str],
+        moment_list: list[str],
+    ) -> list:
+        """ID des sessions en erreur portant l'un des `codes` (sur les deux colonnes si `code_type` vaut « Tous »)."""
+        code_types = [code_type] if code_type in CODE_COLUMNS else list(CODE_COLUMNS)
+        postings = [
+            self._postings[key].array()
+            for key in ((t, int(c)) for t in code_types for c in codes)
+            if key in self._postings
+        ]
+        if not postings:
+            return []
+        rows = np.unique(np.concatenate(postings))
+
+        # Numéros triés comme `Datetime start` : la plage de jours est une tranche
+        days = self._days.array()
+        if date_debut:
+            rows = rows[np.searchsorted(rows, np.searchsorted(days, _day_numbers([date_debut])[0], "left")):]
+        if date_fin:
+            rows = rows[: np.searchsorted(rows, np.searchsorted(days, _day_numbers([date_fin])[0], "right"))]
+
+        mask = self._scope_mask(
+            days[rows],
+            self._site_codes.array()[rows],
+            self._type_codes.array()[rows],
+            self._moment_codes.array()[rows],
+            site_list,
+            None,
+            None,
+            error_type_list,
+            moment_list,
+        )
+        return self._ids.array()[rows[mask]].tolist()
+
+    def totals(
+        self,
+        site_list: list[str],
+        date_debut: date | None,
+        date_fin: date | None,
+        error_type_list: list[str],
+        moment_list: list[str],
+    ) -> tuple[int, pd.DataFrame]:
+        """Nombre de sessions en erreur et nombre de sessions par véhicule (colonnes Vehicle, total_charges)."""
+        counters = self._counters()
+        mask = self._scope_mask(
+            counters["day"].to_numpy(),
+            counters["site"].to_numpy(),
+            counters["type"].to_numpy(),
+            counters["moment"].to_numpy(),
+            site_list,
+            date_debut,
+            date_fin,
+            error_type_list,
+            moment_list,
+        )
+        scoped = counters[mask]
+        vehicle_totals = (
+            scoped.groupby("Vehicle", sort=False)["nb"].sum().reset_index(name="total_charges")
+        )
+        return int(scoped["nb_err"].sum()), vehicle_totals
+
+    def stats(self) -> dict:
+        return {
+            "errors": self.errors,
+            "postings": len(self._postings),
+            "watermark": str(self.last_value) if self.last_value is not None else None,
+            "age_seconds": round(time.time() - self.loaded_at, 1),
+        }
+
+
+def _build_index() -> CodeIndex:
+    index = CodeIndex()
+    for chunk in iter_query_chunks(_SESSIONS_SQL.format(after=""), chunksize=CODE_INDEX_CHUNK_ROWS, typed=False):
+        index.add(chunk)
+    return index
+
+
+_code_index: CodeIndex | None = None
+
+
+async def refresh_code_index() -> CodeIndex:
+    """Construit l'index (ou le reconstruit s'il est trop ancien), sinon ajoute les nouvelles sessions."""
+    global _code_index
+    index = _code_index
+    if index is None or index.last_value is None or time.time() - index.loaded_at > CODE_INDEX_REBUILD_SECONDS:
+        _code_index = await asyncio.to_thread(_build_index)
+        return _code_index
+
+    df = await query_df_async(
+        _SESSIONS_SQL.format(after=_AFTER_WATERMARK),
+        {"wm_value": index.last_value, "wm_id": index.last_id},
+        use_cache=False,
+        typed=False,
+    )
+    index.add(df)
+    return index
+
+
+def get_code_index() -> CodeIndex | None:
+    """Index courant, ou None tant que la première construction n'est pas terminée."""
+    return _code_index
+
+
+async def code_index_refresh_loop() -> None:
+    """Rafraîchissement périodique en tâche de fond (CODE_INDEX_REFRESH_SECONDS > 0)."""
+    while True:
+        try:
+            await refresh_code_index()
+        except Exception as exc:
+            print(f"Rafraîchissement de l'index des codes en échec : {exc}")
+        await asyncio.sleep(CODE_INDEX_REFRESH_SECONDS)
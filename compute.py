@@ -0,0 +1,167 @@
+"""
+Exécuteurs de calcul pour les transformations pandas des routers
+
+- pool de threads : transformations NumPy/pandas qui relâchent le GIL (groupby, pivots)
+- pool de processus : transformations dominées par du Python pur (regex, boucles)
+- pool de hachage : bcrypt (login), concurrence et file bornées pour ne pas affamer les autres pools
+
+Les fonctions soumises au pool de processus doivent être définies au niveau module
+(picklables) et recevoir/retourner des objets sérialisables.
+"""
+
+import asyncio
+import contextvars
+import functools
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable
+
+COMPUTE_THREADS = int(os.getenv("COMPUTE_THREADS", str(os.cpu_count() or 4)))
+COMPUTE_PROCESSES = int(os.getenv("COMPUTE_PROCESSES", str(os.cpu_count() or 2)))
+HASHING_THREADS = int(os.getenv("HASHING_THREADS", "2"))
+HASHING_MAX_QUEUE = int(os.getenv("HASHING_MAX_QUEUE", "32"))
+
+
+class ExecutorSaturated(RuntimeError):
+    """La file d'attente bornée d'un pool est pleine : la tâche est refusée sans être soumise."""
+
+
+def _timed_call(fn: Callable, args: tuple, kwargs: dict) -> tuple[Any, float, float]:
+    """Exécute fn dans le worker et retourne (résultat, début, fin) en temps horloge."""
+    started = time.time()
+    result = fn(*args, **kwargs)
+    return result, started, time.time()
+
+
+class ComputeExecutor:
+    """Pool d'exécution instrumenté : profondeur de file, tâches en cours et temps d'exécution."""
+
+    def __init__(self, name: str, kind: str, max_workers: int, max_queue: int | None = None):
+        self.name = name
+        self.kind = kind
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max_queue
+        self._executor: Executor | None = None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.run_seconds_total = 0.0
+        self.run_seconds_max = 0.0
+        self.wait_seconds_total = 0.0
+        self._by_task: dict[str, dict[str, float]] = {}
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    if self.kind == "process":
+                        self._executor = ProcessPoolExecutor(
+                            max_workers=self.max_workers,
+                            mp_context=multiprocessing.get_context("spawn"),
+                        )
+                    else:
+                        self._executor = ThreadPoolExecutor(
+                            max_workers=self.max_workers,
+                            thread_name_prefix=f"compute-{self.name}",
+                        )
+        return self._executor
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        if self.kind == "process":
+            call = functools.partial(_timed_call, fn, args, kwargs)
+        else:
+            # Les threads héritent du contexte (profilage par requête, etc.)
+            ctx = contextvars.copy_context()
+            call = functools.partial(ctx.run, _timed_call, fn, args, kwargs)
+
+        task_name = getattr(fn, "__qualname__", repr(fn))
+        submitted_at = time.time()
+        with self._lock:
+            if self.max_queue is not None and self.in_flight >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise ExecutorSaturated(self.name)
+            self.in_flight += 1
+            self.submitted += 1
+
+        try:
+            result, started, finished = await loop.run_in_executor(self._get_executor(), call)
+        except BaseException:
+            with self._lock:
+                self.in_flight -= 1
+                self.failed += 1
+            raise
+
+        run_seconds = max(0.0, finished - started)
+        with self._lock:
+            self.in_flight -= 1
+            self.completed += 1
+            self.run_seconds_total += run_seconds
+            self.run_seconds_max = max(self.run_seconds_max, run_seconds)
+            self.wait_seconds_total += max(0.0, started - submitted_at)
+            task = self._by_task.setdefault(task_name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+            task["count"] += 1
+            task["seconds"] += run_seconds
+            task["max_seconds"] = max(task["max_seconds"], run_seconds)
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "kind": self.kind,
+                "max_workers": self.max_workers,
+                "in_flight": self.in_flight,
+                "queue_depth": max(0, self.in_flight - self.max_workers),
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "run_seconds_total": round(self.run_seconds_total, 6),
+                "run_seconds_max": round(self.run_seconds_max, 6),
+                "wait_seconds_total": round(self.wait_seconds_total, 6),
+                "tasks": {name: dict(values) for name, values in self._by_task.items()},
+            }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+thread_executor = ComputeExecutor("threads", "thread", COMPUTE_THREADS)
+process_executor = ComputeExecutor("processes", "process", COMPUTE_PROCESSES)
+hashing_executor = ComputeExecutor("hashing", "thread", HASHING_THREADS, max_queue=HASHING_MAX_QUEUE)
+
+
+async def run_in_thread(fn: Callable, *args, **kwargs) -> Any:
+    """Exécute une transformation NumPy/pandas dans le pool de threads."""
+    return await thread_executor.run(fn, *args, **kwargs)
+
+
+async def run_in_process(fn: Callable, *args, **kwargs) -> Any:
+    """Exécute une transformation Python pur dans le pool de processus."""
+    return await process_executor.run(fn, *args, **kwargs)
+
+
+async def run_hashing(fn: Callable, *args, **kwargs) -> Any:
+    """Exécute un hachage de mot de passe ; lève ExecutorSaturated si la file est pleine."""
+    return await hashing_executor.run(fn, *args, **kwargs)
+
+
+_EXECUTORS = (thread_executor, process_executor, hashing_executor)
+
+
+def get_compute_stats() -> dict:
+    """Statistiques des pools de calcul (file d'attente, temps d'exécution par tâche)."""
+    return {executor.name: executor.stats() for executor in _EXECUTORS}
+
+
+def shutdown_executors() -> None:
+    for executor in _EXECUTORS:
+        executor.shutdown()
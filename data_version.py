@@ -0,0 +1,134 @@
+"""
+Versions des données et requêtes conditionnelles (ETag / 304)
+
+Un watermark peu coûteux par table source (compte et valeurs extrêmes, voir WATERMARK_SQL)
+est relu au plus toutes les DATA_VERSION_TTL secondes.
+Les endpoints décorés par @conditional dérivent un ETag faible de (endpoint, filtres, watermarks,
+templates) : si le navigateur présente déjà cette version (If-None-Match), la réponse est un 304
+sans requête ni rendu. L'ETag est faible : il reste valable pour la version compressée (gzip).
+"""
+
+import functools
+import hashlib
+import os
+import time
+
+from fastapi import Request
+from fastapi.responses import Response
+
+from db import invalidate_query_cache, query_df_async
+from singleflight import SingleFlight
+
+DATA_VERSION_TTL = float(os.getenv("DATA_VERSION_TTL", "15"))
+TEMPLATES_DIR = "templates"
+
+# Sonde par table : une ligne d'agrégats qui change quand l'ETL ajoute, clôt ou recalcule des lignes.
+# Pas de sonde par défaut (CHECKSUM TABLE relirait toute la table) : @conditional l'exige.
+WATERMARK_SQL = {
+    # Une clôture de défaut met à jour date_fin : le nombre de défauts ouverts change
+    "kpi_defauts_log": """
+        SELECT COUNT(*) AS n, SUM(date_fin IS NULL) AS ouverts, MAX(date_debut) AS debut, MAX(date_fin) AS fin
+        FROM kpi_defauts_log
+    """,
+    # Une ligne par mois : le taux du mois en cours est recalculé sans ajout de ligne
+    "kpi_evo": """
+        SELECT COUNT(*) AS n, MAX(mois) AS dernier_mois, SUM(tr) AS somme_tr
+        FROM kpi_evo
+    """,
+    # Une ligne par MAC non identifiée : le total des charges augmente à chaque recalcul
+    "kpi_mac_id": """
+        SELECT COUNT(*) AS n, SUM(nombre_de_charges) AS charges
+        FROM kpi_mac_id
+    """,
+}
+
+
+def _templates_stamp() -> str:
+    """Date de modification la plus récente des templates : un déploiement change les ETag."""
+    latest = 0.0
+    for root, _, files in os.walk(TEMPLATES_DIR):
+        for name in files:
+            latest = max(latest, os.path.getmtime(os.path.join(root, name)))
+    return str(int(latest))
+
+
+class DataVersions:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._values: dict[str, tuple[float, str]] = {}
+        self._flight = SingleFlight("watermark")
+
+    async def get(self, table: str) -> str:
+        cached = self._values.get(table)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        value, _ = await self._flight.do(table, functools.partial(self._probe, table))
+        return value
+
+    async def _probe(self, table: str) -> str:
+        df = await query_df_async(WATERMARK_SQL[table], use_cache=False, typed=False)
+        value = "|".join(str(v) for v in df.iloc[0].tolist()) if not df.empty else "empty"
+        previous = self._values.get(table)
+        if previous is None or previous[1] != value:
+            # Données changées (ou première lecture) : le cache de requêtes ne doit pas servir
+            # l'ancienne version sous le nouvel ETag
+            invalidate_query_cache(table)
+        self._values[table] = (time.monotonic() + self.ttl, value)
+        return value
+
+
+data_versions = DataVersions(DATA_VERSION_TTL)
+_TEMPLATES_STAMP = _templates_stamp()
+
+
+async def compute_etag(endpoint, kwargs: dict, tables: tuple[str, ...], clock_seconds: int = 0) -> str:
+    watermarks = [await data_versions.get(table) for table in tables]
+    filters = sorted((k, str(v)) for k, v in kwargs.items() if not isinstance(v, Request))
+    # Réponse dépendant de l'heure courante : l'ETag change aussi à chaque période
+    period = int(time.time() // clock_seconds) if clock_seconds else None
+    digest = hashlib.sha1(
+        repr((endpoint.__module__, endpoint.__qualname__, filters, watermarks, period, _TEMPLATES_STAMP)).encode()
+    ).hexdigest()
+    return f'W/"{digest[:20]}"'
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match", "")
+    candidates = {value.strip() for value in header.split(",") if value.strip()}
+    return "*" in candidates or etag in candidates
+
+
+def conditional(*tables: str, clock_seconds: int = 0):
+    """
+    Décorateur d'endpoint : ETag dérivé des watermarks de `tables`, 304 si le client a déjà
+    cette version. Sans effet quand l'endpoint est appelé par un autre (bundle).
+    Chaque table doit avoir sa sonde dans WATERMARK_SQL. Avec `clock_seconds`, l'ETag expire
+    aussi toutes les `clock_seconds` secondes (durées calculées depuis l'heure courante).
+    """
+    missing = [table for table in tables if table not in WATERMARK_SQL]
+    if missing:
+        raise ValueError(f"Pas de sonde de watermark pour : {', '.join(missing)}")
+
+    def decorate(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(**kwargs):
+            request = next((v for v in kwargs.values() if isinstance(v, Request)), None)
+            etag = None
+            if request is not None and request.scope.get("endpoint") is wrapper:
+                try:
+                    etag = await compute_etag(endpoint, kwargs, tables, clock_seconds)
+                except Exception as exc:
+                    print(f"Version des données indisponible ({', '.join(tables)}) : {exc}")
+                if etag and _etag_matches(request, etag):
+                    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+            response = await endpoint(**kwargs)
+            if etag and response.status_code == 200:
+                response.headers["ETag"] = etag
+                # Le navigateur garde la réponse mais revalide à chaque clic
+                response.headers["Cache-Control"] = "no-cache"
+            return response
+
+        return wrapper
+
+    return decorate
@@ -2,13 +2,23 @@
 Connexion MySQL avec pool de connexions SQLAlchemy
 """
 
+import hashlib
 import os
-from datetime import date, timedelta
-from typing import Optional
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Iterator, Optional
 from sqlalchemy import create_engine, text, inspect
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.pool import QueuePool
 import pandas as pd
 
+from metrics import observe_pool_wait, record_principal_lookup, record_query, stage
+from schemas import apply_schema
+from singleflight import query_flight
+
 DB_CONFIG = {
     "host": os.getenv("DB_HOST", "141.94.31.144"),
     "port": os.getenv("DB_PORT", "3306"),
@@ -22,6 +32,11 @@ DATABASE_URL = (
     f"@{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['database']}"
 )
 
+ASYNC_DATABASE_URL = (
+    f"mysql+aiomysql://{DB_CONFIG['user']}:{DB_CONFIG['password']}"
+    f"@{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['database']}"
+)
+
 engine = create_engine(
     DATABASE_URL,
     poolclass=QueuePool,
@@ -31,39 +46,280 @@ engine = create_engine(
     pool_pre_ping=True,
 )
 
+# Moteur asynchrone utilisé par les routers : n'occupe pas la boucle d'événements pendant l'aller-retour MySQL
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=5,
+    max_overflow=10,
+    pool_recycle=3600,
+    pool_pre_ping=True,
+)
 
-def get_sites() -> list[str]:
-    """Récupère la liste des sites disponibles"""
-    query = """
-        SELECT DISTINCT Site 
-        FROM kpi_sessions 
-        WHERE Site IS NOT NULL 
-        ORDER BY Site
-    """
-    with engine.connect() as conn:
-        result = conn.execute(text(query))
-        return [row[0] for row in result]
+# ============================================================
+# Cache des résultats de query_df
+# ============================================================
+QUERY_CACHE_ENABLED = os.getenv("QUERY_CACHE_ENABLED", "1") != "0"
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_MB", "256")) * 1024 * 1024
+QUERY_CACHE_DEFAULT_TTL = float(os.getenv("QUERY_CACHE_DEFAULT_TTL", "300"))
+
+# TTL (secondes) par table source : les alertes bougent vite, l'évolution mensuelle très peu
+QUERY_CACHE_TTL_BY_TABLE = {
+    "kpi_alertes": 30,
+    "kpi_defauts_log": 60,
+    "kpi_sessions": 300,
+    "kpi_sessions_rollup": 300,
+    "kpi_suspicious_under_1kwh": 300,
+    "kpi_multi_attempts_hour": 300,
+    "kpi_mac_id": 900,
+    "kpi_evo": 3600,
+}
+
+# Tables jamais mises en cache
+QUERY_CACHE_EXCLUDED_TABLES = {"users"}
+
+_TABLE_RE = re.compile(r"\b(?:FROM|JOIN)\s+`?(\w+)`?", re.IGNORECASE)
+_SQL_WS_RE = re.compile(r"('(?:[^'\\]|\\.)*'|`[^`]*`)|\s+")
+
+
+def _extract_tables(sql: str) -> frozenset[str]:
+    return frozenset(t.lower() for t in _TABLE_RE.findall(sql))
+
+
+def _normalize_sql(sql: str) -> str:
+    """Réduit les espaces hors littéraux pour que deux requêtes identiques partagent la même clé."""
+    return _SQL_WS_RE.sub(lambda m: m.group(1) or " ", sql).strip()
+
+
+def query_fingerprint(sql: str) -> str:
+    """Empreinte courte d'une requête normalisée (les paramètres liés n'y entrent pas)."""
+    return hashlib.sha1(_normalize_sql(sql).encode()).hexdigest()[:10]
+
+
+def _freeze_param(value):
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return repr(value)
+
+
+@dataclass
+class _CacheEntry:
+    df: pd.DataFrame
+    tables: frozenset[str]
+    nbytes: int
+    expires_at: float
 
 
-def get_date_range() -> dict:
-    """Récupère les dates min/max des sessions"""
-    query = """
-        SELECT 
-            MIN(DATE(`Datetime start`)) as date_min,
-            MAX(DATE(`Datetime start`)) as date_max
-        FROM kpi_sessions
+class QueryCache:
+    """Cache LRU des DataFrames retournés par query_df, borné en mémoire avec TTL par table."""
+
+    def __init__(self, max_bytes: int, default_ttl: float, ttl_by_table: dict[str, float]):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.ttl_by_table = ttl_by_table
+        self._entries: OrderedDict[tuple, _CacheEntry] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def accepts(self, sql: str) -> bool:
+        if not QUERY_CACHE_ENABLED or self.max_bytes <= 0:
+            return False
+        return not (_extract_tables(sql) & QUERY_CACHE_EXCLUDED_TABLES)
+
+    @staticmethod
+    def make_key(sql: str, params: dict | None) -> tuple:
+        frozen = tuple(sorted((k, _freeze_param(v)) for k, v in (params or {}).items()))
+        return _normalize_sql(sql), frozen
+
+    def ttl_for(self, tables: frozenset[str]) -> float:
+        ttls = [self.ttl_by_table.get(t, self.default_ttl) for t in tables]
+        return min(ttls) if ttls else self.default_ttl
+
+    def get(self, key: tuple) -> Optional[pd.DataFrame]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expires_at <= time.monotonic():
+                self._drop(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            df = entry.df
+        # Copie : les routers modifient les DataFrames reçus
+        return df.copy()
+
+    def set(self, key: tuple, df: pd.DataFrame, tables: frozenset[str], nbytes: int | None = None) -> None:
+        if nbytes is None:
+            nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        if nbytes > self.max_bytes:
+            return
+        entry = _CacheEntry(df, tables, nbytes, time.monotonic() + self.ttl_for(tables))
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = entry
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def invalidate(self, table: str | None = None) -> int:
+        with self._lock:
+            if table is None:
+                keys = list(self._entries)
+            else:
+                table = table.lower()
+                keys = [k for k, e in self._entries.items() if table in e.tables]
+            for key in keys:
+                self._drop(key)
+            return len(keys)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def _drop(self, key: tuple) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= entry.nbytes
+
+
+query_cache = QueryCache(QUERY_CACHE_MAX_BYTES, QUERY_CACHE_DEFAULT_TTL, QUERY_CACHE_TTL_BY_TABLE)
+
+
+def invalidate_query_cache(table: str | None = None) -> int:
+    """Invalide les résultats en cache (tous, ou ceux qui lisent `table`). Retourne le nombre d'entrées retirées."""
+    return query_cache.invalidate(table)
+
+
+def get_query_cache_stats() -> dict:
+    """Compteurs hit/miss et occupation mémoire du cache de requêtes."""
+    return query_cache.stats()
+
+
+def _finish_query(
+    sql: str, df: pd.DataFrame, typed: bool, key: tuple | None, started: float
+) -> pd.DataFrame:
+    """Typage, métriques et mise en cache d'un résultat fraîchement lu."""
+    tables = _extract_tables(sql)
+    if typed:
+        apply_schema(df, tables)
+    nbytes = int(df.memory_usage(index=True, deep=True).sum())
+    record_query(len(df), nbytes, "mysql", query_fingerprint(sql), time.perf_counter() - started)
+    if key is not None:
+        query_cache.set(key, df, tables, nbytes)
+    return df
+
+
+def query_df(sql: str, params: dict = None, use_cache: bool = True, typed: bool = True) -> pd.DataFrame:
     """
-    with engine.connect() as conn:
-        result = conn.execute(text(query)).fetchone()
-        return {
-            "min": result[0] or date.today() - timedelta(days=365),
-            "max": result[1] or date.today(),
-        }
+    Exécute une requête et retourne un DataFrame.
+    Avec `typed`, les colonnes déclarées dans schemas.TABLE_SCHEMAS sont typées au chargement.
+    """
+    with stage("fetch"):
+        started = time.perf_counter()
+        key = None
+        if use_cache and query_cache.accepts(sql):
+            key = query_cache.make_key(sql, params) + (typed,)
+            cached = query_cache.get(key)
+            if cached is not None:
+                record_query(len(cached), 0, "cache", query_fingerprint(sql), time.perf_counter() - started)
+                return cached
+
+        checkout_started = time.perf_counter()
+        with engine.connect() as conn:
+            observe_pool_wait("sync", time.perf_counter() - checkout_started)
+            df = pd.read_sql(text(sql), conn, params=params)
 
+        df = _finish_query(sql, df, typed, key, started)
+        # Copie : l'original est conservé dans le cache
+        return df.copy() if key is not None else df
 
-def query_df(sql: str, params: dict = None) -> pd.DataFrame:
+
+async def query_df_async(
+    sql: str, params: dict = None, use_cache: bool = True, typed: bool = True
+) -> pd.DataFrame:
+    """Équivalent awaitable de query_df, via le moteur asynchrone (même cache)."""
+    with stage("fetch"):
+        started = time.perf_counter()
+        key = None
+        if use_cache and query_cache.accepts(sql):
+            key = query_cache.make_key(sql, params) + (typed,)
+            cached = query_cache.get(key)
+            if cached is not None:
+                record_query(len(cached), 0, "cache", query_fingerprint(sql), time.perf_counter() - started)
+                return cached
+
+        async def fetch() -> pd.DataFrame:
+            checkout_started = time.perf_counter()
+            async with async_engine.connect() as conn:
+                observe_pool_wait("async", time.perf_counter() - checkout_started)
+                df = await conn.run_sync(
+                    lambda sync_conn: pd.read_sql(text(sql), sync_conn, params=params)
+                )
+            return _finish_query(sql, df, typed, key, started)
+
+        # Requêtes identiques concurrentes : un seul aller-retour MySQL, résultat partagé
+        flight_key = key or query_cache.make_key(sql, params) + (typed,)
+        df, shared = await query_flight.do(flight_key, fetch)
+        if shared:
+            record_query(len(df), 0, "coalesced", query_fingerprint(sql), time.perf_counter() - started)
+        # Copie : le résultat partagé (et mis en cache) n'est jamais remis tel quel
+        return df.copy()
+
+
+STREAM_CHUNK_ROWS = int(os.getenv("STREAM_CHUNK_ROWS", "50000"))
+
+
+def iter_query_chunks(
+    sql: str, params: dict = None, chunksize: int = STREAM_CHUNK_ROWS, typed: bool = True
+) -> Iterator[pd.DataFrame]:
+    """
+    Lit le résultat par blocs de `chunksize` lignes via un curseur serveur non bufferisé :
+    la mémoire reste bornée par la taille d'un bloc, quelle que soit la plage demandée.
+    Jamais mis en cache ; à consommer hors de la boucle d'événements (run_in_thread).
+    """
+    tables = _extract_tables(sql)
+    started = time.perf_counter()
+    rows = peak_bytes = 0
+
+    checkout_started = time.perf_counter()
     with engine.connect() as conn:
-        return pd.read_sql(text(sql), conn, params=params)
+        observe_pool_wait("sync", time.perf_counter() - checkout_started)
+        conn = conn.execution_options(stream_results=True, max_row_buffer=chunksize)
+        chunks = pd.read_sql(text(sql), conn, params=params, chunksize=chunksize)
+        while True:
+            # Seule la lecture compte dans l'étape fetch, pas le traitement du bloc par l'appelant
+            with stage("fetch"):
+                chunk = next(chunks, None)
+                if chunk is not None and typed:
+                    apply_schema(chunk, tables)
+            if chunk is None:
+                break
+            rows += len(chunk)
+            peak_bytes = max(peak_bytes, int(chunk.memory_usage(index=True, deep=True).sum()))
+            yield chunk
+
+    record_query(rows, peak_bytes, "stream", query_fingerprint(sql), time.perf_counter() - started)
 
 
 def table_exists(table_name: str) -> bool:
@@ -71,6 +327,25 @@ def table_exists(table_name: str) -> bool:
     return inspector.has_table(table_name)
 
 
+async def table_exists_async(table_name: str) -> bool:
+    async with async_engine.connect() as conn:
+        return await conn.run_sync(lambda sync_conn: inspect(sync_conn).has_table(table_name))
+
+
+_table_columns_cache: dict[str, frozenset[str]] = {}
+
+
+async def get_table_columns_async(table_name: str) -> frozenset[str]:
+    """Colonnes d'une table (mises en cache pour la durée du processus)."""
+    columns = _table_columns_cache.get(table_name)
+    if columns is None:
+        async with async_engine.connect() as conn:
+            described = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_columns(table_name))
+        columns = frozenset(col["name"] for col in described)
+        _table_columns_cache[table_name] = columns
+    return columns
+
+
 def ensure_users_table() -> None:
     """Crée la table users si elle n'existe pas."""
     if table_exists("users"):
@@ -90,22 +365,93 @@ def ensure_users_table() -> None:
         conn.commit()
 
 
+_USER_BY_USERNAME_SQL = text(
+    "SELECT id, username, password_hash, is_active, created_at FROM users WHERE username = :username"
+)
+
+
+def _user_from_row(row) -> Optional[dict]:
+    if row is None:
+        return None
+    return {
+        "id": row.id,
+        "username": row.username,
+        "password_hash": row.password_hash,
+        "is_active": bool(row.is_active),
+        "created_at": row.created_at,
+    }
+
+
 def get_user_by_username(username: str) -> Optional[dict]:
     """Retourne un utilisateur sous forme de dict ou None."""
-    query = text(
-        "SELECT id, username, password_hash, is_active, created_at FROM users WHERE username = :username"
-    )
     with engine.connect() as conn:
-        row = conn.execute(query, {"username": username}).fetchone()
-        if row is None:
-            return None
-        return {
-            "id": row.id,
-            "username": row.username,
-            "password_hash": row.password_hash,
-            "is_active": bool(row.is_active),
-            "created_at": row.created_at,
-        }
+        row = conn.execute(_USER_BY_USERNAME_SQL, {"username": username}).fetchone()
+        return _user_from_row(row)
+
+
+async def get_user_by_username_async(username: str) -> Optional[dict]:
+    """Version asynchrone de get_user_by_username."""
+    async with async_engine.connect() as conn:
+        result = await conn.execute(_USER_BY_USERNAME_SQL, {"username": username})
+        return _user_from_row(result.fetchone())
+
+
+# ============================================================
+# Cache des utilisateurs résolus par get_current_user
+# ============================================================
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "30"))
+
+
+class PrincipalCache:
+    """Utilisateurs indexés par sujet du jeton (username), conservés PRINCIPAL_CACHE_TTL secondes."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: dict[str, tuple[float, dict]] = {}
+
+    def get(self, username: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                return None
+            expires_at, user = entry
+            if expires_at <= time.monotonic():
+                del self._entries[username]
+                return None
+            return dict(user)
+
+    def set(self, username: str, user: dict) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[username] = (time.monotonic() + self.ttl, dict(user))
+
+    def invalidate(self, username: str | None = None) -> None:
+        with self._lock:
+            if username is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(username, None)
+
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_TTL)
+
+
+async def get_principal_async(username: str) -> Optional[dict]:
+    """
+    Utilisateur correspondant au sujet d'un jeton, via le cache (pas d'aller-retour MySQL
+    à chaque appel /api). Les utilisateurs inconnus ne sont pas mis en cache.
+    """
+    user = principal_cache.get(username)
+    if user is not None:
+        record_principal_lookup("hit")
+        return user
+    record_principal_lookup("miss")
+    user = await get_user_by_username_async(username)
+    if user is not None:
+        principal_cache.set(username, user)
+    return user
 
 
 def create_user(username: str, password_hash: str, is_active: bool = True) -> dict:
@@ -127,9 +473,23 @@ def create_user(username: str, password_hash: str, is_active: bool = True) -> di
         )
         conn.commit()
 
+        principal_cache.invalidate(username)
+
         return {
             "id": result.lastrowid,
             "username": username,
             "password_hash": password_hash,
             "is_active": is_active,
         }
+
+
+def set_user_active(username: str, is_active: bool) -> bool:
+    """Active ou désactive un utilisateur ; l'effet est immédiat sur les jetons déjà émis."""
+    with engine.connect() as conn:
+        result = conn.execute(
+            text("UPDATE users SET is_active = :is_active WHERE username = :username"),
+            {"username": username, "is_active": is_active},
+        )
+        conn.commit()
+    principal_cache.invalidate(username)
+    return result.rowcount > 0
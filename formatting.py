@@ -0,0 +1,124 @@
+"""
+Mise en forme vectorisée des tableaux affichés
+
+Chaque colonne est formatée en une opération (dates -> texte, arrondis, NULL -> "", URL),
+puis records() assemble les dictionnaires de lignes en une seule passe, sans iterrows().
+Les valeurs sont converties en types Python natifs (tolist) pour Jinja et JSON.
+"""
+
+import itertools
+from typing import Any, Mapping
+
+import numpy as np
+import pandas as pd
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M"
+BASE_CHARGE_URL = "https://elto.nidec-asi-online.com/Charge/detail?id="
+
+
+def column(df: pd.DataFrame, name: str, default: Any = "") -> pd.Series:
+    """Colonne `name`, ou une colonne constante `default` si elle est absente."""
+    if name in df.columns:
+        return df[name]
+    return pd.Series(default, index=df.index, dtype=object)
+
+
+def to_datetime(values: pd.Series) -> pd.Series:
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    return pd.to_datetime(values, errors="coerce", format="mixed")
+
+
+def format_datetime(values: pd.Series, fmt: str = DATETIME_FORMAT, na: str = "") -> pd.Series:
+    """Dates formatées ; `na` pour les valeurs nulles ou non interprétables."""
+    return to_datetime(values).dt.strftime(fmt).astype(object).fillna(na)
+
+
+def na_to_empty(values: pd.Series, na: Any = "") -> pd.Series:
+    values = values.astype(object)
+    return values.where(values.notna(), na)
+
+
+def blank_to(values: pd.Series, replacement: Any) -> pd.Series:
+    """Remplace les valeurs nulles et les chaînes vides."""
+    values = na_to_empty(values)
+    return values.where(values != "", replacement)
+
+
+def to_text(values: pd.Series, na: str = "") -> pd.Series:
+    """str(valeur), `na` pour les valeurs nulles."""
+    mask = values.notna()
+    return values.astype(str).where(mask, na).astype(object)
+
+
+def to_int(values: pd.Series, default: int = 0) -> pd.Series:
+    """Entiers ; `default` pour les valeurs nulles ou non numériques."""
+    return pd.to_numeric(values, errors="coerce").fillna(default).astype("int64")
+
+
+def round_number(values: pd.Series, ndigits: int, na: Any = "") -> pd.Series:
+    """Arrondi des valeurs numériques ; les autres valeurs non nulles sont conservées telles quelles."""
+    numeric = pd.to_numeric(values, errors="coerce").round(ndigits)
+    rounded = numeric.astype(object).where(numeric.notna(), values.astype(object))
+    return na_to_empty(rounded, na)
+
+
+def build_url(ids: pd.Series, prefix: str = BASE_CHARGE_URL) -> pd.Series:
+    """`prefix` + identifiant (sans espaces), "" si l'identifiant est vide."""
+    text = to_text(ids).str.strip()
+    return (prefix + text).where(text != "", "")
+
+
+def format_soc(start: pd.Series, end: pd.Series) -> pd.Series:
+    """Évolution du SOC « 20% → 80% », "" si l'une des deux bornes manque."""
+    s0 = pd.to_numeric(start, errors="coerce")
+    s1 = pd.to_numeric(end, errors="coerce")
+    valid = s0.notna() & s1.notna()
+    text = pd.Series("", index=start.index, dtype=object)
+    if valid.any():
+        text[valid] = (
+            np.round(s0[valid]).astype("int64").astype(str)
+            + "% → "
+            + np.round(s1[valid]).astype("int64").astype(str)
+            + "%"
+        )
+    return text
+
+
+def _as_values(value: Any, length: int):
+    if isinstance(value, (pd.Series, pd.Index, np.ndarray)):
+        return value.tolist()
+    if isinstance(value, (list, range)):
+        return value
+    return itertools.repeat(value, length)
+
+
+def records(columns: Mapping[str, Any], length: int) -> list[dict]:
+    """
+    Lignes {clé: valeur} à partir de colonnes déjà formatées (Series, tableaux, listes ou
+    constantes), alignées par position, en une seule passe.
+    """
+    keys = list(columns)
+    values = [_as_values(value, length) for value in columns.values()]
+    # Les constantes sont des itérateurs infinis : le nombre de lignes est borné par `length`
+    rows = itertools.islice(zip(*values), length)
+    return [dict(zip(keys, row)) for row in rows]
+
+
+class RowStream:
+    """
+    Lignes d'un DataFrame pour un template rendu en flux : `|length` et le test de vérité
+    fonctionnent comme sur une liste, mais les dictionnaires ne sont créés que par blocs
+    de `chunk_rows` pendant la boucle, jamais tous à la fois.
+    """
+
+    def __init__(self, df: pd.DataFrame, chunk_rows: int = 500):
+        self.df = df
+        self.chunk_rows = chunk_rows
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    def __iter__(self):
+        for start in range(0, len(self.df), self.chunk_rows):
+            yield from self.df.iloc[start:start + self.chunk_rows].to_dict("records")
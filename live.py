@@ -0,0 +1,302 @@
+"""
+Diffusion en direct (SSE) des alertes et défauts actifs
+
+Une seule tâche de fond suit toutes les LIVE_POLL_SECONDS secondes les lignes ouvertes de
+kpi_alertes (detection non nulle) et de kpi_defauts_log (date_fin nulle), quel que soit le
+nombre de clients, et rien tant que personne n'est connecté. Après une première lecture
+complète, chaque intervalle ne lit que les lignes ouvertes depuis la dernière vue (date
+d'ouverture) et, pour les défauts, celles clôturées depuis (date_fin). Un COUNT(*) des lignes
+ouvertes vérifie l'état obtenu : un écart (alerte retirée par l'ETL, ligne insérée avec une
+date ancienne) déclenche une relecture complète. Seuls les deltas (lignes apparues, lignes
+disparues ou clôturées) sont poussés aux clients abonnés, filtrés par site.
+"""
+
+import asyncio
+import os
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+import pandas as pd
+
+from db import query_df_async
+from formatting import column, format_datetime, na_to_empty, records, to_int
+from metrics import record_live_event, set_live_subscribers
+
+LIVE_POLL_SECONDS = int(os.getenv("LIVE_POLL_SECONDS", "15"))
+LIVE_HEARTBEAT_SECONDS = int(os.getenv("LIVE_HEARTBEAT_SECONDS", "15"))
+# Événements en attente par client ; au-delà, le client est déconnecté et se resynchronise
+LIVE_QUEUE_SIZE = int(os.getenv("LIVE_QUEUE_SIZE", "100"))
+
+
+def _alertes_rows(df: pd.DataFrame) -> list[dict]:
+    return records(
+        {
+            "site": na_to_empty(column(df, "Site")),
+            "pdc": na_to_empty(column(df, "PDC")),
+            "type": na_to_empty(column(df, "type_erreur")),
+            "detection": format_datetime(column(df, "detection", None)),
+            "occurrences": to_int(column(df, "occurrences_12h", 0)),
+            "moment": na_to_empty(column(df, "moment")),
+            "evi_code": na_to_empty(column(df, "evi_code")),
+            "downstream_code_pc": na_to_empty(column(df, "downstream_code_pc")),
+        },
+        len(df),
+    )
+
+
+def _defauts_rows(df: pd.DataFrame) -> list[dict]:
+    return records(
+        {
+            "site": na_to_empty(column(df, "site")),
+            "date_debut": format_datetime(column(df, "date_debut", None)),
+            "date_fin": format_datetime(column(df, "date_fin", None)),
+            "defaut": na_to_empty(column(df, "defaut")),
+            "eqp": na_to_empty(column(df, "eqp")),
+        },
+        len(df),
+    )
+
+
+@dataclass(frozen=True)
+class LiveSource:
+    """
+    Lignes ouvertes d'une table : colonnes lues, condition d'ouverture, date d'ouverture (et de
+    clôture, si la table en a une) servant de watermark, mise en forme et colonnes de la clé.
+    """
+
+    table: str
+    columns: str
+    open_condition: str
+    opened_col: str
+    keys: tuple[str, ...]
+    format_rows: Callable[[pd.DataFrame], list[dict]]
+    closed_col: Optional[str] = None
+
+    def open_sql(self) -> str:
+        return f"SELECT {self.columns} FROM {self.table} WHERE {self.open_condition}"
+
+    def opened_sql(self) -> str:
+        # >= : les lignes de même date que le watermark sont relues puis écartées par leur clé
+        return f"{self.open_sql()} AND {self.opened_col} >= :since"
+
+    def closed_sql(self) -> str:
+        return f"SELECT {self.columns}, {self.closed_col} FROM {self.table} WHERE {self.closed_col} >= :since"
+
+    def count_sql(self) -> str:
+        return f"SELECT COUNT(*) AS nb FROM {self.table} WHERE {self.open_condition}"
+
+    def last_closed_sql(self) -> str:
+        return f"SELECT MAX({self.closed_col}) AS last FROM {self.table}"
+
+
+SOURCES = {
+    "alertes": LiveSource(
+        "kpi_alertes",
+        "Site, PDC, type_erreur, detection, occurrences_12h, moment, evi_code, downstream_code_pc",
+        "detection IS NOT NULL",
+        "detection",
+        # occurrences_12h évolue sans que l'alerte change : hors de la clé
+        ("site", "pdc", "type", "detection", "moment"),
+        _alertes_rows,
+    ),
+    "defauts": LiveSource(
+        "kpi_defauts_log",
+        "site, date_debut, defaut, eqp",
+        "date_fin IS NULL",
+        "date_debut",
+        ("site", "date_debut", "defaut", "eqp"),
+        _defauts_rows,
+        closed_col="date_fin",
+    ),
+}
+
+
+@dataclass(eq=False)
+class Subscriber:
+    sites: frozenset[str]
+    queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=LIVE_QUEUE_SIZE))
+
+    def wants(self, row: dict) -> bool:
+        return not self.sites or row["site"] in self.sites
+
+
+class LiveHub:
+    def __init__(self):
+        self._rows: dict[str, dict[tuple, dict]] = {}
+        # Watermarks des lectures incrémentales : {"opened", "closed", "duplicates"} par source
+        self.since: dict[str, dict] = {}
+        self._subscribers: set[Subscriber] = set()
+        self._active = asyncio.Event()
+        self._ready = asyncio.Event()
+
+    def subscribe(self, sites: list[str]) -> Subscriber:
+        subscriber = Subscriber(frozenset(sites))
+        self._subscribers.add(subscriber)
+        set_live_subscribers(len(self._subscribers))
+        self._active.set()
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        self._subscribers.discard(subscriber)
+        set_live_subscribers(len(self._subscribers))
+        if not self._subscribers:
+            self._active.clear()
+
+    async def wait_for_subscribers(self) -> None:
+        """Attend un abonné ; l'état d'une période sans abonné est oublié, il sera relu."""
+        if self._subscribers:
+            return
+        self._rows.clear()
+        self.since.clear()
+        self._ready.clear()
+        await self._active.wait()
+
+    async def wait_ready(self, timeout: float) -> None:
+        """Attend (au plus `timeout` secondes) la première lecture de toutes les sources."""
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _view(self, subscriber: Subscriber, rows) -> list[dict]:
+        return [row for row in rows if subscriber.wants(row)]
+
+    def snapshot(self, subscriber: Subscriber) -> dict:
+        """État courant pour un nouvel abonné ; `ready` est faux avant la première lecture."""
+        snapshot = {}
+        for name in SOURCES:
+            rows = self._view(subscriber, self._rows.get(name, {}).values())
+            snapshot[name] = {"ready": name in self._rows, "count": len(rows), "rows": rows}
+        return snapshot
+
+    def _key(self, name: str, row: dict) -> tuple:
+        return tuple(row[k] for k in SOURCES[name].keys)
+
+    def count(self, name: str) -> int | None:
+        rows = self._rows.get(name)
+        return None if rows is None else len(rows)
+
+    def update(self, name: str, rows: list[dict]) -> bool:
+        """Remplace l'état de `name` (lecture complète) et publie le delta ; True si des lignes ont changé."""
+        current = {self._key(name, row): row for row in rows}
+        previous = self._rows.get(name)
+        self._rows[name] = current
+        if previous is None:
+            # Première lecture : état initial, envoyé aux abonnés par leur snapshot
+            if all(source in self._rows for source in SOURCES):
+                self._ready.set()
+            return False
+
+        added = [row for key, row in current.items() if key not in previous]
+        closed = [row for key, row in previous.items() if key not in current]
+        return self._publish(name, added, closed)
+
+    def apply(self, name: str, opened: list[dict], closed: list[dict]) -> bool:
+        """Applique une lecture incrémentale (lignes ouvertes, lignes clôturées) et publie le delta."""
+        current = self._rows[name]
+        added = []
+        for row in opened:
+            key = self._key(name, row)
+            if key not in current:
+                current[key] = row
+                added.append(row)
+        removed = []
+        for row in closed:
+            if current.pop(self._key(name, row), None) is not None:
+                removed.append(row)
+        return self._publish(name, added, removed)
+
+    def _publish(self, name: str, added: list[dict], closed: list[dict]) -> bool:
+        if not added and not closed:
+            return False
+        current = self._rows[name]
+
+        record_live_event(name)
+        for subscriber in list(self._subscribers):
+            event = {
+                "added": self._view(subscriber, added),
+                "closed": self._view(subscriber, closed),
+                "count": len(self._view(subscriber, current.values())),
+            }
+            if event["added"] or event["closed"]:
+                self._push(subscriber, (name, event))
+        return True
+
+    def _push(self, subscriber: Subscriber, event) -> None:
+        try:
+            subscriber.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Client trop lent : on vide sa file et on ferme le flux ; EventSource se
+            # reconnecte et repart d'un snapshot complet
+            while not subscriber.queue.empty():
+                subscriber.queue.get_nowait()
+            subscriber.queue.put_nowait(None)
+            self.unsubscribe(subscriber)
+
+
+live_hub = LiveHub()
+
+
+async def _read(sql: str, params: dict | None = None) -> pd.DataFrame:
+    return await query_df_async(sql, params, use_cache=False, typed=False)
+
+
+def _latest(df: pd.DataFrame, col: str, previous=None):
+    """Plus grande date de `col` (ou `previous` si le lot n'en apporte pas de plus récente)."""
+    values = pd.to_datetime(df[col], errors="coerce").dropna() if col in df.columns else pd.Series(dtype="datetime64[ns]")
+    if values.empty:
+        return previous
+    latest = values.max()
+    return latest if previous is None else max(latest, previous)
+
+
+async def _full_read(name: str, source: LiveSource) -> None:
+    df = await _read(source.open_sql())
+    since = {"opened": _latest(df, source.opened_col)}
+    if source.closed_col:
+        last = await _read(source.last_closed_sql())
+        since["closed"] = _latest(last, "last")
+    live_hub.update(name, source.format_rows(df))
+    # Lignes de même clé (doublons de la table) : écart attendu entre COUNT(*) et l'état
+    since["duplicates"] = len(df) - live_hub.count(name)
+    live_hub.since[name] = since
+
+
+async def _incremental_read(name: str, source: LiveSource) -> None:
+    since = live_hub.since[name]
+    opened = closed = pd.DataFrame()
+    if since["opened"] is not None:
+        opened = await _read(source.opened_sql(), {"since": since["opened"]})
+        since["opened"] = _latest(opened, source.opened_col, since["opened"])
+    if source.closed_col and since["closed"] is not None:
+        closed = await _read(source.closed_sql(), {"since": since["closed"]})
+        since["closed"] = _latest(closed, source.closed_col, since["closed"])
+    live_hub.apply(name, source.format_rows(opened), source.format_rows(closed))
+
+    # Contrôle : lignes retirées sans date de clôture, ou ouvertes avant le watermark
+    count = await _read(source.count_sql())
+    if int(count["nb"].iloc[0]) - live_hub.count(name) != since["duplicates"] or since["opened"] is None:
+        await _full_read(name, source)
+
+
+async def poll_live_sources() -> None:
+    """Lit les lignes ouvertes (ou clôturées) depuis la lecture précédente et publie les deltas."""
+    for name, source in SOURCES.items():
+        if live_hub.count(name) is None:
+            await _full_read(name, source)
+        else:
+            await _incremental_read(name, source)
+
+
+async def live_poll_loop() -> None:
+    """Lecture périodique en tâche de fond (LIVE_POLL_SECONDS > 0), suspendue sans abonné."""
+    while True:
+        # Sans client connecté, pas de lecture. Les fragments, eux, restent rafraîchis par le TTL
+        # du cache de requêtes et les watermarks de data_version ; les clients connectés
+        # appliquent les deltas à la page affichée
+        await live_hub.wait_for_subscribers()
+        try:
+            await poll_live_sources()
+        except Exception as exc:
+            print(f"Lecture des alertes et défauts en direct en échec : {exc}")
+        await asyncio.sleep(LIVE_POLL_SECONDS)
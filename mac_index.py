@@ -0,0 +1,169 @@
+"""
+Index de recherche des adresses MAC de kpi_sessions
+
+Les MAC sont normalisées une seule fois au chargement (minuscules, sans « 0x » ni séparateurs).
+Chaque MAC distincte est découpée en n-grammes (2 et 3 caractères) : un index inversé
+n-gramme -> MAC, puis MAC -> ID des sessions, résout une recherche partielle sans parcourir
+la table. Construit en tâche de fond, puis complété de façon incrémentale
+(watermark sur `Datetime start`/ID, comme les snapshots).
+"""
+
+import asyncio
+import os
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+import pandas as pd
+
+from db import iter_query_chunks, query_df_async
+
+MAC_INDEX_REFRESH_SECONDS = int(os.getenv("MAC_INDEX_REFRESH_SECONDS", "60"))
+# Reconstruction complète périodique : prend en compte les sessions corrigées ou supprimées par l'ETL
+MAC_INDEX_REBUILD_SECONDS = int(os.getenv("MAC_INDEX_REBUILD_SECONDS", "86400"))
+MAC_INDEX_CHUNK_ROWS = int(os.getenv("MAC_INDEX_CHUNK_ROWS", "100000"))
+
+NGRAM_SIZES = (2, 3)
+
+_SESSIONS_SQL = """
+    SELECT ID, `MAC Address` AS mac, `Datetime start`
+    FROM kpi_sessions
+    WHERE `Datetime start` IS NOT NULL {after}
+    ORDER BY `Datetime start`, ID
+"""
+_AFTER_WATERMARK = "AND (`Datetime start` > :wm_value OR (`Datetime start` = :wm_value AND ID > :wm_id))"
+
+
+def normalize_mac(values: pd.Series) -> pd.Series:
+    """Forme normalisée des MAC : hexadécimal minuscule sans préfixe « 0x » ni séparateurs, "" si NULL."""
+    text = values.astype(object).where(values.notna(), "").astype(str)
+    return (
+        text.str.lower()
+        .str.replace("0x", "", regex=False)
+        .str.replace(r"[^0-9a-f]", "", regex=True)
+    )
+
+
+def _ngrams(value: str, n: int) -> set[str]:
+    return {value[i:i + n] for i in range(len(value) - n + 1)}
+
+
+@dataclass
+class MacMatch:
+    """Résultat d'une recherche : ID des sessions et valeurs brutes de `MAC Address` correspondantes."""
+
+    session_ids: list = field(default_factory=list)
+    raw_macs: list[str] = field(default_factory=list)
+
+
+class MacIndex:
+    def __init__(self):
+        self.macs: list[str] = []
+        self._codes: dict[str, int] = {}
+        self._grams: dict[str, set[int]] = defaultdict(set)
+        self._session_ids: list[list] = []
+        self._raw_macs: list[set[str]] = []
+        self.sessions = 0
+        self.last_value = None
+        self.last_id = None
+        self.loaded_at = time.time()
+
+    def _code(self, mac: str) -> int:
+        code = self._codes.get(mac)
+        if code is None:
+            code = len(self.macs)
+            self._codes[mac] = code
+            self.macs.append(mac)
+            self._session_ids.append([])
+            self._raw_macs.append(set())
+            for n in NGRAM_SIZES:
+                for gram in _ngrams(mac, n):
+                    self._grams[gram].add(code)
+        return code
+
+    def add(self, df: pd.DataFrame) -> None:
+        """Ajoute un bloc de sessions (ID, mac, Datetime start), trié par `Datetime start` puis ID."""
+        if df.empty:
+            return
+        rows = pd.DataFrame({"norm": normalize_mac(df["mac"]), "raw": df["mac"], "id": df["ID"]})
+        rows = rows[rows["norm"] != ""]
+        for (mac, raw), ids in rows.groupby(["norm", "raw"], sort=False)["id"]:
+            code = self._code(mac)
+            self._session_ids[code].extend(ids.tolist())
+            self._raw_macs[code].add(raw)
+        self.sessions += len(rows)
+        self.last_value = df["Datetime start"].iloc[-1]
+        self.last_id = df["ID"].iloc[-1]
+
+    def _candidates(self, fragment: str) -> list[int]:
+        sizes = [n for n in NGRAM_SIZES if n <= len(fragment)]
+        if not sizes:
+            return [code for code, mac in enumerate(self.macs) if fragment in mac]
+        postings = sorted(
+            (self._grams.get(gram, set()) for gram in _ngrams(fragment, max(sizes))), key=len
+        )
+        codes = set(postings[0]).intersection(*postings[1:])
+        # Les n-grammes communs ne garantissent pas la sous-chaîne complète : vérification finale
+        return sorted(code for code in codes if fragment in self.macs[code])
+
+    def lookup(self, fragment: str) -> MacMatch:
+        """Sessions dont la MAC normalisée contient `fragment` (déjà normalisé)."""
+        match = MacMatch()
+        for code in self._candidates(fragment):
+            match.session_ids.extend(self._session_ids[code])
+            match.raw_macs.extend(self._raw_macs[code])
+        return match
+
+    def stats(self) -> dict:
+        return {
+            "macs": len(self.macs),
+            "ngrams": len(self._grams),
+            "sessions": self.sessions,
+            "watermark": str(self.last_value) if self.last_value is not None else None,
+            "age_seconds": round(time.time() - self.loaded_at, 1),
+        }
+
+
+def _build_index() -> MacIndex:
+    index = MacIndex()
+    for chunk in iter_query_chunks(_SESSIONS_SQL.format(after=""), chunksize=MAC_INDEX_CHUNK_ROWS, typed=False):
+        index.add(chunk)
+    return index
+
+
+_mac_index: MacIndex | None = None
+
+
+async def refresh_mac_index() -> MacIndex:
+    """Construit l'index (ou le reconstruit s'il est trop ancien), sinon ajoute les nouvelles sessions."""
+    global _mac_index
+    index = _mac_index
+    if index is None or index.last_value is None or time.time() - index.loaded_at > MAC_INDEX_REBUILD_SECONDS:
+        # Nouvel objet construit hors de la boucle : les recherches en cours gardent l'ancien
+        _mac_index = await asyncio.to_thread(_build_index)
+        return _mac_index
+
+    df = await query_df_async(
+        _SESSIONS_SQL.format(after=_AFTER_WATERMARK),
+        {"wm_value": index.last_value, "wm_id": index.last_id},
+        use_cache=False,
+        typed=False,
+    )
+    # Peu de lignes entre deux rafraîchissements : ajout direct sur la boucle, sans verrou
+    index.add(df)
+    return index
+
+
+def get_mac_index() -> MacIndex | None:
+    """Index courant, ou None tant que la première construction n'est pas terminée."""
+    return _mac_index
+
+
+async def mac_index_refresh_loop() -> None:
+    """Rafraîchissement périodique en tâche de fond (MAC_INDEX_REFRESH_SECONDS > 0)."""
+    while True:
+        try:
+            await refresh_mac_index()
+        except Exception as exc:
+            print(f"Rafraîchissement de l'index MAC en échec : {exc}")
+        await asyncio.sleep(MAC_INDEX_REFRESH_SECONDS)
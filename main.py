@@ -1,20 +1,53 @@
 from fastapi import Depends, FastAPI, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
+from starlette.datastructures import Headers
 from contextlib import asynccontextmanager
+import asyncio
+import os
 
-from db import engine, get_sites, get_date_range
-from routers import defauts, alertes, sessions, kpis, overview, filters, mac_address
+from catalog import CATALOG_REFRESH_SECONDS, catalog_refresh_loop, get_catalog
+from code_index import CODE_INDEX_REFRESH_SECONDS, code_index_refresh_loop
+from compute import get_compute_stats, shutdown_executors
+from db import async_engine, engine, get_query_cache_stats
+from live import LIVE_POLL_SECONDS, live_poll_loop
+from mac_index import MAC_INDEX_REFRESH_SECONDS, mac_index_refresh_loop
+from metrics import MetricsMiddleware, register_runtime_collector, render_latest
+from profiling import ProfilerMiddleware
+from rollups import ROLLUP_REFRESH_SECONDS, rollup_refresh_loop
+from snapshots import SNAPSHOT_ENABLED, SNAPSHOT_SYNC_SECONDS, open_snapshots, snapshot_sync_loop
+from routers import defauts, alertes, sessions, kpis, overview, filters, mac_address, bundle, live
 from routers.auth import (
     get_current_user,
     router as auth_router,
 )
+from templating import TimedTemplates
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("Démarrage ELTO Dashboard")
+    background_tasks = []
+    if CATALOG_REFRESH_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(catalog_refresh_loop()))
+    if ROLLUP_REFRESH_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(rollup_refresh_loop()))
+    if MAC_INDEX_REFRESH_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(mac_index_refresh_loop()))
+    if CODE_INDEX_REFRESH_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(code_index_refresh_loop()))
+    if LIVE_POLL_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(live_poll_loop()))
+    if SNAPSHOT_ENABLED:
+        print(f"Snapshots locaux ouverts : {', '.join(open_snapshots()) or 'aucun'}")
+        if SNAPSHOT_SYNC_SECONDS > 0:
+            background_tasks.append(asyncio.create_task(snapshot_sync_loop()))
     yield
+    for task in background_tasks:
+        task.cancel()
     engine.dispose()
+    await async_engine.dispose()
+    shutdown_executors()
     print("Arrêt ")
 
 app = FastAPI(
@@ -22,11 +55,36 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+GZIP_MINIMUM_SIZE = int(os.getenv("GZIP_MINIMUM_SIZE", "1024"))
+GZIP_COMPRESSLEVEL = int(os.getenv("GZIP_COMPRESSLEVEL", "6"))
+
+
+class StreamAwareGZipMiddleware(GZipMiddleware):
+    """GZip sauf pour les flux SSE : la compression retiendrait les événements dans son tampon."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and "text/event-stream" in Headers(scope=scope).get("accept", ""):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+# Le dernier middleware ajouté est le plus externe : MetricsMiddleware ouvre le contexte lu par le profiler,
+# la compression enveloppe le profiler (le pied de page de débogage est ajouté avant compression)
+app.add_middleware(ProfilerMiddleware)
+app.add_middleware(StreamAwareGZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE, compresslevel=GZIP_COMPRESSLEVEL)
+app.add_middleware(MetricsMiddleware)
+register_runtime_collector(
+    {"sync": engine.pool, "async": async_engine.sync_engine.pool},
+    get_query_cache_stats,
+    get_compute_stats,
+)
+
 # Static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.mount("/assets", StaticFiles(directory="assets"), name="assets")  
 # Templates Jinja2
-templates = Jinja2Templates(directory="templates")
+templates = TimedTemplates(directory="templates")
 
 # Inclure les routers
 app.include_router(auth_router)
@@ -39,12 +97,15 @@ app.include_router(alertes.router, prefix="/api", dependencies=protected_depende
 app.include_router(sessions.router, prefix="/api", dependencies=protected_dependency)
 app.include_router(kpis.router, prefix="/api", dependencies=protected_dependency)
 app.include_router(mac_address.router, prefix="/api", dependencies=protected_dependency)
+app.include_router(bundle.router, prefix="/api", dependencies=protected_dependency)
+app.include_router(live.router, prefix="/api", dependencies=protected_dependency)
 
 
 @app.get("/dashboard")
 async def index(request: Request, current_user: dict = Depends(get_current_user)):
-    sites = get_sites()
-    date_range = get_date_range()
+    catalog = await get_catalog()
+    sites = catalog.sites
+    date_range = catalog.date_range()
 
     return templates.TemplateResponse(
         "index.html",
@@ -58,6 +119,13 @@ async def index(request: Request, current_user: dict = Depends(get_current_user)
     )
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Métriques au format Prometheus (pool, requêtes, cache, temps de rendu)"""
+    payload, content_type = render_latest()
+    return Response(content=payload, media_type=content_type)
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
@@ -0,0 +1,287 @@
+"""
+Métriques Prometheus du dashboard, exposées sur /metrics
+
+- pool de connexions : attente au checkout, connexions empruntées, overflow
+- requêtes HTTP : latence par endpoint, découpée en étapes fetch (SQL), transform (pandas), render (Jinja)
+- query_df : lignes et octets ramenés par appel, par router
+- cache de requêtes et pools de calcul : compteurs lus à chaque collecte
+
+Le détail par requête (empreinte SQL, durée, rendus) est conservé pour le profiler (profiling.py).
+"""
+
+import contextvars
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+STAGES = ("fetch", "transform", "render")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ROWS_BUCKETS = (0, 10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+BYTES_BUCKETS = (1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000, 1_000_000_000)
+
+POOL_CHECKOUT_WAIT = Histogram(
+    "elto_db_pool_checkout_wait_seconds",
+    "Temps d'obtention d'une connexion du pool SQLAlchemy",
+    ["engine"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_DURATION = Histogram(
+    "elto_http_request_duration_seconds",
+    "Durée totale des requêtes HTTP par endpoint",
+    ["endpoint", "method", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_STAGE_DURATION = Histogram(
+    "elto_http_request_stage_seconds",
+    "Durée des requêtes HTTP par étape (fetch, transform, render)",
+    ["endpoint", "stage"],
+    buckets=LATENCY_BUCKETS,
+)
+QUERY_ROWS = Histogram(
+    "elto_query_rows",
+    "Lignes ramenées par appel à query_df",
+    ["router"],
+    buckets=ROWS_BUCKETS,
+)
+QUERY_BYTES = Histogram(
+    "elto_query_bytes",
+    "Taille mémoire des DataFrames ramenés par query_df",
+    ["router"],
+    buckets=BYTES_BUCKETS,
+)
+QUERY_CALLS = Counter("elto_query_calls", "Appels à query_df", ["router", "source"])
+PASSWORD_HASHING_DURATION = Histogram(
+    "elto_password_hashing_seconds",
+    "Durée des hachages/vérifications bcrypt, attente dans le pool comprise",
+    ["operation", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+COALESCED_CALLS = Counter(
+    "elto_singleflight_coalesced",
+    "Appels servis par un calcul identique déjà en cours",
+    ["flight"],
+)
+SECTION_FAILURES = Counter(
+    "elto_section_failures",
+    "Sections de page remplacées par un placeholder (échec ou délai dépassé)",
+    ["page", "section", "reason"],
+)
+PRINCIPAL_LOOKUPS = Counter(
+    "elto_auth_principal_lookups",
+    "Résolutions d'utilisateur par get_current_user (hit : lecture MySQL évitée)",
+    ["result"],
+)
+LIVE_SUBSCRIBERS = Gauge("elto_live_subscribers", "Clients connectés au flux SSE /api/live/stream")
+LIVE_EVENTS = Counter("elto_live_events", "Deltas publiés sur le flux SSE", ["source"])
+
+
+@dataclass
+class QueryRecord:
+    """Un appel à query_df (ou lecture de snapshot) pendant la requête."""
+
+    rows: int
+    nbytes: int
+    source: str
+    fingerprint: str = ""
+    seconds: float = 0.0
+
+
+@dataclass
+class RequestMetrics:
+    """Mesures accumulées pendant une requête HTTP."""
+
+    started: float = field(default_factory=time.perf_counter)
+    stages: dict[str, float] = field(default_factory=lambda: dict.fromkeys(STAGES, 0.0))
+    queries: list[QueryRecord] = field(default_factory=list)
+    renders: list[tuple[str, float]] = field(default_factory=list)
+    principal: str | None = None
+
+
+_current_request: contextvars.ContextVar[RequestMetrics | None] = contextvars.ContextVar(
+    "request_metrics", default=None
+)
+
+
+def current_request_metrics() -> RequestMetrics | None:
+    return _current_request.get()
+
+
+@contextmanager
+def stage(name: str):
+    """Ajoute la durée du bloc à l'étape `name` de la requête en cours."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        request_metrics = _current_request.get()
+        if request_metrics is not None:
+            request_metrics.stages[name] = request_metrics.stages.get(name, 0.0) + time.perf_counter() - started
+
+
+def observe_pool_wait(engine_name: str, seconds: float) -> None:
+    POOL_CHECKOUT_WAIT.labels(engine_name).observe(seconds)
+
+
+def record_query(rows: int, nbytes: int, source: str, fingerprint: str = "", seconds: float = 0.0) -> None:
+    """Enregistre un appel à query_df ; le router n'est connu qu'à la fin de la requête."""
+    request_metrics = _current_request.get()
+    if request_metrics is None:
+        _observe_query("background", rows, nbytes, source)
+    else:
+        request_metrics.queries.append(QueryRecord(rows, nbytes, source, fingerprint, seconds))
+
+
+def observe_password_hashing(operation: str, outcome: str, seconds: float) -> None:
+    PASSWORD_HASHING_DURATION.labels(operation, outcome).observe(seconds)
+
+
+def record_coalesced(flight: str) -> None:
+    COALESCED_CALLS.labels(flight).inc()
+
+
+def record_section_failure(page: str, section: str, reason: str) -> None:
+    SECTION_FAILURES.labels(page, section, reason).inc()
+
+
+def record_principal_lookup(result: str) -> None:
+    PRINCIPAL_LOOKUPS.labels(result).inc()
+
+
+def set_live_subscribers(count: int) -> None:
+    LIVE_SUBSCRIBERS.set(count)
+
+
+def record_live_event(source: str) -> None:
+    LIVE_EVENTS.labels(source).inc()
+
+
+def record_render(template: str, seconds: float) -> None:
+    request_metrics = _current_request.get()
+    if request_metrics is not None:
+        request_metrics.renders.append((template, seconds))
+
+
+def set_principal(username: str) -> None:
+    """Associe l'utilisateur authentifié à la requête en cours."""
+    request_metrics = _current_request.get()
+    if request_metrics is not None:
+        request_metrics.principal = username
+
+
+def _observe_query(router: str, rows: int, nbytes: int, source: str) -> None:
+    QUERY_CALLS.labels(router, source).inc()
+    QUERY_ROWS.labels(router).observe(rows)
+    QUERY_BYTES.labels(router).observe(nbytes)
+
+
+def _route_labels(scope) -> tuple[str, str]:
+    route = scope.get("route")
+    if route is None:
+        return "unmatched", "none"
+    tags = getattr(route, "tags", None) or ["app"]
+    return getattr(route, "path", "unmatched"), str(tags[0])
+
+
+class MetricsMiddleware:
+    """Middleware ASGI : ouvre le contexte de mesures de la requête et publie les histogrammes à la fin."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_metrics = RequestMetrics()
+        token = _current_request.set(request_metrics)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _current_request.reset(token)
+            self._publish(scope, request_metrics, status)
+
+    @staticmethod
+    def _publish(scope, request_metrics: RequestMetrics, status: int) -> None:
+        endpoint, router = _route_labels(scope)
+        total = time.perf_counter() - request_metrics.started
+        REQUEST_DURATION.labels(endpoint, scope.get("method", ""), str(status)).observe(total)
+
+        stages = request_metrics.stages
+        # transform : tout ce qui n'est ni SQL ni rendu (pandas inline et pools de calcul)
+        stages["transform"] = max(0.0, total - stages["fetch"] - stages["render"])
+        for name in STAGES:
+            REQUEST_STAGE_DURATION.labels(endpoint, name).observe(stages[name])
+
+        for query in request_metrics.queries:
+            _observe_query(router, query.rows, query.nbytes, query.source)
+
+
+class RuntimeCollector:
+    """Expose à chaque collecte l'état du pool, du cache de requêtes et des pools de calcul."""
+
+    def __init__(self, pools: dict, cache_stats: Callable[[], dict], compute_stats: Callable[[], dict]):
+        self.pools = pools
+        self.cache_stats = cache_stats
+        self.compute_stats = compute_stats
+
+    def collect(self):
+        checked_out = GaugeMetricFamily(
+            "elto_db_pool_checked_out", "Connexions empruntées au pool", labels=["engine"]
+        )
+        overflow = GaugeMetricFamily(
+            "elto_db_pool_overflow", "Connexions en dépassement de pool_size", labels=["engine"]
+        )
+        size = GaugeMetricFamily("elto_db_pool_size", "Taille configurée du pool", labels=["engine"])
+        for name, pool in self.pools.items():
+            checked_out.add_metric([name], pool.checkedout())
+            overflow.add_metric([name], max(0, pool.overflow()))
+            size.add_metric([name], pool.size())
+        yield checked_out
+        yield overflow
+        yield size
+
+        cache = self.cache_stats()
+        for key in ("hits", "misses", "evictions", "expirations"):
+            yield CounterMetricFamily(f"elto_query_cache_{key}", f"Cache de requêtes : {key}", value=cache[key])
+        yield GaugeMetricFamily("elto_query_cache_bytes", "Octets occupés par le cache de requêtes", value=cache["bytes"])
+        yield GaugeMetricFamily("elto_query_cache_entries", "Entrées du cache de requêtes", value=cache["entries"])
+
+        in_flight = GaugeMetricFamily("elto_compute_in_flight", "Tâches en cours par pool de calcul", labels=["pool"])
+        queue_depth = GaugeMetricFamily("elto_compute_queue_depth", "Tâches en attente par pool de calcul", labels=["pool"])
+        run_seconds = CounterMetricFamily(
+            "elto_compute_run_seconds", "Temps d'exécution cumulé par pool de calcul", labels=["pool"]
+        )
+        rejected = CounterMetricFamily(
+            "elto_compute_rejected", "Tâches refusées (file d'attente pleine) par pool de calcul", labels=["pool"]
+        )
+        for name, stats in self.compute_stats().items():
+            in_flight.add_metric([name], stats["in_flight"])
+            queue_depth.add_metric([name], stats["queue_depth"])
+            run_seconds.add_metric([name], stats["run_seconds_total"])
+            rejected.add_metric([name], stats["rejected"])
+        yield in_flight
+        yield queue_depth
+        yield run_seconds
+        yield rejected
+
+
+def register_runtime_collector(pools: dict, cache_stats: Callable[[], dict], compute_stats: Callable[[], dict]) -> None:
+    REGISTRY.register(RuntimeCollector(pools, cache_stats, compute_stats))
+
+
+def render_latest() -> tuple[bytes, str]:
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,152 @@
+"""
+Profiler par requête HTTP
+
+- en-tête Server-Timing sur chaque réponse : SQL (fetch), pandas (transform), Jinja (render), total,
+  puis une entrée par appel à query_df (empreinte, source, lignes, mémoire du DataFrame)
+- pied de page JSON de débogage sur les réponses HTML, réservé aux administrateurs,
+  sur demande (?debug=1, en-tête X-Debug-Profile: 1 ou cookie elto_debug=1)
+
+Les mesures sont celles accumulées par metrics.RequestMetrics : ce middleware doit être
+ajouté avant MetricsMiddleware (qui l'enveloppe et ouvre le contexte de la requête).
+"""
+
+import html
+import json
+import os
+import time
+from urllib.parse import parse_qs
+
+from starlette.datastructures import MutableHeaders
+
+from metrics import RequestMetrics, current_request_metrics
+
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "1") != "0"
+PROFILER_MAX_QUERY_ENTRIES = int(os.getenv("PROFILER_MAX_QUERY_ENTRIES", "20"))
+PROFILER_ADMIN_USERS = {
+    u.strip()
+    for u in os.getenv("PROFILER_ADMIN_USERS", os.getenv("DEFAULT_ADMIN_USER", "admin")).split(",")
+    if u.strip()
+}
+
+DEBUG_QUERY_PARAM = "debug"
+DEBUG_HEADER = b"x-debug-profile"
+DEBUG_COOKIE = "elto_debug"
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 1)
+
+
+def _stage_durations(request_metrics: RequestMetrics) -> dict[str, float]:
+    total = time.perf_counter() - request_metrics.started
+    fetch = request_metrics.stages.get("fetch", 0.0)
+    render = request_metrics.stages.get("render", 0.0)
+    return {
+        "fetch": fetch,
+        "transform": max(0.0, total - fetch - render),
+        "render": render,
+        "total": total,
+    }
+
+
+def server_timing(request_metrics: RequestMetrics) -> str:
+    """Valeur de l'en-tête Server-Timing pour les mesures accumulées jusqu'ici."""
+    durations = _stage_durations(request_metrics)
+    entries = [
+        f'fetch;dur={_ms(durations["fetch"])};desc="SQL ({len(request_metrics.queries)})"',
+        f'transform;dur={_ms(durations["transform"])};desc="pandas"',
+        f'render;dur={_ms(durations["render"])};desc="Jinja"',
+        f'total;dur={_ms(durations["total"])}',
+    ]
+    for i, query in enumerate(request_metrics.queries[:PROFILER_MAX_QUERY_ENTRIES], start=1):
+        entries.append(
+            f'q{i};dur={_ms(query.seconds)};'
+            f'desc="{query.fingerprint} {query.source} rows={query.rows} mem={query.nbytes // 1024}kB"'
+        )
+    return ", ".join(entries)
+
+
+def profile_payload(request_metrics: RequestMetrics) -> dict:
+    durations = _stage_durations(request_metrics)
+    return {
+        "user": request_metrics.principal,
+        "stages_ms": {name: _ms(value) for name, value in durations.items()},
+        "queries": [
+            {
+                "fingerprint": q.fingerprint,
+                "source": q.source,
+                "ms": _ms(q.seconds),
+                "rows": q.rows,
+                "bytes": q.nbytes,
+            }
+            for q in request_metrics.queries
+        ],
+        "renders": [{"template": name, "ms": _ms(seconds)} for name, seconds in request_metrics.renders],
+    }
+
+
+def _debug_footer(request_metrics: RequestMetrics) -> bytes:
+    payload = json.dumps(profile_payload(request_metrics), indent=2, ensure_ascii=False)
+    return (
+        '\n<details class="debug-profile"><summary>Profil de la requête</summary>'
+        f"<pre>{html.escape(payload)}</pre></details>\n"
+    ).encode()
+
+
+def _debug_requested(scope) -> bool:
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    if query.get(DEBUG_QUERY_PARAM, [""])[0] in ("1", "true"):
+        return True
+    for name, value in scope.get("headers", []):
+        if name == DEBUG_HEADER and value in (b"1", b"true"):
+            return True
+        if name == b"cookie" and f"{DEBUG_COOKIE}=1" in value.decode("latin-1"):
+            return True
+    return False
+
+
+class ProfilerMiddleware:
+    """Middleware ASGI : ajoute Server-Timing et, pour un administrateur qui le demande, le pied de page JSON."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        request_metrics = current_request_metrics()
+        if scope["type"] != "http" or not PROFILER_ENABLED or request_metrics is None:
+            await self.app(scope, receive, send)
+            return
+
+        debug = _debug_requested(scope)
+        held_start = None
+        body_parts: list[bytes] = []
+
+        async def send_profiled(message):
+            nonlocal held_start
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", server_timing(request_metrics))
+                if (
+                    debug
+                    and request_metrics.principal in PROFILER_ADMIN_USERS
+                    and headers.get("content-type", "").startswith("text/html")
+                ):
+                    # Le corps est retenu jusqu'au dernier fragment pour y ajouter le pied de page
+                    held_start = message
+                    return
+                await send(message)
+                return
+
+            if message["type"] == "http.response.body" and held_start is not None:
+                body_parts.append(message.get("body", b""))
+                if message.get("more_body", False):
+                    return
+                body = b"".join(body_parts) + _debug_footer(request_metrics)
+                MutableHeaders(scope=held_start)["content-length"] = str(len(body))
+                await send(held_start)
+                await send({"type": "http.response.body", "body": body})
+                return
+
+            await send(message)
+
+        await self.app(scope, receive, send_profiled)
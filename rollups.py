@@ -0,0 +1,307 @@
+"""
+Agrégats pré-calculés de kpi_sessions (jour, heure, site, PDC, état, erreur, véhicule)
+
+Le job de rafraîchissement est incrémental : il repart du dernier `Datetime start`/ID traité
+(high-watermark) et ne recalcule que les jours touchés, plus une fenêtre de rattrapage.
+
+Usage : python rollups.py [--full]
+"""
+
+import asyncio
+import os
+import sys
+import time
+from datetime import date, timedelta
+from typing import Iterable
+
+import pandas as pd
+from sqlalchemy import text
+
+from db import engine, invalidate_query_cache, query_df_async, table_exists_async
+from sql_filters import parse_list
+
+ROLLUP_TABLE = "kpi_sessions_rollup"
+WATERMARK_TABLE = "kpi_rollup_watermark"
+ROLLUP_LOOKBACK_DAYS = int(os.getenv("ROLLUP_LOOKBACK_DAYS", "2"))
+ROLLUP_REFRESH_SECONDS = int(os.getenv("ROLLUP_REFRESH_SECONDS", "0"))
+# Retard toléré du watermark sur le dernier `Datetime start` de kpi_sessions ; au-delà, lecture brute
+ROLLUP_MAX_LAG_SECONDS = int(os.getenv("ROLLUP_MAX_LAG_SECONDS", str(2 * ROLLUP_REFRESH_SECONDS)))
+
+ROLLUP_DIMENSIONS = ("day", "hour", "Site", "PDC", "state", "type_erreur", "moment", "Vehicle")
+ROLLUP_MEASURES = ("nb", "energy_kwh", "duration_min")
+
+CREATE_ROLLUP_SQL = f"""
+    CREATE TABLE IF NOT EXISTS {ROLLUP_TABLE} (
+        day DATE NOT NULL,
+        hour TINYINT NOT NULL,
+        Site VARCHAR(255) NULL,
+        PDC VARCHAR(64) NULL,
+        state INT NULL,
+        type_erreur VARCHAR(64) NULL,
+        moment VARCHAR(64) NULL,
+        Vehicle VARCHAR(255) NULL,
+        nb INT NOT NULL,
+        energy_kwh DOUBLE NULL,
+        duration_min DOUBLE NULL,
+        KEY idx_rollup_day_site (day, Site)
+    )
+"""
+
+CREATE_WATERMARK_SQL = f"""
+    CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} (
+        name VARCHAR(64) PRIMARY KEY,
+        last_datetime DATETIME NULL,
+        last_id VARCHAR(64) NULL,
+        refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    )
+"""
+
+# Expression SQL de chaque dimension/mesure sur la table brute
+RAW_EXPRESSIONS = {
+    "day": "DATE(`Datetime start`)",
+    "hour": "HOUR(`Datetime start`)",
+    "Site": "Site",
+    "PDC": "PDC",
+    "state": "`State of charge(0:good, 1:error)`",
+    "type_erreur": "type_erreur",
+    "moment": "moment",
+    "Vehicle": "Vehicle",
+    "nb": "COUNT(*)",
+    "energy_kwh": "SUM(`Energy (Kwh)`)",
+    "duration_min": "SUM(TIMESTAMPDIFF(SECOND, `Datetime start`, `Datetime end`)) / 60",
+}
+
+ROLLUP_EXPRESSIONS = {
+    **{dim: f"`{dim}`" for dim in ROLLUP_DIMENSIONS},
+    "nb": "SUM(nb)",
+    "energy_kwh": "SUM(energy_kwh)",
+    "duration_min": "SUM(duration_min)",
+}
+
+
+def ensure_rollup_tables() -> None:
+    """Crée les tables d'agrégats et de watermark si besoin."""
+    with engine.begin() as conn:
+        conn.execute(text(CREATE_ROLLUP_SQL))
+        conn.execute(text(CREATE_WATERMARK_SQL))
+
+
+def _rebuild_from(conn, from_day: date | None) -> int:
+    """Supprime puis recalcule les agrégats à partir de `from_day` (tout si None)."""
+    dims = ", ".join(RAW_EXPRESSIONS[d] for d in ROLLUP_DIMENSIONS)
+    measures = ", ".join(RAW_EXPRESSIONS[m] for m in ROLLUP_MEASURES)
+    columns = ", ".join(ROLLUP_DIMENSIONS + ROLLUP_MEASURES)
+    group_by = ", ".join(str(i) for i in range(1, len(ROLLUP_DIMENSIONS) + 1))
+
+    params = {}
+    where = "`Datetime start` IS NOT NULL"
+    if from_day is not None:
+        where += " AND `Datetime start` >= :from_day"
+        params["from_day"] = str(from_day)
+        conn.execute(text(f"DELETE FROM {ROLLUP_TABLE} WHERE day >= :from_day"), params)
+    else:
+        conn.execute(text(f"DELETE FROM {ROLLUP_TABLE}"))
+
+    result = conn.execute(
+        text(
+            f"""
+            INSERT INTO {ROLLUP_TABLE} ({columns})
+            SELECT {dims}, {measures}
+            FROM kpi_sessions
+            WHERE {where}
+            GROUP BY {group_by}
+            """
+        ),
+        params,
+    )
+    return result.rowcount
+
+
+def refresh_rollup(full: bool = False) -> dict:
+    """Rafraîchit les agrégats depuis le dernier watermark (ou intégralement si `full`)."""
+    ensure_rollup_tables()
+    started = time.monotonic()
+
+    with engine.begin() as conn:
+        watermark = conn.execute(
+            text(f"SELECT last_datetime, last_id FROM {WATERMARK_TABLE} WHERE name = :name"),
+            {"name": ROLLUP_TABLE},
+        ).fetchone()
+
+        latest = conn.execute(
+            text(
+                """
+                SELECT `Datetime start`, ID
+                FROM kpi_sessions
+                WHERE `Datetime start` IS NOT NULL
+                ORDER BY `Datetime start` DESC, ID DESC
+                LIMIT 1
+                """
+            )
+        ).fetchone()
+        if latest is None:
+            return {"mode": "empty", "rows": 0, "seconds": 0.0}
+
+        if full or watermark is None or watermark.last_datetime is None:
+            mode, from_day = "full", None
+        else:
+            new_rows = conn.execute(
+                text(
+                    """
+                    SELECT COUNT(*)
+                    FROM kpi_sessions
+                    WHERE `Datetime start` > :wm_dt
+                       OR (`Datetime start` = :wm_dt AND ID > :wm_id)
+                    """
+                ),
+                {"wm_dt": watermark.last_datetime, "wm_id": watermark.last_id or ""},
+            ).scalar()
+            if not new_rows:
+                return {"mode": "noop", "rows": 0, "seconds": round(time.monotonic() - started, 3)}
+            mode = "incremental"
+            from_day = pd.Timestamp(watermark.last_datetime).date() - timedelta(days=ROLLUP_LOOKBACK_DAYS)
+
+        rows = _rebuild_from(conn, from_day)
+
+        conn.execute(
+            text(
+                f"""
+                INSERT INTO {WATERMARK_TABLE} (name, last_datetime, last_id)
+                VALUES (:name, :last_datetime, :last_id)
+                ON DUPLICATE KEY UPDATE last_datetime = VALUES(last_datetime), last_id = VALUES(last_id)
+                """
+            ),
+            {"name": ROLLUP_TABLE, "last_datetime": latest[0], "last_id": str(latest[1])},
+        )
+
+    invalidate_query_cache(ROLLUP_TABLE)
+    _rollup_state.update(fresh=True, checked_at=time.monotonic())
+    return {
+        "mode": mode,
+        "from_day": str(from_day) if from_day else None,
+        "rows": rows,
+        "seconds": round(time.monotonic() - started, 3),
+    }
+
+
+async def rollup_refresh_loop() -> None:
+    """Rafraîchissement périodique en tâche de fond (ROLLUP_REFRESH_SECONDS > 0)."""
+    while True:
+        try:
+            await asyncio.to_thread(refresh_rollup)
+        except Exception as exc:
+            print(f"Rafraîchissement des agrégats en échec : {exc}")
+        await asyncio.sleep(ROLLUP_REFRESH_SECONDS)
+
+
+# Agrégats utilisables (table présente et à jour), revérifié périodiquement
+_rollup_state = {"fresh": False, "checked_at": 0.0}
+_ROLLUP_RECHECK_SECONDS = 60
+
+
+async def _rollup_is_fresh() -> bool:
+    """Le watermark des agrégats suit le dernier `Datetime start` de kpi_sessions (à ROLLUP_MAX_LAG_SECONDS près)."""
+    if not await table_exists_async(ROLLUP_TABLE) or not await table_exists_async(WATERMARK_TABLE):
+        return False
+    df = await query_df_async(
+        f"""
+        SELECT
+            (SELECT last_datetime FROM {WATERMARK_TABLE} WHERE name = :name) AS watermark,
+            (SELECT MAX(`Datetime start`) FROM kpi_sessions) AS latest
+        """,
+        {"name": ROLLUP_TABLE},
+        use_cache=False,
+        typed=False,
+    )
+    watermark = pd.to_datetime(df["watermark"].iloc[0], errors="coerce")
+    latest = pd.to_datetime(df["latest"].iloc[0], errors="coerce")
+    if pd.isna(watermark) or pd.isna(latest):
+        return False
+    return (latest - watermark).total_seconds() <= ROLLUP_MAX_LAG_SECONDS
+
+
+async def rollup_available() -> bool:
+    """
+    Vrai si les lectures peuvent passer par les agrégats. Sans rafraîchissement régulier
+    (ROLLUP_REFRESH_SECONDS = 0 après un `python rollups.py` ponctuel), les agrégats prennent
+    du retard : on revient alors à l'agrégation de kpi_sessions plutôt que de servir des
+    comptes figés à côté de statistiques à jour.
+    """
+    now = time.monotonic()
+    if now - _rollup_state["checked_at"] >= _ROLLUP_RECHECK_SECONDS:
+        _rollup_state["checked_at"] = now
+        try:
+            _rollup_state["fresh"] = await _rollup_is_fresh()
+        except Exception as exc:
+            print(f"Vérification des agrégats en échec : {exc}")
+            _rollup_state["fresh"] = False
+    return _rollup_state["fresh"]
+
+
+async def load_session_counts(
+    dimensions: Iterable[str],
+    sites: str = "",
+    date_debut: date | None = None,
+    date_fin: date | None = None,
+    measures: Iterable[str] = ("nb",),
+) -> pd.DataFrame:
+    """
+    Comptes de sessions groupés par `dimensions` (colonne `nb`, plus les sommes demandées).
+    Lit la table d'agrégats si elle est à jour, sinon agrège kpi_sessions côté MySQL.
+    """
+    dimensions = list(dimensions)
+    measures = list(measures)
+    use_rollup = await rollup_available()
+    expressions = ROLLUP_EXPRESSIONS if use_rollup else RAW_EXPRESSIONS
+
+    conditions = ["1=1"]
+    params: dict[str, str] = {}
+    if use_rollup:
+        if date_debut:
+            conditions.append("day >= :date_debut")
+            params["date_debut"] = str(date_debut)
+        if date_fin:
+            conditions.append("day <= :date_fin")
+            params["date_fin"] = str(date_fin)
+    else:
+        if date_debut:
+            conditions.append("`Datetime start` >= :date_debut")
+            params["date_debut"] = str(date_debut)
+        if date_fin:
+            conditions.append("`Datetime start` < DATE_ADD(:date_fin, INTERVAL 1 DAY)")
+            params["date_fin"] = str(date_fin)
+
+    site_list = parse_list(sites)
+    if site_list:
+        placeholders = ",".join(f":site_{i}" for i in range(len(site_list)))
+        conditions.append(f"Site IN ({placeholders})")
+        params.update({f"site_{i}": s for i, s in enumerate(site_list)})
+
+    select = [f"{expressions[d]} AS `{d}`" for d in dimensions]
+    select += [f"{expressions[m]} AS `{m}`" for m in measures]
+    sql = f"""
+        SELECT {", ".join(select)}
+        FROM {ROLLUP_TABLE if use_rollup else "kpi_sessions"}
+        WHERE {" AND ".join(conditions)}
+    """
+    if dimensions:
+        sql += " GROUP BY " + ", ".join(str(i) for i in range(1, len(dimensions) + 1))
+
+    df = await query_df_async(sql, params)
+    if "nb" in df.columns:
+        df["nb"] = pd.to_numeric(df["nb"], errors="coerce").fillna(0).astype(int)
+    return df
+
+
+def main():
+    full = "--full" in sys.argv[1:]
+    print("=" * 50)
+    print(f"📦 Rafraîchissement de {ROLLUP_TABLE} ({'complet' if full else 'incrémental'})")
+    print("=" * 50)
+    result = refresh_rollup(full=full)
+    print(f"✅ Mode {result['mode']} : {result['rows']} lignes en {result['seconds']} s")
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,14 +4,27 @@ Endpoint: GET /api/alertes
 """
 
 from fastapi import APIRouter, Request, Query
-from fastapi.templating import Jinja2Templates
 from datetime import date
 import pandas as pd
 
-from db import query_df
+from db import query_df_async
+from formatting import column, format_datetime, na_to_empty, records, to_int
+from sql_filters import compile_select
+from templating import TimedTemplates
 
 router = APIRouter(tags=["alertes"])
-templates = Jinja2Templates(directory="templates")
+templates = TimedTemplates(directory="templates")
+
+ALERTES_COLUMNS = [
+    "Site",
+    "PDC",
+    "type_erreur",
+    "detection",
+    "occurrences_12h",
+    "moment",
+    "evi_code",
+    "downstream_code_pc",
+]
 
 
 @router.get("/alertes")
@@ -26,52 +39,23 @@ async def get_alertes(
     """
     Retourne le fragment HTML des alertes actives
     """
-    sql = """
-        SELECT
-            Site,
-            PDC,
-            type_erreur,
-            detection,
-            occurrences_12h,
-            moment,
-            evi_code,
-            downstream_code_pc
-        FROM kpi_alertes
-        ORDER BY detection DESC
-    """
-    
-    df = query_df(sql)
+    sql, params = compile_select(
+        "kpi_alertes",
+        ALERTES_COLUMNS,
+        sites=sites,
+        date_debut=date_debut,
+        date_fin=date_fin,
+        error_types=error_types,
+        moments=moments,
+        extra=["detection IS NOT NULL"],
+        order_by="detection DESC",
+    )
+
+    df = await query_df_async(sql, params)
 
     if not df.empty:
         df["detection"] = pd.to_datetime(df["detection"], errors="coerce")
-
-        # Filtrer par dates
-        if date_debut:
-            df = df[df["detection"] >= pd.Timestamp(date_debut)]
-        if date_fin:
-            df = df[df["detection"] < pd.Timestamp(date_fin) + pd.Timedelta(days=1)]
-        
-        # Filtrer par sites
-        if sites:
-            site_list = [s.strip() for s in sites.split(",") if s.strip()]
-            if site_list:
-                df = df[df["Site"].isin(site_list)]
-
-        # Filtrer par type d'erreur
-        if error_types and "type_erreur" in df.columns:
-            type_list = [t.strip() for t in error_types.split(",") if t.strip()]
-            if type_list:
-                df = df[df["type_erreur"].isin(type_list)]
-
-        # Filtrer par moment
-        if moments and "moment" in df.columns:
-            moment_list = [m.strip() for m in moments.split(",") if m.strip()]
-            if moment_list:
-                df = df[df["moment"].isin(moment_list)]
-
-        # Trier par date de détection (plus récentes en premier)
-        if "detection" in df.columns:
-            df = df.dropna(subset=["detection"]).sort_values("detection", ascending=False)
+        df = df.dropna(subset=["detection"])
 
     nb_alertes = len(df)
     
@@ -88,35 +72,19 @@ async def get_alertes(
         top = df.groupby("Site").size().sort_values(ascending=False).head(5)
         top_sites = [{"site": site, "count": count} for site, count in top.items()]
 
-    rows = []
-    if not df.empty:
-        for _, row in df.iterrows():
-            detection_value = row.get("detection")
-            if pd.notna(detection_value):
-                detection_value = pd.to_datetime(detection_value, errors="coerce")
-                detection_value = (
-                    detection_value.strftime("%Y-%m-%d %H:%M")
-                    if not pd.isna(detection_value)
-                    else ""
-                )
-            else:
-                detection_value = ""
-
-            occurrences_val = pd.to_numeric(row.get("occurrences_12h", 0), errors="coerce")
-            occurrences = int(occurrences_val) if pd.notna(occurrences_val) else 0
-
-            rows.append(
-                {
-                    "site": row.get("Site", ""),
-                    "pdc": row.get("PDC", ""),
-                    "type": row.get("type_erreur", ""),
-                    "detection": detection_value,
-                    "occurrences": occurrences,
-                    "moment": row.get("moment", ""),
-                    "evi_code": row.get("evi_code", ""),
-                    "downstream_code_pc": row.get("downstream_code_pc", ""),
-                }
-            )
+    rows = records(
+        {
+            "site": na_to_empty(column(df, "Site")),
+            "pdc": na_to_empty(column(df, "PDC")),
+            "type": na_to_empty(column(df, "type_erreur")),
+            "detection": format_datetime(column(df, "detection", None)),
+            "occurrences": to_int(column(df, "occurrences_12h", 0)),
+            "moment": na_to_empty(column(df, "moment")),
+            "evi_code": na_to_empty(column(df, "evi_code")),
+            "downstream_code_pc": na_to_empty(column(df, "downstream_code_pc")),
+        },
+        len(df),
+    )
 
     return templates.TemplateResponse(
         "partials/alertes.html",
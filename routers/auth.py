@@ -1,6 +1,7 @@
 """Routes et dépendances pour l'authentification."""
 
 import os
+import time
 from datetime import datetime, timedelta
 from typing import Any, Optional
 from fastapi.responses import RedirectResponse
@@ -8,15 +9,23 @@ from fastapi.responses import RedirectResponse
 from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from fastapi.templating import Jinja2Templates
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel
 
-from db import create_user, ensure_users_table, get_user_by_username
+from compute import ExecutorSaturated, run_hashing
+from db import (
+    create_user,
+    ensure_users_table,
+    get_principal_async,
+    get_user_by_username,
+    get_user_by_username_async,
+)
+from metrics import observe_password_hashing, set_principal
+from templating import TimedTemplates
 
 router = APIRouter(tags=["auth"])
-templates = Jinja2Templates(directory="templates")
+templates = TimedTemplates(directory="templates")
 
 # Configuration
 SECRET_KEY = os.getenv("SECRET_KEY", "change-me")
@@ -42,11 +51,39 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
-def authenticate_user(username: str, password: str) -> Optional[dict[str, Any]]:
-    user = get_user_by_username(username)
+async def _run_hashing(operation: str, fn, *args):
+    """bcrypt hors de la boucle d'événements, dans le pool de hachage borné ; 503 s'il est saturé."""
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        return await run_hashing(fn, *args)
+    except ExecutorSaturated:
+        outcome = "rejected"
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many concurrent logins, retry shortly",
+            headers={"Retry-After": "2"},
+        )
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        observe_password_hashing(operation, outcome, time.perf_counter() - started)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await _run_hashing("verify", verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    return await _run_hashing("hash", get_password_hash, password)
+
+
+async def authenticate_user(username: str, password: str) -> Optional[dict[str, Any]]:
+    user = await get_user_by_username_async(username)
     if not user:
         return None
-    if not verify_password(password, user["password_hash"]):
+    if not await verify_password_async(password, user["password_hash"]):
         return None
     if not user.get("is_active", True):
         return None
@@ -93,9 +130,10 @@ async def get_current_user(token: str = Depends(get_current_token)) -> dict[str,
     except JWTError:
         raise credentials_exception
 
-    user = get_user_by_username(username)
+    user = await get_principal_async(username)
     if user is None or not user.get("is_active", True):
         raise credentials_exception
+    set_principal(user["username"])
     return user
 
 
@@ -125,7 +163,7 @@ async def login_page(request: Request):
 
 @router.post("/", response_model=Token)
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(form_data.username, form_data.password)
+    user = await authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect credentials")
 
@@ -0,0 +1,111 @@
+"""
+Router pour le chargement groupé des onglets
+Endpoint: GET /api/bundle
+
+Une seule requête (authentification et lecture des filtres une fois) rend plusieurs fragments
+en parallèle ; les lectures communes sont partagées via le store de sessions, le cache et le
+single-flight de query_df. Le premier fragment est la réponse principale (swap htmx normal),
+les suivants arrivent en hx-swap-oob dans #tab-prefetch, chacun dans un <template> inerte
+que l'onglet correspondant affichera sans nouvel appel.
+"""
+
+import asyncio
+import inspect
+import traceback
+from datetime import date
+from html import escape
+
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import HTMLResponse
+from fastapi.params import Param
+
+from metrics import record_section_failure
+from routers import alertes, defauts, kpis, overview, sessions
+from templating import response_text
+
+router = APIRouter(tags=["bundle"])
+
+# Noms des onglets côté index.html -> endpoint
+BUNDLE_PARTIALS = {
+    "overview": overview.get_overview,
+    "general": sessions.get_sessions_general,
+    "comparaison": sessions.get_sessions_comparaison,
+    "stats": sessions.get_sessions_stats,
+    "analyse-erreur": sessions.get_error_analysis,
+    "tentatives": kpis.get_multi_attempts,
+    "suspectes": kpis.get_suspicious,
+    "alertes": alertes.get_alertes,
+    "evolution": kpis.get_kpi_evolution,
+    "historique": defauts.get_defauts_historique,
+}
+
+
+def _endpoint_kwargs(endpoint, request: Request, filters: dict) -> dict:
+    """Arguments de l'endpoint : filtres partagés, sinon valeur par défaut de son Query()."""
+    kwargs = {}
+    for name, param in inspect.signature(endpoint).parameters.items():
+        if param.annotation is Request:
+            kwargs[name] = request
+        elif name in filters:
+            value = filters[name]
+            # Certains endpoints reçoivent les dates sous forme de chaîne
+            if isinstance(value, date) and param.annotation is not date:
+                value = str(value)
+            kwargs[name] = value
+        elif isinstance(param.default, Param):
+            kwargs[name] = param.default.default
+        else:
+            kwargs[name] = param.default
+    return kwargs
+
+
+async def _render_partial(name: str, request: Request, filters: dict) -> str:
+    endpoint = BUNDLE_PARTIALS[name]
+    try:
+        response = await endpoint(**_endpoint_kwargs(endpoint, request, filters))
+        return await response_text(response)
+    except HTTPException:
+        raise
+    except Exception as exc:
+        print(f"Bundle : fragment {name} en échec : {exc!r}")
+        traceback.print_exc()
+        record_section_failure("bundle", name, "error")
+        # Marqueur lu par index.html : un fragment préchargé en échec est redemandé à l'ouverture de l'onglet
+        return (
+            f'<div class="empty-state" data-bundle-error="{escape(name)}">'
+            "<div>Données temporairement indisponibles</div></div>"
+        )
+
+
+@router.get("/bundle", response_class=HTMLResponse)
+async def get_bundle(
+    request: Request,
+    partials: str = Query(..., description="Onglets séparés par virgule, le premier est la réponse principale"),
+    sites: str = Query(default=""),
+    date_debut: date = Query(default=None),
+    date_fin: date = Query(default=None),
+    error_types: str = Query(default=""),
+    moments: str = Query(default=""),
+):
+    names = list(dict.fromkeys(p.strip() for p in partials.split(",") if p.strip()))
+    unknown = [n for n in names if n not in BUNDLE_PARTIALS]
+    if not names or unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown partials: {', '.join(unknown) or '(none)'}")
+
+    filters = {
+        "sites": sites,
+        "date_debut": date_debut,
+        "date_fin": date_fin,
+        "error_types": error_types,
+        "moments": moments,
+    }
+    fragments = await asyncio.gather(*(_render_partial(name, request, filters) for name in names))
+
+    body = fragments[0]
+    if len(names) > 1:
+        templates_html = "".join(
+            f'<template data-partial="{escape(name)}">{fragment}</template>'
+            for name, fragment in zip(names[1:], fragments[1:])
+        )
+        body += f'\n<div id="tab-prefetch" hx-swap-oob="innerHTML">{templates_html}</div>'
+    return HTMLResponse(body)
@@ -4,14 +4,18 @@ Endpoint: GET /api/defauts-actifs
 """
 
 from fastapi import APIRouter, Request, Query
-from fastapi.templating import Jinja2Templates
 from datetime import datetime
+import numpy as np
 import pandas as pd
 
-from db import query_df
+from data_version import conditional
+from db import query_df_async
+from formatting import blank_to, format_datetime, records, to_int
+from sql_filters import compile_select
+from templating import TimedTemplates
 
 router = APIRouter(tags=["defauts"])
-templates = Jinja2Templates(directory="templates")
+templates = TimedTemplates(directory="templates")
 
 
 @router.get("/defauts-actifs")
@@ -22,24 +26,15 @@ async def get_defauts_actifs(
     """
     Retourne le fragment HTML des défauts actifs (KPI card + liste)
     """
-    sql = """
-        SELECT
-            site,
-            date_debut,
-            defaut,
-            eqp
-        FROM kpi_defauts_log
-        WHERE date_fin IS NULL
-        ORDER BY date_debut DESC
-    """
-    
-    df = query_df(sql)
-    
-    # Filtrer par sites si spécifié
-    if sites:
-        site_list = [s.strip() for s in sites.split(",") if s.strip()]
-        if site_list:
-            df = df[df["site"].isin(site_list)]
+    sql, params = compile_select(
+        "kpi_defauts_log",
+        ["site", "date_debut", "defaut", "eqp"],
+        sites=sites,
+        extra=["date_fin IS NULL"],
+        order_by="date_debut DESC",
+    )
+
+    df = await query_df_async(sql, params)
     
     # Calculs
     nb_defauts = len(df)
@@ -57,20 +52,19 @@ async def get_defauts_actifs(
     defauts_list = []
     if not df.empty:
         df["date_debut"] = pd.to_datetime(df["date_debut"], errors="coerce")
-        now = pd.Timestamp.now()
-        
-        for _, row in df.iterrows():
-            delta_days = (now - row["date_debut"]).days if pd.notna(row["date_debut"]) else 0
-            is_recent = delta_days < 1
-            
-            defauts_list.append({
-                "site": row["site"],
-                "defaut": row["defaut"],
-                "eqp": row["eqp"],
+        delta_days = to_int((pd.Timestamp.now() - df["date_debut"]).dt.days)
+
+        defauts_list = records(
+            {
+                "site": df["site"],
+                "defaut": df["defaut"],
+                "eqp": df["eqp"],
                 "depuis_jours": delta_days,
-                "is_recent": is_recent,
-                "card_class": "critical" if delta_days > 7 else "warning",
-            })
+                "is_recent": delta_days < 1,
+                "card_class": np.where(delta_days > 7, "critical", "warning"),
+            },
+            len(df),
+        )
     
     # Sites à surveiller (défauts < 24h)
     sites_recent = list(set(d["site"] for d in defauts_list if d["is_recent"]))
@@ -97,6 +91,8 @@ async def get_defauts_actifs(
 
 
 @router.get("/defauts-historique")
+# Durée des défauts en cours calculée depuis maintenant (jours entiers) : revalidée chaque heure
+@conditional("kpi_defauts_log", clock_seconds=3600)
 async def get_defauts_historique(
     request: Request,
     sites: str = Query(default="", description="Sites séparés par virgule"),
@@ -124,35 +120,23 @@ async def get_defauts_historique(
                 "OR (date_debut <= :d1 AND (date_fin >= :d2 OR date_fin IS NULL)))"
             )
 
-    sql = """
-        SELECT
-            site,
-            date_debut,
-            date_fin,
-            defaut,
-            eqp
-        FROM kpi_defauts_log
-    """
-
-    if where_clauses:
-        sql += " WHERE " + " AND ".join(where_clauses)
-
-    sql += " ORDER BY date_debut DESC"
-
-    df = query_df(sql, params=params)
+    sql, filter_params = compile_select(
+        "kpi_defauts_log",
+        ["site", "date_debut", "date_fin", "defaut", "eqp"],
+        sites=sites,
+        extra=where_clauses,
+        order_by="date_debut DESC",
+    )
+    params.update(filter_params)
 
-    # Filtre par site
-    if sites:
-        site_list = [s.strip() for s in sites.split(",") if s.strip()]
-        if site_list:
-            df = df[df["site"].isin(site_list)]
+    df = await query_df_async(sql, params=params)
 
     if not df.empty:
         df["date_debut"] = pd.to_datetime(df["date_debut"], errors="coerce")
         df["date_fin"] = pd.to_datetime(df["date_fin"], errors="coerce")
         now = pd.Timestamp.now()
         df["duree_jours"] = ((df["date_fin"].fillna(now)) - df["date_debut"]).dt.days
-        df["statut"] = df["date_fin"].apply(lambda x: "En cours" if pd.isna(x) else "Résolu")
+        df["statut"] = np.where(df["date_fin"].isna(), "En cours", "Résolu")
 
     nb_total = len(df)
     if not df.empty and "statut" in df.columns:
@@ -168,18 +152,18 @@ async def get_defauts_historique(
     rows = []
     if not df.empty:
         df_sorted = df.sort_values(by="date_debut", ascending=False)
-        for _, row in df_sorted.iterrows():
-            rows.append(
-                {
-                    "site": row.get("site") or "—",
-                    "date_debut": row["date_debut"].strftime("%Y-%m-%d %H:%M") if pd.notna(row["date_debut"]) else "-",
-                    "date_fin": row["date_fin"].strftime("%Y-%m-%d %H:%M") if pd.notna(row["date_fin"]) else "En cours",
-                    "duree": int(row.get("duree_jours", 0)),
-                    "statut": row.get("statut", "-"),
-                    "defaut": row.get("defaut") or "-",
-                    "eqp": row.get("eqp") or "-",
-                }
-            )
+        rows = records(
+            {
+                "site": blank_to(df_sorted["site"], "—"),
+                "date_debut": format_datetime(df_sorted["date_debut"], na="-"),
+                "date_fin": format_datetime(df_sorted["date_fin"], na="En cours"),
+                "duree": to_int(df_sorted["duree_jours"]),
+                "statut": df_sorted["statut"],
+                "defaut": blank_to(df_sorted["defaut"], "-"),
+                "eqp": blank_to(df_sorted["eqp"], "-"),
+            },
+            len(df_sorted),
+        )
 
     top_equipements = []
     top_defauts = []
@@ -1,13 +1,55 @@
 from fastapi import APIRouter, Request, Query
-from fastapi.templating import Jinja2Templates
 from datetime import date
 import pandas as pd
 
-from db import query_df, table_exists
+from data_version import conditional
+from db import get_table_columns_async, query_df_async, table_exists_async
+from formatting import (
+    BASE_CHARGE_URL,
+    build_url,
+    column,
+    format_datetime,
+    na_to_empty,
+    records,
+    round_number,
+    to_int,
+    to_text,
+)
+from sql_filters import compile_select
+from templating import TimedTemplates
 
 router = APIRouter(tags=["kpis"])
-templates = Jinja2Templates(directory="templates")
-BASE_CHARGE_URL = "https://elto.nidec-asi-online.com/Charge/detail?id="
+templates = TimedTemplates(directory="templates")
+
+SUSPICIOUS_COLUMNS = [
+    "ID",
+    "Site",
+    "PDC",
+    "MAC Address",
+    "Vehicle",
+    "Datetime start",
+    "Datetime end",
+    "Energy (Kwh)",
+    "SOC Start",
+    "SOC End",
+]
+
+MULTI_ATTEMPTS_COLUMNS = [
+    "Date_heure",
+    "Heure",
+    "Site",
+    "MAC",
+    "Vehicle",
+    "tentatives",
+    "PDC(s)",
+    "1ère tentative",
+    "Dernière tentative",
+    "ID(s)",
+    "SOC start min",
+    "SOC start max",
+    "SOC end min",
+    "SOC end max",
+]
 
 
 @router.get("/kpi/suspicious")
@@ -18,68 +60,39 @@ async def get_suspicious(
     date_fin: date = Query(default=None),
 ):
     """Transactions suspectes (<1 kWh)"""
-    sql = "SELECT * FROM kpi_suspicious_under_1kwh"
-    df = query_df(sql)
-
-    if not df.empty:
-        if "Datetime start" in df.columns:
-            df["Datetime start"] = pd.to_datetime(df["Datetime start"], errors="coerce")
-
-            if date_debut:
-                df = df[df["Datetime start"] >= pd.Timestamp(date_debut)]
-            if date_fin:
-                df = df[df["Datetime start"] < pd.Timestamp(date_fin) + pd.Timedelta(days=1)]
-
-        if sites and "Site" in df.columns:
-            site_list = [s.strip() for s in sites.split(",") if s.strip()]
-            if site_list:
-                df = df[df["Site"].isin(site_list)]
-
-        if "Datetime start" in df.columns:
-            df = df.sort_values("Datetime start")
-
-    def format_ts(value):
-        if pd.isna(value):
-            return ""
-        try:
-            ts = pd.to_datetime(value, errors="coerce")
-            return ts.strftime("%Y-%m-%d %H:%M") if not pd.isna(ts) else ""
-        except Exception:
-            return str(value)
-
-    def to_str(value):
-        if pd.isna(value):
-            return ""
-        return str(value)
-
-    def to_float(value):
-        if pd.isna(value):
-            return ""
-        try:
-            return round(float(value), 3)
-        except Exception:
-            return value
-
-    rows = []
-    if not df.empty:
-        for idx, (_, row) in enumerate(df.iterrows(), start=1):
-            charge_id = to_str(row.get("ID", ""))
-            rows.append(
-                {
-                    "rank": idx,
-                    "id": charge_id,
-                    "url": f"{BASE_CHARGE_URL}{charge_id}" if charge_id else "",
-                    "site": row.get("Site", ""),
-                    "pdc": to_str(row.get("PDC", "")),
-                    "mac": row.get("MAC Address", ""),
-                    "vehicle": row.get("Vehicle", ""),
-                    "start": format_ts(row.get("Datetime start")),
-                    "end": format_ts(row.get("Datetime end")),
-                    "energy": to_float(row.get("Energy (Kwh)")),
-                    "soc_start": to_float(row.get("SOC Start")),
-                    "soc_end": to_float(row.get("SOC End")),
-                }
-            )
+    table = "kpi_suspicious_under_1kwh"
+    sql, params = compile_select(
+        table,
+        SUSPICIOUS_COLUMNS,
+        sites=sites,
+        date_debut=date_debut,
+        date_fin=date_fin,
+        available=await get_table_columns_async(table),
+        sort=[("Datetime start", False)],
+    )
+    df = await query_df_async(sql, params)
+
+    if not df.empty and "Datetime start" in df.columns:
+        df["Datetime start"] = pd.to_datetime(df["Datetime start"], errors="coerce")
+
+    charge_ids = to_text(column(df, "ID"))
+    rows = records(
+        {
+            "rank": range(1, len(df) + 1),
+            "id": charge_ids,
+            "url": build_url(charge_ids),
+            "site": na_to_empty(column(df, "Site")),
+            "pdc": to_text(column(df, "PDC")),
+            "mac": na_to_empty(column(df, "MAC Address")),
+            "vehicle": na_to_empty(column(df, "Vehicle")),
+            "start": format_datetime(column(df, "Datetime start", None)),
+            "end": format_datetime(column(df, "Datetime end", None)),
+            "energy": round_number(column(df, "Energy (Kwh)", None), 3),
+            "soc_start": round_number(column(df, "SOC Start", None), 3),
+            "soc_end": round_number(column(df, "SOC End", None), 3),
+        },
+        len(df),
+    )
 
     return templates.TemplateResponse(
         "partials/suspicious.html",
@@ -98,87 +111,55 @@ async def get_multi_attempts(
     date_fin: date = Query(default=None),
 ):
     """Tentatives multiples par heure"""
-    sql = "SELECT * FROM kpi_multi_attempts_hour"
-    df = query_df(sql)
+    table = "kpi_multi_attempts_hour"
+    sql, params = compile_select(
+        table,
+        MULTI_ATTEMPTS_COLUMNS,
+        sites=sites,
+        date_debut=date_debut,
+        date_fin=date_fin,
+        available=await get_table_columns_async(table),
+        sort=[("Date_heure", False), ("Site", False), ("tentatives", True)],
+    )
+    df = await query_df_async(sql, params)
 
     if not df.empty and "Date_heure" in df.columns:
         df["Date_heure"] = pd.to_datetime(df["Date_heure"], errors="coerce")
 
-        if date_debut:
-            df = df[df["Date_heure"] >= pd.Timestamp(date_debut)]
-        if date_fin:
-            df = df[df["Date_heure"] < pd.Timestamp(date_fin) + pd.Timedelta(days=1)]
-
-        if sites and "Site" in df.columns:
-            site_list = [s.strip() for s in sites.split(",") if s.strip()]
-            if site_list:
-                df = df[df["Site"].isin(site_list)]
-
-    if not df.empty:
-        sort_cols = []
-        sort_order = []
-        if "Date_heure" in df.columns:
-            sort_cols.append("Date_heure")
-            sort_order.append(True)
-        if "Site" in df.columns:
-            sort_cols.append("Site")
-            sort_order.append(True)
-        if "tentatives" in df.columns:
-            sort_cols.append("tentatives")
-            sort_order.append(False)
-        if sort_cols:
-            df = df.sort_values(sort_cols, ascending=sort_order)
-
     soc_columns = [
         col
         for col in ["SOC start min", "SOC start max", "SOC end min", "SOC end max"]
         if col in df.columns
     ]
 
-    def format_ts(value):
-        if pd.isna(value):
-            return ""
-        try:
-            ts = pd.to_datetime(value, errors="coerce")
-            return ts.strftime("%Y-%m-%d %H:%M") if not pd.isna(ts) else ""
-        except Exception:
-            return str(value)
-
     def parse_ids(value):
         if not isinstance(value, str):
             value = "" if pd.isna(value) else str(value)
         ids = [v.strip() for v in value.split(",") if v.strip()]
         return [{"id": iid, "url": f"{BASE_CHARGE_URL}{iid}"} for iid in ids]
 
-    table_rows = []
-    if not df.empty:
-        for idx, (_, row) in enumerate(df.iterrows(), start=1):
-            date_value = row.get("Date_heure")
-            hour_value = row.get("Heure")
-            if (pd.isna(hour_value) or hour_value == "") and not pd.isna(date_value):
-                ts_hour = pd.to_datetime(date_value, errors="coerce")
-                hour_value = ts_hour.strftime("%Y-%m-%d %H:%M") if not pd.isna(ts_hour) else ""
-
-            tentatives_val = pd.to_numeric(row.get("tentatives", 0), errors="coerce")
-            tentatives = int(tentatives_val) if pd.notna(tentatives_val) else 0
-
-            table_rows.append(
-                {
-                    "rank": idx,
-                    "site": row.get("Site", ""),
-                    "hour": hour_value or "",
-                    "mac": row.get("MAC", ""),
-                    "vehicle": row.get("Vehicle", ""),
-                    "tentatives": tentatives,
-                    "pdc": row.get("PDC(s)", ""),
-                    "first_attempt": format_ts(row.get("1ère tentative")),
-                    "last_attempt": format_ts(row.get("Dernière tentative")),
-                    "ids": parse_ids(row.get("ID(s)")),
-                    "soc_values": {col: row.get(col, "") for col in soc_columns},
-                }
-            )
+    # Heure affichée : colonne Heure, sinon Date_heure formatée
+    hours = na_to_empty(column(df, "Heure"))
+    hours = hours.where(hours != "", format_datetime(column(df, "Date_heure", None)))
 
-    return templates.TemplateResponse(
+    table_rows = records(
+        {
+            "rank": range(1, len(df) + 1),
+            "site": na_to_empty(column(df, "Site")),
+            "hour": hours,
+            "mac": na_to_empty(column(df, "MAC")),
+            "vehicle": na_to_empty(column(df, "Vehicle")),
+            "tentatives": to_int(column(df, "tentatives", 0)),
+            "pdc": na_to_empty(column(df, "PDC(s)")),
+            "first_attempt": format_datetime(column(df, "1ère tentative", None)),
+            "last_attempt": format_datetime(column(df, "Dernière tentative", None)),
+            "ids": [parse_ids(value) for value in column(df, "ID(s)").tolist()],
+            "soc_values": df[soc_columns].to_dict("records") if soc_columns else [{} for _ in range(len(df))],
+        },
+        len(df),
+    )
+
+    return templates.StreamingTemplateResponse(
         "partials/multi_attempts.html",
         {
             "request": request,
@@ -189,6 +170,7 @@ async def get_multi_attempts(
 
 
 @router.get("/kpi/evolution")
+@conditional("kpi_evo")
 async def get_kpi_evolution(
     request: Request,
     sites: str = Query(default=""),
@@ -200,7 +182,7 @@ async def get_kpi_evolution(
     """Évolution mensuelle du taux de réussite global."""
 
     table_name = "kpi_evo"
-    if not table_exists(table_name):
+    if not await table_exists_async(table_name):
         return templates.TemplateResponse(
             "partials/evolution.html",
             {
@@ -210,7 +192,7 @@ async def get_kpi_evolution(
         )
 
     try:
-        df = query_df(f"SELECT * FROM {table_name}")
+        df = await query_df_async(f"SELECT * FROM {table_name}")
     except Exception as exc: 
         return templates.TemplateResponse(
             "partials/evolution.html",
@@ -0,0 +1,67 @@
+"""
+Router du flux en direct des alertes et défauts actifs
+Endpoint: GET /api/live/stream (text/event-stream)
+
+Événements : `snapshot` à la connexion (état courant), puis `alertes` / `defauts` avec les
+lignes apparues (`added`) et disparues (`closed`) et le nouveau total, filtrés par site.
+Un commentaire `: ping` est envoyé sans activité pour garder la connexion ouverte.
+"""
+
+import asyncio
+import json
+
+from fastapi import APIRouter, Query, Request
+from fastapi.responses import StreamingResponse
+
+from live import LIVE_HEARTBEAT_SECONDS, LIVE_POLL_SECONDS, Subscriber, live_hub
+from sql_filters import parse_list
+
+router = APIRouter(tags=["live"])
+
+
+def _event(name: str, data) -> str:
+    return f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _events(request: Request, subscriber: Subscriber):
+    try:
+        # Délai de reconnexion d'EventSource : un intervalle de lecture
+        yield f"retry: {max(LIVE_POLL_SECONDS, 1) * 1000}\n"
+        # Premier abonné après une période sans client : le poller relit les sources
+        await live_hub.wait_ready(LIVE_HEARTBEAT_SECONDS)
+        yield _event("snapshot", live_hub.snapshot(subscriber))
+        while True:
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), LIVE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                yield ": ping\n\n"
+                continue
+            if event is None:
+                # Client décroché par le hub (file pleine) : il se reconnectera
+                break
+            name, data = event
+            yield _event(name, data)
+    finally:
+        live_hub.unsubscribe(subscriber)
+
+
+@router.get("/live/stream")
+async def live_stream(
+    request: Request,
+    sites: str = Query(default="", description="Sites séparés par virgule"),
+):
+    """
+    Flux SSE des deltas d'alertes et de défauts actifs
+    """
+    subscriber = live_hub.subscribe(parse_list(sites))
+    return StreamingResponse(
+        _events(request, subscriber),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            # Pas de mise en tampon par un proxy nginx
+            "X-Accel-Buffering": "no",
+        },
+    )
@@ -1,17 +1,28 @@
 from fastapi import APIRouter, Form, Query, Request
-from fastapi.templating import Jinja2Templates
 from datetime import date
 import pandas as pd
 import numpy as np
+import os
 import re
 
-from db import query_df, table_exists
+from code_index import get_code_index
+from data_version import conditional
+from db import query_df_async, table_exists_async
+from formatting import RowStream, records
+from mac_index import get_mac_index, normalize_mac
+from sql_filters import parse_list
+from templating import TimedTemplates
 
 router = APIRouter(tags=["mac_address"])
-templates = Jinja2Templates(directory="templates")
+templates = TimedTemplates(directory="templates")
 
 BASE_CHARGE_URL = "https://elto.nidec-asi-online.com/Charge/detail?id="
 
+# Au-delà de ce nombre d'ID (puis de valeurs brutes de MAC), la recherche repasse par un parcours de la fenêtre
+MAC_SEARCH_MAX_KEYS = int(os.getenv("MAC_SEARCH_MAX_KEYS", "5000"))
+# Au-delà de ce nombre de sessions, la recherche par codes repasse par le filtre SQL sur les codes
+CODE_SEARCH_MAX_IDS = int(os.getenv("CODE_SEARCH_MAX_IDS", "10000"))
+
 
 def _fmt_mac(mac: str) -> str:
     if pd.isna(mac) or not mac:
@@ -81,6 +92,20 @@ def _build_conditions(
     return " AND ".join(conditions), params
 
 
+def _in_condition(column: str, prefix: str, values: list, params: dict) -> str:
+    placeholders = ",".join(f":{prefix}_{i}" for i in range(len(values)))
+    params.update({f"{prefix}_{i}": v for i, v in enumerate(values)})
+    return f"{column} IN ({placeholders})"
+
+
+def _unindexed_condition(alias: str, last_value, last_id, params: dict) -> str:
+    """Sessions absentes des index : sans `Datetime start`, ou postérieures à leur watermark."""
+    params["wm_value"] = last_value
+    params["wm_id"] = last_id
+    start = f"{alias}.`Datetime start`"
+    return f"({start} IS NULL OR {start} > :wm_value OR ({start} = :wm_value AND {alias}.ID > :wm_id))"
+
+
 @router.get("/mac-address/search")
 async def search_mac(
     request: Request,
@@ -114,6 +139,25 @@ async def search_mac(
         moments=moments,
     )
 
+    # Index MAC : la requête ne lit que les sessions des MAC correspondantes, plus celles que
+    # l'index ne couvre pas encore (un résultat vide de l'index n'est pas une réponse)
+    restricted = False
+    index = get_mac_index()
+    if index is not None and index.last_value is not None:
+        match = index.lookup(mac_norm)
+        unindexed = _unindexed_condition("s", index.last_value, index.last_id, params)
+        if not match.session_ids:
+            restricted = True
+            where_clause += f" AND {unindexed}"
+        elif len(match.session_ids) <= MAC_SEARCH_MAX_KEYS:
+            restricted = True
+            matched = _in_condition("s.ID", "mid", match.session_ids, params)
+            where_clause += f" AND ({matched} OR {unindexed})"
+        elif len(match.raw_macs) <= MAC_SEARCH_MAX_KEYS:
+            restricted = True
+            matched = _in_condition("s.`MAC Address`", "mraw", match.raw_macs, params)
+            where_clause += f" AND ({matched} OR {unindexed})"
+
     sql = f"""
         SELECT
             s.ID,
@@ -133,25 +177,21 @@ async def search_mac(
         WHERE {where_clause}
     """
 
-    df = query_df(sql, params)
+    df = await query_df_async(sql, params)
 
     if df.empty:
         return templates.TemplateResponse(
             "partials/mac_search.html",
             {
                 "request": request,
-                "no_data": True,
+                "no_results" if restricted else "no_data": True,
                 "mac_query": mac_query,
             }
         )
 
-    df["mac_norm"] = (
-        df["mac"].astype(str).str.lower()
-        .str.replace("0x", "", regex=False)
-        .str.replace(r"[^0-9a-f]", "", regex=True)
-    )
-
-    df = df[df["mac_norm"].str.contains(mac_norm, na=False)].copy()
+    # Revérifié aussi sur le résultat restreint : une session a pu changer de MAC depuis l'indexation
+    df["mac_norm"] = normalize_mac(df["mac"])
+    df = df[df["mac_norm"].str.contains(mac_norm, na=False, regex=False)].copy()
 
     if df.empty:
         return templates.TemplateResponse(
@@ -163,15 +203,7 @@ async def search_mac(
             }
         )
 
-    for col in ["Datetime start", "Datetime end"]:
-        if col in df.columns:
-            df[col] = pd.to_datetime(df[col], errors="coerce")
-
-    for col in ["Energy (Kwh)", "SOC Start", "SOC End"]:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors="coerce")
-
-    df["is_ok"] = df["is_ok"].fillna(0).astype(bool)
+    df["is_ok"] = df["is_ok"].fillna(False).astype(bool)
     df["mac_formatted"] = df["mac"].apply(_fmt_mac)
     df["evolution_soc"] = df.apply(
         lambda r: _format_soc_evolution(r.get("SOC Start"), r.get("SOC End")), axis=1
@@ -204,10 +236,11 @@ async def search_mac(
     ]
     display_cols = [c for c in display_cols if c in df.columns]
 
-    ok_rows = df_ok[display_cols].to_dict("records") if not df_ok.empty else []
-    nok_rows = df_nok[display_cols].to_dict("records") if not df_nok.empty else []
+    # Lignes créées au fil du rendu en flux, pas toutes d'avance
+    ok_rows = RowStream(df_ok[display_cols])
+    nok_rows = RowStream(df_nok[display_cols])
 
-    return templates.TemplateResponse(
+    return templates.StreamingTemplateResponse(
         "partials/mac_search.html",
         {
             "request": request,
@@ -223,13 +256,14 @@ async def search_mac(
 
 
 @router.get("/mac-address/top10")
+@conditional("kpi_mac_id")
 async def get_top10_unidentified(
     request: Request,
     sites: str = Query(default=""),
     date_debut: date = Query(default=None),
     date_fin: date = Query(default=None),
 ):
-    if not table_exists("kpi_mac_id"):
+    if not await table_exists_async("kpi_mac_id"):
         return templates.TemplateResponse(
             "partials/mac_top10.html",
             {
@@ -245,7 +279,7 @@ async def get_top10_unidentified(
         LIMIT 10
     """
 
-    df = query_df(sql)
+    df = await query_df_async(sql)
 
     if df.empty:
         return templates.TemplateResponse(
@@ -331,18 +365,35 @@ async def search_by_codes(
     error_scope_clause = where_clause
     error_scope_params = dict(params)
 
-    placeholders = ", ".join([f":code_{i}" for i in range(len(code_list))])
     code_filter = code_type if code_type in {"Erreur_EVI", "Erreur_DownStream"} else "Tous"
 
+    placeholders = ", ".join([f":code_{i}" for i in range(len(code_list))])
     if code_filter == "Erreur_EVI":
         where_clause += f" AND s.`EVI Error Code` IN ({placeholders})"
     elif code_filter == "Erreur_DownStream":
         where_clause += f" AND s.`Downstream Code PC` IN ({placeholders})"
     else:
         where_clause += f" AND (s.`EVI Error Code` IN ({placeholders}) OR s.`Downstream Code PC` IN ({placeholders}))"
-
     params.update({f"code_{i}": c for i, c in enumerate(code_list)})
 
+    # Index des codes : postings -> ID des sessions, compteurs -> dénominateurs. Il ne couvre ni
+    # les sessions sans `Datetime start` ni celles postérieures à son watermark : lues en SQL.
+    index = get_code_index()
+    if index is not None and index.last_value is None:
+        index = None
+    if index is not None:
+        scope = (parse_list(sites), date_debut_val, date_fin_val, parse_list(error_types), parse_list(moments))
+        # Lecture synchrone : postings, compteurs et watermark décrivent le même état de l'index
+        session_ids = index.lookup(code_filter, code_list, *scope)
+        indexed_errors, indexed_vehicle_totals = index.totals(*scope)
+        unindexed = _unindexed_condition("s", index.last_value, index.last_id, params)
+        unindexed_params = dict(error_scope_params, wm_value=params["wm_value"], wm_id=params["wm_id"])
+        if not session_ids:
+            where_clause += f" AND {unindexed}"
+        elif len(session_ids) <= CODE_SEARCH_MAX_IDS:
+            # Lecture par clé primaire ; les codes restent vérifiés (sessions corrigées depuis l'indexation)
+            where_clause += f" AND ({_in_condition('s.ID', 'sid', session_ids, params)} OR {unindexed})"
+
     sql = f"""
         SELECT
             s.ID,
@@ -363,18 +414,37 @@ async def search_by_codes(
         WHERE s.is_ok = 0 AND {where_clause}
     """
 
-    df = query_df(sql, params)
+    df = await query_df_async(sql, params)
 
-    total_error_sql = f"""
-        SELECT COUNT(*) AS total_errors
-        FROM kpi_sessions s
-        WHERE s.is_ok = 0 AND {error_scope_clause}
-    """
+    if index is not None:
+        # Compteurs de l'index complétés par les sessions qu'il ne couvre pas
+        unindexed_sql = f"""
+            SELECT s.Vehicle, COUNT(*) AS total_charges, SUM(s.is_ok = 0) AS total_errors
+            FROM kpi_sessions s
+            WHERE {error_scope_clause} AND {unindexed}
+            GROUP BY s.Vehicle
+        """
+        unindexed_totals = await query_df_async(unindexed_sql, unindexed_params)
+        total_error_count = indexed_errors + int(
+            pd.to_numeric(unindexed_totals["total_errors"], errors="coerce").fillna(0).sum()
+        )
+        indexed_vehicle_totals = (
+            pd.concat([indexed_vehicle_totals, unindexed_totals[["Vehicle", "total_charges"]]], ignore_index=True)
+            .groupby("Vehicle", sort=False)["total_charges"]
+            .sum()
+            .reset_index()
+        )
+    else:
+        total_error_sql = f"""
+            SELECT COUNT(*) AS total_errors
+            FROM kpi_sessions s
+            WHERE s.is_ok = 0 AND {error_scope_clause}
+        """
 
-    total_errors_df = query_df(total_error_sql, error_scope_params)
-    total_error_count = (
-        int(total_errors_df["total_errors"].iloc[0]) if not total_errors_df.empty else 0
-    )
+        total_errors_df = await query_df_async(total_error_sql, error_scope_params)
+        total_error_count = (
+            int(total_errors_df["total_errors"].iloc[0]) if not total_errors_df.empty else 0
+        )
 
     if df.empty:
         return templates.TemplateResponse(
@@ -382,8 +452,6 @@ async def search_by_codes(
             {"request": request, "error": "Aucune charge en erreur trouvée"},
         )
 
-    df["Datetime start"] = pd.to_datetime(df["Datetime start"], errors="coerce")
-    df["Datetime end"] = pd.to_datetime(df["Datetime end"], errors="coerce")
     df["MAC Address"] = df["MAC Address"].apply(_fmt_mac)
 
     df["Évolution SOC"] = df.apply(
@@ -396,13 +464,10 @@ async def search_by_codes(
         axis=1,
     )
 
-    if "Energy (Kwh)" in df.columns:
-        df["Energy (Kwh)"] = pd.to_numeric(df["Energy (Kwh)"], errors="coerce")
-
     df = df.sort_values("Datetime start", ascending=False)
 
     occ_site_pdc = (
-        df.groupby(["Site", "PDC"])
+        df.groupby(["Site", "PDC"], observed=True)
         .size()
         .reset_index(name="Occurrences")
         .sort_values("Occurrences", ascending=False)
@@ -414,7 +479,7 @@ async def search_by_codes(
         monthly_df["month"] = monthly_df["Datetime start"].dt.to_period("M").astype(str)
 
         monthly_counts = (
-            monthly_df.groupby(["month", "Site"])
+            monthly_df.groupby(["month", "Site"], observed=True)
             .size()
             .reset_index(name="Occurrences")
             .sort_values(["month", "Site"])
@@ -422,21 +487,17 @@ async def search_by_codes(
 
         if not monthly_counts.empty:
             max_occ = monthly_counts["Occurrences"].max()
-
-            for month, group in monthly_counts.groupby("month"):
-                monthly_hist.append(
-                    {
-                        "month": month,
-                        "sites": [
-                            {
-                                "Site": row["Site"],
-                                "Occurrences": int(row["Occurrences"]),
-                                "occ_pct": (row["Occurrences"] / max_occ * 100) if max_occ else 0,
-                            }
-                            for _, row in group.iterrows()
-                        ],
-                    }
-                )
+            site_rows = records(
+                {
+                    "Site": monthly_counts["Site"],
+                    "Occurrences": monthly_counts["Occurrences"].astype(int),
+                    "occ_pct": monthly_counts["Occurrences"] / max_occ * 100 if max_occ else 0,
+                },
+                len(monthly_counts),
+            )
+            positions = monthly_counts.reset_index(drop=True).groupby("month", observed=True).indices
+            for month, rows in positions.items():
+                monthly_hist.append({"month": month, "sites": [site_rows[i] for i in rows]})
 
     vehicle_counts = None
     if "Vehicle" in df.columns:
@@ -452,31 +513,34 @@ async def search_by_codes(
 
         if not vehicle_df.empty:
             vehicle_counts = (
-                vehicle_df.groupby("Vehicle")
+                vehicle_df.groupby("Vehicle", observed=True)
                 .size()
                 .reset_index(name="Occurrences")
             )
 
     occ_vehicle = []
     if vehicle_counts is not None and not vehicle_counts.empty:
-        total_where, total_params = _build_conditions(
-            sites,
-            date_debut_val,
-            date_fin_val,
-            "cs",
-            error_types=error_types,
-            moments=moments,
-        )
-        total_sql = f"""
-            SELECT
-                cs.Vehicle,
-                COUNT(*) AS total_charges
-            FROM kpi_sessions cs
-            WHERE {total_where}
-            GROUP BY cs.Vehicle
-        """
+        if index is not None:
+            vehicle_totals = indexed_vehicle_totals
+        else:
+            total_where, total_params = _build_conditions(
+                sites,
+                date_debut_val,
+                date_fin_val,
+                "cs",
+                error_types=error_types,
+                moments=moments,
+            )
+            total_sql = f"""
+                SELECT
+                    cs.Vehicle,
+                    COUNT(*) AS total_charges
+                FROM kpi_sessions cs
+                WHERE {total_where}
+                GROUP BY cs.Vehicle
+            """
 
-        vehicle_totals = query_df(total_sql, total_params)
+            vehicle_totals = await query_df_async(total_sql, total_params)
 
         if not vehicle_totals.empty:
             vehicle_totals["Vehicle"] = vehicle_totals["Vehicle"].astype(str).str.strip()
@@ -508,22 +572,22 @@ async def search_by_codes(
     site_options = sorted(df["Site"].dropna().unique().tolist())
 
     daily_counts = (
-        df.groupby(["Site", "month", "day", "PDC"])
+        df.groupby(["Site", "month", "day", "PDC"], observed=True)
         .size()
         .reset_index(name="Occurrences")
     )
 
     hourly_counts = (
-        df.groupby(["Site", "day", "hour", "PDC"])
+        df.groupby(["Site", "day", "hour", "PDC"], observed=True)
         .size()
         .reset_index(name="Occurrences")
     )
 
-    charges_rows = df.to_dict("records")
+    charges_rows = RowStream(df)
 
     error_share_pct = round(len(df) / total_error_count * 100, 1) if total_error_count else 0
 
-    return templates.TemplateResponse(
+    return templates.StreamingTemplateResponse(
         "partials/code_results.html",
         {
             "request": request,
@@ -3,16 +3,27 @@ Router pour l'onglet Vue d'ensemble (tab0_overview)
 Endpoint: GET /api/tab/overview
 """
 
+import asyncio
+import functools
+import os
+import re
+
 from fastapi import APIRouter, Request, Query
-from fastapi.templating import Jinja2Templates
 from datetime import date, datetime
 import pandas as pd
 import numpy as np
 
-from db import query_df
+from compute import run_in_thread
+from db import get_table_columns_async, query_df_async
+from formatting import format_datetime, records, to_int
+from metrics import record_section_failure
+from rollups import load_session_counts
+from sql_filters import compile_conditions, compile_count, compile_select
+from singleflight import coalesce
+from templating import TimedTemplates
 
 router = APIRouter(tags=["overview"])
-templates = Jinja2Templates(directory="templates")
+templates = TimedTemplates(directory="templates")
 
 
 def get_status(value: int, thresholds: tuple = (0, 5)) -> str:
@@ -25,174 +36,182 @@ def get_status(value: int, thresholds: tuple = (0, 5)) -> str:
     return "success"
 
 
-@router.get("/tab/overview")
-async def get_overview(
-    request: Request,
-    sites: str = Query(default=""),
-    date_debut: date = Query(default=None),
-    date_fin: date = Query(default=None),
-    pdc_only: bool = Query(default=False),
-    error_types: str = Query(default=""),
-    moments: str = Query(default=""),
-):
-    """
-    Retourne le fragment HTML complet de l'onglet Vue d'ensemble
-    """
-    site_list = [s.strip() for s in sites.split(",") if s.strip()] if sites else []
-    error_type_list = [e.strip() for e in error_types.split(",") if e.strip()] if error_types else []
-    moment_list = [m.strip() for m in moments.split(",") if m.strip()] if moments else []
-    
-    # ============================================================
-    # 1. DÉFAUTS ACTIFS
-    # ============================================================
-    sql_defauts = """
-        SELECT site, date_debut, defaut, eqp
-        FROM kpi_defauts_log
-        WHERE date_fin IS NULL
-        ORDER BY date_debut DESC
-    """
-    df_defauts = query_df(sql_defauts)
-    
+# Premier motif reconnu dans `eqp` (insensible à la casse), sinon « Autres »
+EQUIP_PATTERNS = [
+    ("PDC1", re.compile(r"PDC1", re.IGNORECASE)),
+    ("PDC2", re.compile(r"PDC2", re.IGNORECASE)),
+    ("PDC3", re.compile(r"PDC3", re.IGNORECASE)),
+    ("PDC4", re.compile(r"PDC4", re.IGNORECASE)),
+    ("PDC5", re.compile(r"PDC5", re.IGNORECASE)),
+    ("PDC6", re.compile(r"PDC6", re.IGNORECASE)),
+    ("Variateur HC1", re.compile(r"Variateur.*HC1|HC1.*Variateur", re.IGNORECASE)),
+    ("Variateur HC2", re.compile(r"Variateur.*HC2|HC2.*Variateur", re.IGNORECASE)),
+    ("Variateur HB1", re.compile(r"Variateur.*HB1|HB1.*Variateur", re.IGNORECASE)),
+    ("Variateur HB2", re.compile(r"Variateur.*HB2|HB2.*Variateur", re.IGNORECASE)),
+]
+EQUIP_OTHER = "Autres"
+EQUIP_ORDER = [label for label, _ in EQUIP_PATTERNS] + [EQUIP_OTHER]
+
+
+@functools.lru_cache(maxsize=4096)
+def _equipment_label(eqp) -> str:
+    if isinstance(eqp, str):
+        for label, pattern in EQUIP_PATTERNS:
+            if pattern.search(eqp):
+                return label
+    return EQUIP_OTHER
+
+
+def _equipment_labels(eqp: pd.Series) -> pd.Categorical:
+    """Libellé d'équipement de chaque ligne ; les motifs ne sont évalués qu'une fois par valeur distincte."""
+    codes, uniques = pd.factorize(eqp.astype(object))
+    labels = np.array([_equipment_label(value) for value in uniques] + [EQUIP_OTHER], dtype=object)
+    return pd.Categorical(labels[codes], categories=EQUIP_ORDER, ordered=True)  # code -1 (NULL) -> « Autres »
+
+
+def _group_defauts_par_site(df_defauts: pd.DataFrame) -> dict:
+    """Regroupe les défauts actifs par site puis par équipement (exécuté dans le pool de processus)."""
+    depuis_jours = to_int(df_defauts["depuis_jours"])
+    defects = records(
+        {
+            "defaut": df_defauts["defaut"],
+            "eqp": df_defauts["eqp"],
+            # Clé des lignes du flux en direct (site, date_debut, defaut, eqp)
+            "date_debut": format_datetime(df_defauts["date_debut"]),
+            "depuis_jours": depuis_jours,
+            "card_class": np.where(depuis_jours > 7, "critical", "warning"),
+        },
+        len(df_defauts),
+    )
+
+    # Un seul groupby (site, équipement) : sites triés, équipements dans l'ordre des motifs,
+    # lignes dans leur ordre d'origine au sein de chaque groupe
+    positions = pd.Series(np.arange(len(df_defauts)), index=df_defauts.index)
+    groups = positions.groupby(
+        [df_defauts["site"], _equipment_labels(df_defauts["eqp"])], observed=True, sort=True
+    )
+
+    defauts_par_site = {}
+    for (site_name, label), group in groups:
+        site_data = defauts_par_site.setdefault(
+            site_name, {"name": site_name, "count": 0, "equipements": []}
+        )
+        site_data["count"] += len(group)
+        site_data["equipements"].append({"label": label, "defects": [defects[i] for i in group]})
+
+    return defauts_par_site
+
+
+OVERVIEW_SECTION_TIMEOUT = float(os.getenv("OVERVIEW_SECTION_TIMEOUT", "8"))
+
+# Contexte affiché pour une section en échec ou hors délai (carte « indisponible »)
+SECTION_PLACEHOLDERS = {
+    "defauts": {
+        "nb_defauts": 0,
+        "nb_sites_defauts": 0,
+        "defauts_status": "unavailable",
+        "sites_recent": [],
+        "defauts_par_site": {},
+    },
+    "suspicious": {"nb_suspicious": 0, "suspicious_status": "unavailable"},
+    "multi": {"nb_multi": 0, "multi_status": "unavailable"},
+    "alertes": {"nb_alertes": 0, "alertes_status": "unavailable", "top_sites_alertes": []},
+    "sessions": {"top_sites_reussite": [], "top_sites_echecs": []},
+}
+
+
+async def _section_defauts(sites: str, pdc_only: bool) -> dict:
+    defauts_extra = ["date_fin IS NULL"]
+    defauts_params: dict[str, str] = {}
+    # Filtre PDC uniquement
+    if pdc_only:
+        defauts_extra.append("UPPER(eqp) LIKE :eqp_pdc")
+        defauts_params["eqp_pdc"] = "%PDC%"
+
+    sql_defauts, params = compile_select(
+        "kpi_defauts_log",
+        ["site", "date_debut", "defaut", "eqp"],
+        sites=sites,
+        extra=defauts_extra,
+        order_by="date_debut DESC",
+    )
+    df_defauts = await query_df_async(sql_defauts, {**params, **defauts_params})
+
     if not df_defauts.empty:
         df_defauts["date_debut"] = pd.to_datetime(df_defauts["date_debut"], errors="coerce")
-        
-        # Filtre sites
-        if site_list:
-            df_defauts = df_defauts[df_defauts["site"].isin(site_list)]
-        
-        # Filtre PDC uniquement
-        if pdc_only:
-            df_defauts = df_defauts[df_defauts["eqp"].str.contains("PDC", case=False, na=False)]
-    
+
     nb_defauts = len(df_defauts)
     nb_sites_defauts = df_defauts["site"].nunique() if not df_defauts.empty else 0
-    defauts_status = get_status(nb_defauts, (0, 5))
-    
+
     # Calcul durée et sites récents
     defauts_par_site = {}
     sites_recent = []
-    
+
     if not df_defauts.empty:
         now = pd.Timestamp.now()
         df_defauts["depuis_jours"] = (now - df_defauts["date_debut"]).dt.days
         df_defauts["is_recent"] = (now - df_defauts["date_debut"]) < pd.Timedelta(days=1)
-        
+
         # Sites à surveiller (défauts < 24h)
         sites_recent = df_defauts[df_defauts["is_recent"]]["site"].unique().tolist()
-        
+
         # Grouper par site avec patterns équipement
-        equip_patterns = [
-            ("PDC1", r"PDC1"),
-            ("PDC2", r"PDC2"),
-            ("PDC3", r"PDC3"),
-            ("PDC4", r"PDC4"),
-            ("PDC5", r"PDC5"),
-            ("PDC6", r"PDC6"),
-            ("Variateur HC1", r"Variateur.*HC1|HC1.*Variateur"),
-            ("Variateur HC2", r"Variateur.*HC2|HC2.*Variateur"),
-            ("Variateur HB1", r"Variateur.*HB1|HB1.*Variateur"),
-            ("Variateur HB2", r"Variateur.*HB2|HB2.*Variateur"),
-            ("Autres", None),  
-        ]
-        
-        for site_name, df_site in df_defauts.groupby("site"):
-            site_data = {"name": site_name, "count": len(df_site), "equipements": []}
-            handled_indices = set()
-            
-            for label, pattern in equip_patterns:
-                if pattern:
-                    mask = df_site["eqp"].str.contains(pattern, case=False, na=False, regex=True)
-                    df_eqp = df_site[mask & ~df_site.index.isin(handled_indices)]
-                else:
-                    df_eqp = df_site[~df_site.index.isin(handled_indices)]
-                
-                if df_eqp.empty:
-                    continue
-                
-                handled_indices.update(df_eqp.index.tolist())
-                
-                defects = []
-                for _, row in df_eqp.iterrows():
-                    defects.append({
-                        "defaut": row["defaut"],
-                        "eqp": row["eqp"],
-                        "depuis_jours": int(row["depuis_jours"]),
-                        "card_class": "critical" if row["depuis_jours"] > 7 else "warning",
-                    })
-                
-                if defects:
-                    site_data["equipements"].append({
-                        "label": label,
-                        "defects": defects,
-                    })
-            
-            defauts_par_site[site_name] = site_data
-    
-    # ============================================================
-    # 2. TRANSACTIONS SUSPECTES (<1 kWh)
-    # ============================================================
-    sql_suspicious = "SELECT * FROM kpi_suspicious_under_1kwh"
-    df_suspicious = query_df(sql_suspicious)
-    
-    if not df_suspicious.empty and "Datetime start" in df_suspicious.columns:
-        df_suspicious["Datetime start"] = pd.to_datetime(df_suspicious["Datetime start"], errors="coerce")
-        
-        if date_debut:
-            df_suspicious = df_suspicious[df_suspicious["Datetime start"] >= pd.Timestamp(date_debut)]
-        if date_fin:
-            df_suspicious = df_suspicious[df_suspicious["Datetime start"] < pd.Timestamp(date_fin) + pd.Timedelta(days=1)]
-        if site_list and "Site" in df_suspicious.columns:
-            df_suspicious = df_suspicious[df_suspicious["Site"].isin(site_list)]
-    
-    nb_suspicious = len(df_suspicious)
-    suspicious_status = get_status(nb_suspicious, (0, 5))
-    
-    # ============================================================
-    # 3. TENTATIVES MULTIPLES
-    # ============================================================
-    sql_multi = "SELECT * FROM kpi_multi_attempts_hour"
-    df_multi = query_df(sql_multi)
-    
-    if not df_multi.empty and "Date_heure" in df_multi.columns:
-        df_multi["Date_heure"] = pd.to_datetime(df_multi["Date_heure"], errors="coerce")
-        
-        if date_debut:
-            df_multi = df_multi[df_multi["Date_heure"] >= pd.Timestamp(date_debut)]
-        if date_fin:
-            df_multi = df_multi[df_multi["Date_heure"] < pd.Timestamp(date_fin) + pd.Timedelta(days=1)]
-        if site_list and "Site" in df_multi.columns:
-            df_multi = df_multi[df_multi["Site"].isin(site_list)]
-    
-    nb_multi = len(df_multi)
-    multi_status = get_status(nb_multi, (0, 5))
-    
-    # ============================================================
-    # 4. ALERTES ACTIVES
-    # ============================================================
-    sql_alertes = """
-        SELECT Site, PDC, type_erreur, detection, occurrences_12h, moment
+        defauts_par_site = await run_in_thread(_group_defauts_par_site, df_defauts)
+
+    return {
+        "nb_defauts": nb_defauts,
+        "nb_sites_defauts": nb_sites_defauts,
+        "defauts_status": get_status(nb_defauts, (0, 5)),
+        "sites_recent": sites_recent,
+        "defauts_par_site": defauts_par_site,
+    }
+
+
+async def _count_table(table: str, sites: str, date_debut: date | None, date_fin: date | None) -> int:
+    sql, params = compile_count(
+        table,
+        sites=sites,
+        date_debut=date_debut,
+        date_fin=date_fin,
+        available=await get_table_columns_async(table),
+    )
+    df = await query_df_async(sql, params)
+    return int(df["nb"].iloc[0]) if not df.empty else 0
+
+
+async def _section_suspicious(sites: str, date_debut: date | None, date_fin: date | None) -> dict:
+    nb_suspicious = await _count_table("kpi_suspicious_under_1kwh", sites, date_debut, date_fin)
+    return {"nb_suspicious": nb_suspicious, "suspicious_status": get_status(nb_suspicious, (0, 5))}
+
+
+async def _section_multi(sites: str, date_debut: date | None, date_fin: date | None) -> dict:
+    nb_multi = await _count_table("kpi_multi_attempts_hour", sites, date_debut, date_fin)
+    return {"nb_multi": nb_multi, "multi_status": get_status(nb_multi, (0, 5))}
+
+
+async def _section_alertes(sites: str, date_debut: date | None, date_fin: date | None) -> dict:
+    where_alertes, params = compile_conditions(
+        "kpi_alertes", sites=sites, date_debut=date_debut, date_fin=date_fin
+    )
+    sql_alertes = f"""
+        SELECT Site, COUNT(*) AS nb
         FROM kpi_alertes
-        ORDER BY detection DESC
+        WHERE {where_alertes}
+        GROUP BY Site
     """
-    df_alertes = query_df(sql_alertes)
-    
-    if not df_alertes.empty:
-        df_alertes["detection"] = pd.to_datetime(df_alertes["detection"], errors="coerce")
-        
-        if date_debut:
-            df_alertes = df_alertes[df_alertes["detection"] >= pd.Timestamp(date_debut)]
-        if date_fin:
-            df_alertes = df_alertes[df_alertes["detection"] < pd.Timestamp(date_fin) + pd.Timedelta(days=1)]
-        if site_list:
-            df_alertes = df_alertes[df_alertes["Site"].isin(site_list)]
-    
-    nb_alertes = len(df_alertes)
-    alertes_status = get_status(nb_alertes, (0, 10))
-    
+    df_alertes = await query_df_async(sql_alertes, params)
+
+    nb_alertes = int(df_alertes["nb"].sum()) if not df_alertes.empty else 0
+
     # Top 5 sites en alerte (pour le graphique)
     top_sites_alertes = []
     if not df_alertes.empty:
-        top = df_alertes.groupby("Site").size().sort_values(ascending=False).head(5)
+        top = (
+            df_alertes.dropna(subset=["Site"])
+            .set_index("Site")["nb"]
+            .sort_values(ascending=False)
+            .head(5)
+        )
         max_val = top.max() if len(top) > 0 else 1
         for site, count in top.items():
             top_sites_alertes.append({
@@ -201,32 +220,27 @@ async def get_overview(
                 "percent": round(count / max_val * 100, 1),
             })
 
-    conditions = ["1=1"]
-    
-    if date_debut:
-        conditions.append(f"`Datetime start` >= '{date_debut}'")
-    if date_fin:
-        conditions.append(f"`Datetime start` < DATE_ADD('{date_fin}', INTERVAL 1 DAY)")
-    if site_list:
-        sites_str = "','".join(site_list)
-        conditions.append(f"Site IN ('{sites_str}')")
-    
-    where_clause = " AND ".join(conditions)
-    
-    sql_sessions = f"""
-        SELECT 
-            Site,
-            `State of charge(0:good, 1:error)` as state,
-            type_erreur,
-            moment
-        FROM kpi_sessions
-        WHERE {where_clause}
-    """
-    df_sessions = query_df(sql_sessions)
-    
+    return {
+        "nb_alertes": nb_alertes,
+        "alertes_status": get_status(nb_alertes, (0, 10)),
+        "top_sites_alertes": top_sites_alertes,
+    }
+
+
+async def _section_sessions(
+    sites: str,
+    date_debut: date | None,
+    date_fin: date | None,
+    error_type_list: list[str],
+    moment_list: list[str],
+) -> dict:
+    df_sessions = await load_session_counts(
+        ["Site", "state", "type_erreur", "moment"], sites, date_debut, date_fin
+    )
+
     top_sites_reussite = []
     top_sites_echecs = []
-    
+
     if not df_sessions.empty:
         df_sessions["is_ok"] = pd.to_numeric(df_sessions["state"], errors="coerce").fillna(0).astype(int).eq(0)
 
@@ -247,12 +261,13 @@ async def get_overview(
         # is_ok_filt : on garde l'erreur seulement si elle match les filtres
         mask_nok_keep = mask_nok & mask_type & mask_moment
         df_sessions["is_ok_filt"] = np.where(mask_nok_keep, False, True)
+        df_sessions["ok_nb"] = df_sessions["nb"].where(df_sessions["is_ok_filt"], 0)
         
         stats = (
-            df_sessions.groupby("Site")
+            df_sessions.groupby("Site", observed=True)
             .agg(
-                total=("is_ok_filt", "count"),
-                ok=("is_ok_filt", "sum"),
+                total=("nb", "sum"),
+                ok=("ok_nb", "sum"),
             )
             .reset_index()
         )
@@ -267,25 +282,79 @@ async def get_overview(
         top_by_volume = stats.sort_values("total", ascending=False).head(10)
         top_by_success = top_by_volume.sort_values("taux_ok", ascending=False)
         
-        for _, row in top_by_success.iterrows():
-            top_sites_reussite.append({
-                "site": row["Site"],
-                "taux_ok": float(row["taux_ok"]),
-                "total": int(row["total"]),
-            })
+        top_sites_reussite = records(
+            {
+                "site": top_by_success["Site"],
+                "taux_ok": top_by_success["taux_ok"].astype(float),
+                "total": to_int(top_by_success["total"]),
+            },
+            len(top_by_success),
+        )
         
         # Top 10 par échecs
         top_by_fails = stats.sort_values("nok", ascending=False).head(10)
         max_nok = top_by_fails["nok"].max() if len(top_by_fails) > 0 else 1
         
-        for _, row in top_by_fails.iterrows():
-            top_sites_echecs.append({
-                "site": row["Site"],
-                "nok": int(row["nok"]),
-                "total": int(row["total"]),
-                "percent": round(row["nok"] / max_nok * 100, 1) if max_nok > 0 else 0,
-            })
-    
+        top_sites_echecs = records(
+            {
+                "site": top_by_fails["Site"],
+                "nok": to_int(top_by_fails["nok"]),
+                "total": to_int(top_by_fails["total"]),
+                "percent": (top_by_fails["nok"] / max_nok * 100).round(1) if max_nok > 0 else 0,
+            },
+            len(top_by_fails),
+        )
+
+    return {"top_sites_reussite": top_sites_reussite, "top_sites_echecs": top_sites_echecs}
+
+
+async def _run_section(name: str, coro) -> dict:
+    """Exécute une section avec son délai ; en cas d'échec ou de dépassement, retourne son placeholder."""
+    try:
+        return await asyncio.wait_for(coro, OVERVIEW_SECTION_TIMEOUT)
+    except asyncio.TimeoutError:
+        reason = "timeout"
+        print(f"Vue d'ensemble : section {name} hors délai ({OVERVIEW_SECTION_TIMEOUT} s)")
+    except Exception as exc:
+        reason = "error"
+        print(f"Vue d'ensemble : section {name} en échec : {exc}")
+    record_section_failure("overview", name, reason)
+    return {**SECTION_PLACEHOLDERS[name], "unavailable": name}
+
+
+@router.get("/tab/overview")
+@coalesce
+async def get_overview(
+    request: Request,
+    sites: str = Query(default=""),
+    date_debut: date = Query(default=None),
+    date_fin: date = Query(default=None),
+    pdc_only: bool = Query(default=False),
+    error_types: str = Query(default=""),
+    moments: str = Query(default=""),
+):
+    """
+    Retourne le fragment HTML complet de l'onglet Vue d'ensemble
+    Les cinq sections sont indépendantes : exécutées en parallèle, chacune avec son délai.
+    """
+    error_type_list = [e.strip() for e in error_types.split(",") if e.strip()] if error_types else []
+    moment_list = [m.strip() for m in moments.split(",") if m.strip()] if moments else []
+
+    sections = await asyncio.gather(
+        _run_section("defauts", _section_defauts(sites, pdc_only)),
+        _run_section("suspicious", _section_suspicious(sites, date_debut, date_fin)),
+        _run_section("multi", _section_multi(sites, date_debut, date_fin)),
+        _run_section("alertes", _section_alertes(sites, date_debut, date_fin)),
+        _run_section("sessions", _section_sessions(sites, date_debut, date_fin, error_type_list, moment_list)),
+    )
+
+    context = {}
+    unavailable = []
+    for section in sections:
+        if "unavailable" in section:
+            unavailable.append(section.pop("unavailable"))
+        context.update(section)
+
     # ============================================================
     # RENDER
     # ============================================================
@@ -293,24 +362,8 @@ async def get_overview(
         "partials/tab_overview.html",
         {
             "request": request,
-            # Défauts
-            "nb_defauts": nb_defauts,
-            "nb_sites_defauts": nb_sites_defauts,
-            "defauts_status": defauts_status,
-            "sites_recent": sites_recent,
-            "defauts_par_site": defauts_par_site,
             "pdc_only": pdc_only,
-            "nb_suspicious": nb_suspicious,
-            "suspicious_status": suspicious_status,
-            # Multi-attempts
-            "nb_multi": nb_multi,
-            "multi_status": multi_status,
-            # Alertes
-            "nb_alertes": nb_alertes,
-            "alertes_status": alertes_status,
-            "top_sites_alertes": top_sites_alertes,
-            # Sessions stats
-            "top_sites_reussite": top_sites_reussite,
-            "top_sites_echecs": top_sites_echecs,
+            "unavailable": unavailable,
+            **context,
         }
     )
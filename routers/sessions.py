@@ -1,18 +1,36 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
 from fastapi import APIRouter, Request, Query
-from fastapi.templating import Jinja2Templates
 from datetime import date
-from typing import Any
+from typing import Any, Iterable, Iterator, Optional
 from urllib.parse import urlencode
 import pandas as pd
 import numpy as np
 
-from db import query_df
+from aggregators import GroupTotals, RunningStats
+from catalog import get_catalog
+from compute import run_in_thread
+from db import iter_query_chunks, query_df_async
+from formatting import RowStream, build_url, column, format_soc, na_to_empty, records, to_int
+from rollups import load_session_counts
+from snapshots import iter_snapshot_chunks, read_snapshot
 from routers.filters import MOMENT_ORDER
+from singleflight import SingleFlight, coalesce
+from sql_filters import parse_list
+from templating import TimedTemplates
 
+STATE_COL = "State of charge(0:good, 1:error)"
 EVI_MOMENT = "EVI Status during error"
 EVI_CODE = "EVI Error Code"
 DS_PC = "Downstream Code PC"
 
+# Au-delà de cette plage (ou sans borne), /sessions/stats lit les sessions en flux par blocs
+STATS_STREAMING_MIN_DAYS = int(os.getenv("STATS_STREAMING_MIN_DAYS", "31"))
+
 PHASE_MAP = {
     "Avant charge": {"Init", "Lock Connector", "CableCheck"},
     "Charge": {"Charge"},
@@ -34,21 +52,7 @@ SITE_COLOR_PALETTE = [
 ]
 
 router = APIRouter(tags=["sessions"])
-templates = Jinja2Templates(directory="templates")
-
-_vehicle_strategy_cache = None
-
-
-def _get_vehicle_strategy():
-    global _vehicle_strategy_cache
-
-    if _vehicle_strategy_cache is not None:
-        return _vehicle_strategy_cache
-
-    _vehicle_strategy_cache = ("k.Vehicle", "")
-
-    return _vehicle_strategy_cache
-
+templates = TimedTemplates(directory="templates")
 
 def _build_conditions(sites: str, date_debut: date | None, date_fin: date | None, table_alias: str | None = None):
     conditions = ["1=1"]
@@ -74,8 +78,67 @@ def _build_conditions(sites: str, date_debut: date | None, date_fin: date | None
     return " AND ".join(conditions), params
 
 
-def _apply_status_filters(df: pd.DataFrame, error_type_list: list[str], moment_list: list[str]) -> pd.DataFrame:
-    df["is_ok"] = pd.to_numeric(df["state"], errors="coerce").fillna(0).astype(int).eq(0)
+async def _fetch_sessions(
+    columns: list[str], sites: str, date_debut: date | None, date_fin: date | None, use_cache: bool = True
+) -> pd.DataFrame:
+    """
+    Sessions brutes (colonnes `columns`, état renommé en `state`) : snapshot local s'il est
+    disponible, sinon MySQL.
+    """
+    df = await read_snapshot(
+        "kpi_sessions",
+        columns,
+        sites=sites,
+        date_debut=date_debut,
+        date_fin=date_fin,
+        rename={STATE_COL: "state"},
+    )
+    if df is not None:
+        return df
+
+    sql, params = _sessions_sql(columns, sites, date_debut, date_fin)
+    return await query_df_async(sql, params, use_cache=use_cache)
+
+
+def _sessions_sql(
+    columns: list[str], sites: str, date_debut: date | None, date_fin: date | None
+) -> tuple[str, dict]:
+    where_clause, params = _build_conditions(sites, date_debut, date_fin)
+    select = ",\n            ".join(f"`{c}` AS state" if c == STATE_COL else f"`{c}`" for c in columns)
+    sql = f"""
+        SELECT
+            {select}
+        FROM kpi_sessions
+        WHERE {where_clause}
+    """
+    return sql, params
+
+
+def _stream_sessions(
+    columns: list[str], sites: str, date_debut: date | None, date_fin: date | None
+) -> Optional[Iterator[pd.DataFrame]]:
+    """
+    Sessions par blocs : snapshot local s'il existe, sinon curseur serveur MySQL pour les
+    plages larges. None pour une plage courte (lecture en une fois, via le cache de requêtes).
+    """
+    chunks = iter_snapshot_chunks(
+        "kpi_sessions",
+        columns,
+        sites=sites,
+        date_debut=date_debut,
+        date_fin=date_fin,
+        rename={STATE_COL: "state"},
+    )
+    if chunks is not None:
+        return chunks
+    if date_debut and date_fin and (date_fin - date_debut).days < STATS_STREAMING_MIN_DAYS:
+        return None
+    sql, params = _sessions_sql(columns, sites, date_debut, date_fin)
+    return iter_query_chunks(sql, params)
+
+
+def _status_mask(df: pd.DataFrame, error_type_list: list[str], moment_list: list[str]) -> np.ndarray:
+    """True pour les sessions comptées OK une fois appliqués les filtres type d'erreur / moment."""
     mask_nok = ~df["is_ok"]
     mask_type = (
         df["type_erreur"].isin(error_type_list)
@@ -87,49 +150,189 @@ def _apply_status_filters(df: pd.DataFrame, error_type_list: list[str], moment_l
         if moment_list and "moment" in df.columns
         else pd.Series(True, index=df.index)
     )
-    df["is_ok_filt"] = np.where(mask_nok & mask_type & mask_moment, False, True)
+    return np.where(mask_nok & mask_type & mask_moment, False, True)
+
+
+def _apply_status_filters(df: pd.DataFrame, error_type_list: list[str], moment_list: list[str]) -> pd.DataFrame:
+    df["is_ok"] = pd.to_numeric(df["state"], errors="coerce").fillna(0).astype(int).eq(0)
+    df["is_ok_filt"] = _status_mask(df, error_type_list, moment_list)
     return df
 
 
-def _map_moment_label(val: int) -> str:
-    try:
-        v = int(val)
-    except Exception:
-        return "Unknown"
+def _apply_weighted_status_filters(
+    df: pd.DataFrame, error_type_list: list[str], moment_list: list[str]
+) -> pd.DataFrame:
+    """Variante de _apply_status_filters pour les comptes agrégés (colonne `nb`)."""
+    df = _apply_status_filters(df, error_type_list, moment_list)
+    df["ok_nb"] = df["nb"].where(df["is_ok_filt"], 0)
+    return df
 
-    if v == 0:
-        return "Fin de charge"
-    if 1 <= v <= 2:
-        return "Init"
-    if 4 <= v <= 6:
-        return "Lock Connector"
-    if v == 7:
-        return "CableCheck"
-    if v == 8:
-        return "Charge"
-    if v > 8:
-        return "Fin de charge"
-    return "Unknown"
 
+# ============================================================
+# Frames de sessions partagées entre les sous-onglets
+# ============================================================
+SESSION_FRAME_TTL = float(os.getenv("SESSION_FRAME_TTL", "300"))
+SESSION_FRAME_MAX_BYTES = int(os.getenv("SESSION_FRAME_MAX_MB", "512")) * 1024 * 1024
+_SESSION_FRAME_MAX_VARIANTS = 16
+
+# Union des colonnes lues par stats, projection, analyse d'erreurs et détails par site
+SESSION_FRAME_COLUMNS = [
+    "ID",
+    "Site",
+    "PDC",
+    "Datetime start",
+    "Datetime end",
+    "Energy (Kwh)",
+    "Mean Power (Kw)",
+    "Max Power (Kw)",
+    "SOC Start",
+    "SOC End",
+    "MAC Address",
+    "Vehicle",
+    "type_erreur",
+    "moment",
+    "moment_avancee",
+    EVI_MOMENT,
+    EVI_CODE,
+    DS_PC,
+    STATE_COL,
+]
+
+
+@dataclass
+class _SessionFrame:
+    df: pd.DataFrame
+    nbytes: int
+    expires_at: float
+    # Masque is_ok_filt par combinaison (types d'erreur, moments)
+    status: dict[tuple, np.ndarray] = field(default_factory=dict)
+
+    def status_mask(self, error_type_list: list[str], moment_list: list[str]) -> np.ndarray:
+        key = (frozenset(error_type_list), frozenset(moment_list))
+        mask = self.status.get(key)
+        if mask is None:
+            if len(self.status) >= _SESSION_FRAME_MAX_VARIANTS:
+                self.status.clear()
+            mask = self.status[key] = _status_mask(self.df, error_type_list, moment_list)
+        return mask
+
+
+class SessionFrameStore:
+    """
+    Sessions d'un filtre (sites, dates) lues une seule fois avec toutes les colonnes des
+    sous-onglets ; chaque endpoint en reçoit une vue (copie de ses seules colonnes).
+    LRU borné en mémoire, même TTL que kpi_sessions dans le cache de requêtes.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._frames: OrderedDict[tuple, _SessionFrame] = OrderedDict()
+        self._bytes = 0
+        self._flight = SingleFlight("session_frames")
+
+    async def get(self, sites: str, date_debut: date | None, date_fin: date | None) -> _SessionFrame:
+        sites = ",".join(sorted(parse_list(sites)))
+        key = (sites, date_debut, date_fin)
+        frame = self._frames.get(key)
+        if frame is not None and frame.expires_at > time.monotonic():
+            self._frames.move_to_end(key)
+            return frame
+        frame, _ = await self._flight.do(key, lambda: self._load(key))
+        return frame
+
+    async def _load(self, key: tuple) -> _SessionFrame:
+        sites, date_debut, date_fin = key
+        # Pas de cache de requêtes : la frame est conservée ici
+        df = await _fetch_sessions(SESSION_FRAME_COLUMNS, sites, date_debut, date_fin, use_cache=False)
+        df["is_ok"] = pd.to_numeric(df["state"], errors="coerce").fillna(0).astype(int).eq(0)
+        nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        frame = _SessionFrame(df, nbytes, time.monotonic() + self.ttl)
+        self._put(key, frame)
+        return frame
+
+    def _put(self, key: tuple, frame: _SessionFrame) -> None:
+        if frame.nbytes > self.max_bytes:
+            return
+        if key in self._frames:
+            self._bytes -= self._frames.pop(key).nbytes
+        self._frames[key] = frame
+        self._bytes += frame.nbytes
+        while self._bytes > self.max_bytes and self._frames:
+            _, oldest = self._frames.popitem(last=False)
+            self._bytes -= oldest.nbytes
+
+    def invalidate(self) -> None:
+        self._frames.clear()
+        self._bytes = 0
+
+    async def view(
+        self,
+        columns: list[str],
+        sites: str,
+        date_debut: date | None,
+        date_fin: date | None,
+        error_type_list: list[str],
+        moment_list: list[str],
+    ) -> pd.DataFrame:
+        """Colonnes `columns` (état renommé en `state`) avec is_ok et is_ok_filt déjà calculés."""
+        frame = await self.get(sites, date_debut, date_fin)
+        wanted = ["state" if c == STATE_COL else c for c in columns]
+        wanted = [c for c in dict.fromkeys(wanted) if c in frame.df.columns and c != "is_ok"]
+        view = frame.df[wanted + ["is_ok"]].copy()
+        view["is_ok_filt"] = frame.status_mask(error_type_list, moment_list)
+        return view
+
+
+session_frames = SessionFrameStore(SESSION_FRAME_MAX_BYTES, SESSION_FRAME_TTL)
+
+
+# Moment par valeur entière de « EVI Status during error » (0 à 8) ; au-delà de 8 : fin de charge
+MOMENT_BY_STEP = np.array(
+    [
+        "Fin de charge",
+        "Init",
+        "Init",
+        "Unknown",
+        "Lock Connector",
+        "Lock Connector",
+        "Lock Connector",
+        "CableCheck",
+        "Charge",
+    ],
+    dtype=object,
+)
+
+PHASE_BY_MOMENT = {moment: phase for phase, moments in PHASE_MAP.items() for moment in moments}
+
+
+def _moment_labels(evi_step: pd.Series, moment_raw: pd.Series) -> pd.Series:
+    """
+    Moment de chaque erreur : table MOMENT_BY_STEP sur le step EVI (tronqué à l'entier),
+    sinon colonne `moment` brute (sans espaces), sinon "Unknown".
+    """
+    step = evi_step.to_numpy(dtype=float, na_value=np.nan)
+    finite = np.isfinite(step)
+    truncated = np.trunc(np.where(finite, step, -1.0))
 
-def _map_phase_label(moment: str | int | float | None) -> str:
-    if pd.isna(moment):
-        return "Unknown"
+    labels = np.full(len(step), "Unknown", dtype=object)
+    in_table = finite & (truncated >= 0) & (truncated < len(MOMENT_BY_STEP))
+    labels[in_table] = MOMENT_BY_STEP[truncated[in_table].astype(int)]
+    labels[finite & (truncated >= len(MOMENT_BY_STEP))] = "Fin de charge"
 
-    if isinstance(moment, (list, tuple, set)):
-        for value in moment:
-            mapped = _map_phase_label(value)
-            if mapped != "Unknown":
-                return mapped
-        return "Unknown"
+    # Repli sur le moment brut : quelques valeurs distinctes, nettoyées une seule fois
+    codes, uniques = pd.factorize(moment_raw.astype(object))
+    fallback = np.array(
+        [value.strip() if isinstance(value, str) else "" for value in uniques] + [""], dtype=object
+    )[codes]  # code -1 (NULL) -> dernier élément, ""
+    use_raw = (labels == "Unknown") & (fallback != "")
+    labels[use_raw] = fallback[use_raw]
 
-    moment_str = str(moment)
+    return pd.Series(labels, index=evi_step.index, dtype=object)
 
-    for phase, moments in PHASE_MAP.items():
-        if moment_str in moments:
-            return phase
 
-    return "Unknown"
+def _phase_labels(moment_labels: pd.Series) -> pd.Series:
+    return moment_labels.map(PHASE_BY_MOMENT).fillna("Unknown")
 
 
 def _build_pivot_table(detail_df: pd.DataFrame, by_site: pd.DataFrame) -> dict[str, Any]:
@@ -154,6 +357,7 @@ def _build_pivot_table(detail_df: pd.DataFrame, by_site: pd.DataFrame) -> dict[s
         columns=["_type", "_moment", "_step", "_code"],
         aggfunc="size",
         fill_value=0,
+        observed=True,
     ).sort_index(axis=1)
 
     # Reset index and handle column names properly
@@ -198,11 +402,11 @@ def _build_pivot_table(detail_df: pd.DataFrame, by_site: pd.DataFrame) -> dict[s
     ordered_columns = ["Site", "Total Charges"] + [
         col for col in pivot_table.columns if col not in {"Site", "Total Charges"}
     ]
-    pivot_table = pivot_table[ordered_columns].fillna(0)
+    pivot_table = pivot_table[ordered_columns]
 
     # 6. Convertir les colonnes numériques en int
     numeric_cols = [col for col in pivot_table.columns if col != "Site"]
-    pivot_table[numeric_cols] = pivot_table[numeric_cols].astype(int)
+    pivot_table[numeric_cols] = pivot_table[numeric_cols].fillna(0).astype(int)
 
     return {
         "columns": pivot_table.columns.tolist(),
@@ -238,6 +442,162 @@ def _comparaison_base_context(
     }
 
 
+class _SessionStatsFold:
+    """
+    Statistiques de l'onglet Stats repliées bloc par bloc : compteurs, sommes, min/max et
+    totaux par site/PDC/jour, sans conserver les sessions elles-mêmes.
+    """
+
+    def __init__(self, error_type_list: list[str], moment_list: list[str]):
+        self.error_type_list = error_type_list
+        self.moment_list = moment_list
+        self.total = 0
+        self.total_ok = 0
+        self.energy_all = RunningStats()
+        self.energy_ok = RunningStats()
+        self.pmean_ok = RunningStats()
+        self.pmax_ok = RunningStats()
+        self.soc_start = RunningStats()
+        self.soc_end = RunningStats()
+        self.soc_gain = RunningStats()
+        self.duration_ok = RunningStats()
+        self.charges_by_site_day = GroupTotals(["Site", "day"])
+        self.dur_by_site = GroupTotals(["Site"])
+        self.dur_by_pdc = GroupTotals(["Site", "PDC"])
+
+    def update(self, chunk: pd.DataFrame) -> None:
+        if chunk.empty:
+            return
+        if "is_ok_filt" not in chunk.columns:
+            chunk = _apply_status_filters(chunk, self.error_type_list, self.moment_list)
+        ok = chunk[chunk["is_ok_filt"]]
+        self.total += len(chunk)
+        self.total_ok += len(ok)
+
+        # Énergie totale sur toutes les charges, moyennes et max sur les charges OK
+        self.energy_all.update(chunk["Energy (Kwh)"])
+        self.energy_ok.update(ok["Energy (Kwh)"])
+        self.pmean_ok.update(ok["Mean Power (Kw)"])
+        self.pmax_ok.update(ok["Max Power (Kw)"])
+        self.soc_start.update(ok["SOC Start"])
+        self.soc_end.update(ok["SOC End"])
+        self.soc_gain.update(ok["SOC End"] - ok["SOC Start"])
+
+        durations = (ok["Datetime end"] - ok["Datetime start"]).dt.total_seconds() / 60
+        self.duration_ok.update(durations)
+
+        if ok.empty:
+            return
+        self.charges_by_site_day.add_frame(ok[["Site"]].assign(day=ok["Datetime start"].dt.date))
+
+        # Durées de fonctionnement : le filtre moment s'applique comme côté interface
+        dur_source = ok
+        if self.moment_list:
+            dur_source = dur_source[dur_source["moment"].isin(self.moment_list)]
+        dur_df = dur_source[["Site", "PDC"]].assign(dur_min=durations).dropna(subset=["dur_min"])
+        self.dur_by_site.add_frame(dur_df, "dur_min")
+        self.dur_by_pdc.add_frame(dur_df, "dur_min")
+
+    def consume(self, chunks: Iterable[pd.DataFrame]) -> "_SessionStatsFold":
+        for chunk in chunks:
+            self.update(chunk)
+        return self
+
+    def context(self) -> dict[str, Any]:
+        if self.soc_start.count and self.soc_end.count:
+            soc_gain_mean = self.soc_gain.mean(2)
+        else:
+            soc_gain_mean = 0
+
+        # === CHARGES PAR SITE ===
+        charges_by_site_day = self.charges_by_site_day.to_series("Nb")
+        if not charges_by_site_day.empty:
+            daily_stats = charges_by_site_day.groupby(level="day").sum()
+            nb_days = len(daily_stats)
+            mean_day = round(float(daily_stats.mean()), 2)
+            med_day = round(float(daily_stats.median()), 2)
+            max_day_site, max_day = charges_by_site_day.idxmax()
+            max_day_site = str(max_day_site)
+            max_day_date = str(max_day)
+            max_day_nb = int(charges_by_site_day.max())
+        else:
+            nb_days = 0
+            mean_day = 0
+            med_day = 0
+            max_day_site = "—"
+            max_day_date = "—"
+            max_day_nb = 0
+
+        # === DURÉES DE FONCTIONNEMENT PAR SITE ===
+        by_site_dur = self.dur_by_site.to_series("dur_min").reset_index()
+        if not by_site_dur.empty:
+            by_site_dur = by_site_dur.assign(Heures=lambda d: (d["dur_min"] / 60).round(1)).sort_values(
+                "Heures", ascending=False
+            )
+            durations_by_site = by_site_dur[["Site", "Heures"]].to_dict("records")
+        else:
+            durations_by_site = []
+
+        by_pdc_dur = self.dur_by_pdc.to_series("dur_min").reset_index()
+        durations_by_site_dict: dict[str, list[dict[str, Any]]] = {}
+        if not by_pdc_dur.empty:
+            by_pdc_dur["Heures"] = (by_pdc_dur["dur_min"] / 60).round(1)
+            # Grouper par site pour le sélecteur, PDC triés par durée décroissante
+            for row in by_pdc_dur.sort_values("Heures", ascending=False, kind="stable").to_dict("records"):
+                durations_by_site_dict.setdefault(row["Site"], []).append(
+                    {"PDC": row["PDC"], "Heures": row["Heures"]}
+                )
+
+        # Conserver l'ordre des sites affichés dans le tableau principal
+        site_options_order = [row["Site"] for row in durations_by_site]
+
+        return {
+            "total_charges": self.total,
+            "total_ok": self.total_ok,
+            "total_nok": self.total - self.total_ok,
+            # Énergie
+            "e_total_all": self.energy_all.sum(3),
+            "e_mean": self.energy_ok.mean(3),
+            "e_max": self.energy_ok.max(3),
+            # Puissance moyenne
+            "pm_mean": self.pmean_ok.mean(3),
+            "pm_max": self.pmean_ok.max(3),
+            # Puissance maximale
+            "px_mean": self.pmax_ok.mean(3),
+            "px_max": self.pmax_ok.max(3),
+            # SOC
+            "soc_start_mean": self.soc_start.mean(2),
+            "soc_end_mean": self.soc_end.mean(2),
+            "soc_gain_mean": soc_gain_mean,
+            # Durées
+            "dur_mean": self.duration_ok.mean(1),
+            # Charges par jour
+            "nb_days": nb_days,
+            "mean_day": mean_day,
+            "med_day": med_day,
+            "max_day_site": max_day_site,
+            "max_day_date": max_day_date,
+            "max_day_nb": max_day_nb,
+            # Durées de fonctionnement
+            "durations_by_site": durations_by_site,
+            "durations_by_site_dict": durations_by_site_dict,
+            "site_options_dur": site_options_order if site_options_order else list(durations_by_site_dict.keys()),
+        }
+
+
+async def _fold_sessions_stats(
+    fold: _SessionStatsFold, columns: list[str], sites: str, date_debut: date | None, date_fin: date | None
+) -> _SessionStatsFold:
+    chunks = _stream_sessions(columns, sites, date_debut, date_fin)
+    if chunks is not None:
+        # Lecture et repli dans un thread : le curseur serveur est synchrone
+        return await run_in_thread(fold.consume, chunks)
+    fold.update(
+        await session_frames.view(columns, sites, date_debut, date_fin, fold.error_type_list, fold.moment_list)
+    )
+    return fold
+
+
 @router.get("/sessions/stats")
 async def get_sessions_stats(
     request: Request,
@@ -253,36 +613,29 @@ async def get_sessions_stats(
     error_type_list = [e.strip() for e in error_types.split(",") if e.strip()] if error_types else []
     moment_list = [m.strip() for m in moments.split(",") if m.strip()] if moments else []
 
-    where_clause, params = _build_conditions(sites, date_debut, date_fin, table_alias="k")
-
-    # Récupération complète des données avec toutes les colonnes nécessaires
-    vehicle_select, join_clause = _get_vehicle_strategy()
-
-    sql = f"""
-        SELECT
-            k.ID,
-            k.Site,
-            k.PDC,
-            k.`Datetime start`,
-            k.`Datetime end`,
-            k.`Energy (Kwh)`,
-            k.`Mean Power (Kw)`,
-            k.`Max Power (Kw)`,
-            k.`SOC Start`,
-            k.`SOC End`,
-            k.`MAC Address`,
-            k.`State of charge(0:good, 1:error)` as state,
-            k.type_erreur,
-            k.moment,
-            {vehicle_select}
-        FROM kpi_sessions k
-        {join_clause}
-        WHERE {where_clause}
-    """
+    # Colonnes nécessaires aux statistiques, repliées par blocs sur les plages larges
+    # (les comptes par véhicule sont lus dans les agrégats)
+    columns = [
+        "Site",
+        "PDC",
+        "Datetime start",
+        "Datetime end",
+        "Energy (Kwh)",
+        "Mean Power (Kw)",
+        "Max Power (Kw)",
+        "SOC Start",
+        "SOC End",
+        STATE_COL,
+        "type_erreur",
+        "moment",
+    ]
 
-    df = query_df(sql, params)
+    fold, vehicle_counts = await asyncio.gather(
+        _fold_sessions_stats(_SessionStatsFold(error_type_list, moment_list), columns, sites, date_debut, date_fin),
+        load_session_counts(["Vehicle", "state", "type_erreur", "moment"], sites, date_debut, date_fin),
+    )
 
-    if df.empty:
+    if fold.total == 0:
         return templates.TemplateResponse(
             "partials/sessions_stats.html",
             {
@@ -291,189 +644,41 @@ async def get_sessions_stats(
             }
         )
 
-    # Conversion des types
-    for col in ["Datetime start", "Datetime end"]:
-        if col in df.columns:
-            df[col] = pd.to_datetime(df[col], errors="coerce")
-
-    for col in ["Energy (Kwh)", "Mean Power (Kw)", "Max Power (Kw)", "SOC Start", "SOC End"]:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors="coerce")
-
-    # Déterminer is_ok
-    df["is_ok_raw"] = pd.to_numeric(df["state"], errors="coerce").fillna(0).astype(int).eq(0)
-
-    # Filtrage par type d'erreur et moment
-    df = _apply_status_filters(df, error_type_list, moment_list)
-
-    # Séparer OK et NOK
-    ok_mask = df["is_ok_filt"]
-    nok_mask = ~df["is_ok_filt"]
-
-    ok_df = df[ok_mask].copy()
-    nok_df = df[nok_mask].copy()
-
-    # === STATISTIQUES D'ÉNERGIE ===
-    energy_all = pd.to_numeric(df.get("Energy (Kwh)", pd.Series(dtype=float)), errors="coerce")
-    e_total_all = round(float(energy_all.sum(skipna=True)), 3) if energy_all.notna().any() else 0
-
-    # Pour moyenne et max : utiliser uniquement les charges OK
-    energy_ok = pd.to_numeric(ok_df.get("Energy (Kwh)", pd.Series(dtype=float)), errors="coerce")
-    e_mean = round(float(energy_ok.mean(skipna=True)), 3) if energy_ok.notna().any() else 0
-    e_max = round(float(energy_ok.max(skipna=True)), 3) if energy_ok.notna().any() else 0
-
-    # === STATISTIQUES DE PUISSANCE MOYENNE ===
-    pmean_ok = pd.to_numeric(ok_df.get("Mean Power (Kw)", pd.Series(dtype=float)), errors="coerce")
-    pm_mean = round(float(pmean_ok.mean(skipna=True)), 3) if pmean_ok.notna().any() else 0
-    pm_max = round(float(pmean_ok.max(skipna=True)), 3) if pmean_ok.notna().any() else 0
-
-    # === STATISTIQUES DE PUISSANCE MAXIMALE ===
-    pmax_ok = pd.to_numeric(ok_df.get("Max Power (Kw)", pd.Series(dtype=float)), errors="coerce")
-    px_mean = round(float(pmax_ok.mean(skipna=True)), 3) if pmax_ok.notna().any() else 0
-    px_max = round(float(pmax_ok.max(skipna=True)), 3) if pmax_ok.notna().any() else 0
-
-    # === STATISTIQUES SOC ===
-    soc_start = pd.to_numeric(ok_df.get("SOC Start", pd.Series(dtype=float)), errors="coerce")
-    soc_end = pd.to_numeric(ok_df.get("SOC End", pd.Series(dtype=float)), errors="coerce")
-    soc_start_mean = round(float(soc_start.mean(skipna=True)), 2) if soc_start.notna().any() else 0
-    soc_end_mean = round(float(soc_end.mean(skipna=True)), 2) if soc_end.notna().any() else 0
-
-    if soc_start.notna().any() and soc_end.notna().any():
-        soc_gain_mean = round(float((soc_end - soc_start).mean(skipna=True)), 2)
-    else:
-        soc_gain_mean = 0
-
-    # === DURÉES DE CHARGE ===
-    dt_start = pd.to_datetime(ok_df.get("Datetime start"), errors="coerce")
-    dt_end = pd.to_datetime(ok_df.get("Datetime end"), errors="coerce")
-    durations = (dt_end - dt_start).dt.total_seconds() / 60  # minutes
-    dur_mean = round(float(durations.mean(skipna=True)), 1) if durations.notna().any() else 0
-
-    # === CHARGES PAR SITE ===
-    if not ok_df.empty:
-        ok_df["day"] = pd.to_datetime(ok_df["Datetime start"]).dt.date
-        charges_by_site_day = (
-            ok_df.groupby(["Site", "day"])
-            .size()
-            .reset_index(name="Nb")
-        )
-
-        # Statistiques par jour
-        daily_stats = charges_by_site_day.groupby("day")["Nb"].sum().reset_index()
-        nb_days = len(daily_stats)
-        mean_day = round(float(daily_stats["Nb"].mean()), 2) if nb_days else 0
-        med_day = round(float(daily_stats["Nb"].median()), 2) if nb_days else 0
-
-        # Max par jour
-        if not charges_by_site_day.empty:
-            max_row = charges_by_site_day.loc[charges_by_site_day["Nb"].idxmax()]
-            max_day_site = str(max_row["Site"])
-            max_day_date = str(max_row["day"])
-            max_day_nb = int(max_row["Nb"])
-        else:
-            max_day_site = "—"
-            max_day_date = "—"
-            max_day_nb = 0
-    else:
-        nb_days = 0
-        mean_day = 0
-        med_day = 0
-        max_day_site = "—"
-        max_day_date = "—"
-        max_day_nb = 0
-
-    # === DURÉES DE FONCTIONNEMENT PAR SITE ===
-    dur_source = ok_df.copy()
-
-    # Appliquer le filtre moment pour les durées afin de respecter le filtrage côté interface
-    if moment_list and "moment" in dur_source.columns:
-        dur_source = dur_source[dur_source["moment"].isin(moment_list)]
-
-    if not dur_source.empty and "Datetime start" in dur_source.columns and "Datetime end" in dur_source.columns:
-        dur_df = dur_source[["Site", "PDC", "Datetime start", "Datetime end"]].copy()
-        dur_df = dur_df.dropna(subset=["Datetime start", "Datetime end"])
-        dur_df["dur_min"] = (
-            pd.to_datetime(dur_df["Datetime end"]) - pd.to_datetime(dur_df["Datetime start"])
-        ).dt.total_seconds() / 60
-
-        by_site_dur = (
-            dur_df.groupby("Site")["dur_min"]
-            .sum()
-            .reset_index()
-            .assign(Heures=lambda d: (d["dur_min"] / 60).round(1))
-            .sort_values("Heures", ascending=False)
-        )
-        durations_by_site = by_site_dur[["Site", "Heures"]].to_dict("records")
-
-        by_pdc_dur = (
-            dur_df.groupby(["Site", "PDC"])["dur_min"]
-            .sum()
-            .reset_index()
-            .assign(Heures=lambda d: (d["dur_min"] / 60).round(1))
-        )
-        durations_by_pdc_raw = by_pdc_dur.to_dict("records")
-    else:
-        durations_by_site = []
-        durations_by_pdc_raw = []
-
-    # Grouper par site pour le sélecteur
-    durations_by_site_dict = {}
-    for row in durations_by_pdc_raw:
-        site = row["Site"]
-        if site not in durations_by_site_dict:
-            durations_by_site_dict[site] = []
-        durations_by_site_dict[site].append({
-            "PDC": row["PDC"],
-            "Heures": row["Heures"]
-        })
-
-    # Trier les PDC par durée décroissante dans chaque site
-    for site in durations_by_site_dict:
-        durations_by_site_dict[site] = sorted(
-            durations_by_site_dict[site],
-            key=lambda x: x["Heures"],
-            reverse=True
-        )
-
-    # Conserver l'ordre des sites affichés dans le tableau principal
-    site_options_order = [row["Site"] for row in durations_by_site]
-
     # === STATISTIQUES PAR TYPE DE VÉHICULE ===
     vehicle_stats = []
     vehicle_debug_info = {
-        "has_column": "Vehicle" in df.columns,
-        "total_rows": len(df),
+        "has_column": "Vehicle" in vehicle_counts.columns,
+        "total_rows": fold.total,
         "non_null_count": 0,
         "valid_count": 0,
         "unknown_count": 0,
     }
 
-    if "Vehicle" in df.columns and not df.empty:
+    if "Vehicle" in vehicle_counts.columns and not vehicle_counts.empty:
         # Nettoyer les données Vehicle
-        df_vehicle = df.copy()
-        df_vehicle["Vehicle"] = df_vehicle["Vehicle"].astype(str).str.strip()
+        df_vehicle = _apply_weighted_status_filters(vehicle_counts, error_type_list, moment_list)
 
         # Compter les non-NULL avant nettoyage
-        vehicle_debug_info["non_null_count"] = int(df_vehicle["Vehicle"].notna().sum())
+        vehicle_debug_info["non_null_count"] = int(df_vehicle.loc[df_vehicle["Vehicle"].notna(), "nb"].sum())
 
+        df_vehicle["Vehicle"] = df_vehicle["Vehicle"].astype(str).str.strip()
         df_vehicle["Vehicle"] = df_vehicle["Vehicle"].replace(
             {"": "Unknown", "nan": "Unknown", "none": "Unknown", "NULL": "Unknown", "None": "Unknown"},
             regex=False
         )
-        df_vehicle["Vehicle"] = df_vehicle["Vehicle"].fillna("Unknown")
 
         # Compter les Unknown
-        vehicle_debug_info["unknown_count"] = int((df_vehicle["Vehicle"] == "Unknown").sum())
+        vehicle_debug_info["unknown_count"] = int(df_vehicle.loc[df_vehicle["Vehicle"] == "Unknown", "nb"].sum())
 
         # Exclure les véhicules inconnus
         df_vehicle = df_vehicle[df_vehicle["Vehicle"] != "Unknown"]
-        vehicle_debug_info["valid_count"] = len(df_vehicle)
+        vehicle_debug_info["valid_count"] = int(df_vehicle["nb"].sum())
 
         if not df_vehicle.empty:
             # Grouper par véhicule et calculer les statistiques
             vehicle_grouped = (
-                df_vehicle.groupby("Vehicle", dropna=False)["is_ok_filt"]
-                .agg(total="size", ok="sum")
+                df_vehicle.groupby("Vehicle", dropna=False, observed=True)
+                .agg(total=("nb", "sum"), ok=("ok_nb", "sum"))
                 .reset_index()
             )
             vehicle_grouped["nok"] = vehicle_grouped["total"] - vehicle_grouped["ok"]
@@ -497,36 +702,7 @@ async def get_sessions_stats(
         {
             "request": request,
             "no_data": False,
-            "total_charges": len(df),
-            "total_ok": len(ok_df),
-            "total_nok": len(nok_df),
-            # Énergie
-            "e_total_all": e_total_all,
-            "e_mean": e_mean,
-            "e_max": e_max,
-            # Puissance moyenne
-            "pm_mean": pm_mean,
-            "pm_max": pm_max,
-            # Puissance maximale
-            "px_mean": px_mean,
-            "px_max": px_max,
-            # SOC
-            "soc_start_mean": soc_start_mean,
-            "soc_end_mean": soc_end_mean,
-            "soc_gain_mean": soc_gain_mean,
-            # Durées
-            "dur_mean": dur_mean,
-            # Charges par jour
-            "nb_days": nb_days,
-            "mean_day": mean_day,
-            "med_day": med_day,
-            "max_day_site": max_day_site,
-            "max_day_date": max_day_date,
-            "max_day_nb": max_day_nb,
-            # Durées de fonctionnement
-            "durations_by_site": durations_by_site,
-            "durations_by_site_dict": durations_by_site_dict,
-            "site_options_dur": site_options_order if site_options_order else list(durations_by_site_dict.keys()),
+            **fold.context(),
             # Statistiques par véhicule
             "vehicle_stats": vehicle_stats,
             "vehicle_debug_info": vehicle_debug_info,
@@ -534,88 +710,13 @@ async def get_sessions_stats(
     )
 
 
-@router.get("/sessions/projection")
-async def get_sessions_projection(
-    request: Request,
-    sites: str = Query(default=""),
-    date_debut: date = Query(default=None),
-    date_fin: date = Query(default=None),
-    error_types: str = Query(default=""),
-    moments: str = Query(default=""),
-    hide_empty: bool = Query(default=False),
-):
-    error_type_list = [e.strip() for e in error_types.split(",") if e.strip()] if error_types else []
-    moment_list = [m.strip() for m in moments.split(",") if m.strip()] if moments else []
-
-    site_options_df = query_df(
-        """
-        SELECT DISTINCT Site
-        FROM kpi_sessions
-        WHERE Site IS NOT NULL
-        ORDER BY Site
-        """
-    )
-    site_options = site_options_df["Site"].tolist() if not site_options_df.empty else []
-
-    selected_sites = [s.strip() for s in sites.split(",") if s.strip()] if sites else []
-
-    if not selected_sites:
-        return templates.TemplateResponse(
-            "partials/projection.html",
-            {
-                "request": request,
-                "site_options": site_options,
-                "selected_sites": [],
-                "hide_empty": hide_empty,
-                "show_prompt": True,
-            },
-        )
-
-    where_clause, params = _build_conditions(",".join(selected_sites), date_debut, date_fin, table_alias="k")
-
-    sql = f"""
-        SELECT
-            k.Site,
-            k.PDC,
-            k.`State of charge(0:good, 1:error)` as state,
-            k.type_erreur,
-            k.moment,
-            k.`EVI Error Code`,
-            k.`Downstream Code PC`,
-            k.`EVI Status during error`
-        FROM kpi_sessions k
-        WHERE {where_clause}
-    """
-
-    df = query_df(sql, params)
-
-    if df.empty:
-        return templates.TemplateResponse(
-            "partials/projection.html",
-            {
-                "request": request,
-                "no_data": True,
-                "site_options": site_options,
-                "selected_sites": selected_sites,
-                "hide_empty": hide_empty,
-            },
-        )
-
-    df["is_ok"] = pd.to_numeric(df["state"], errors="coerce").fillna(0).astype(int).eq(0)
-    df = _apply_status_filters(df, error_type_list, moment_list)
-
+def _projection_context(
+    df: pd.DataFrame, error_type_list: list[str], moment_list: list[str], hide_empty: bool
+) -> dict[str, Any]:
+    # is_ok / is_ok_filt déjà posés par session_frames.view
     err = df[~df["is_ok_filt"]].copy()
     if err.empty:
-        return templates.TemplateResponse(
-            "partials/projection.html",
-            {
-                "request": request,
-                "no_errors": True,
-                "site_options": site_options,
-                "selected_sites": selected_sites,
-                "hide_empty": hide_empty,
-            },
-        )
+        return {"no_errors": True}
 
     evi_step = pd.to_numeric(
         err.get("EVI Status during error", pd.Series(np.nan, index=err.index)),
@@ -628,19 +729,7 @@ async def get_sessions_projection(
         err.get("Downstream Code PC", pd.Series(np.nan, index=err.index)), errors="coerce"
     ).fillna(0).astype(int)
     moment_raw = err.get("moment", pd.Series(None, index=err.index))
-
-    def resolve_moment_label(idx: int) -> str:
-        label = None
-        step_val = evi_step.loc[idx] if idx in evi_step.index else np.nan
-        raw_val = moment_raw.loc[idx] if idx in moment_raw.index else None
-
-        if pd.notna(step_val):
-            label = _map_moment_label(step_val)
-        if (not label or label == "Unknown") and isinstance(raw_val, str) and raw_val.strip():
-            label = raw_val.strip()
-        return label or "Unknown"
-
-    err["moment_label"] = [resolve_moment_label(i) for i in err.index]
+    err["moment_label"] = _moment_labels(evi_step, moment_raw)
 
     sub_evi_mask = (ds_pc.eq(8192)) | (ds_pc.eq(0) & evi_code.ne(0))
     sub_ds_mask = ds_pc.ne(0) & ds_pc.ne(8192)
@@ -656,19 +745,10 @@ async def get_sessions_projection(
     evi_long = pd.concat([sub_evi, sub_ds], ignore_index=True)
 
     if evi_long.empty:
-        return templates.TemplateResponse(
-            "partials/projection.html",
-            {
-                "request": request,
-                "no_errors": True,
-                "site_options": site_options,
-                "selected_sites": selected_sites,
-                "hide_empty": hide_empty,
-            },
-        )
+        return {"no_errors": True}
 
-    evi_long["Site"] = evi_long.get("Site", "").fillna("")
-    evi_long["PDC"] = evi_long.get("PDC", "").fillna("").astype(str)
+    evi_long["Site"] = evi_long.get("Site", "").astype(object).fillna("")
+    evi_long["PDC"] = evi_long.get("PDC", "").astype(object).fillna("").astype(str)
     evi_long["moment_label"] = evi_long["moment_label"].fillna("Unknown")
 
     unique_moments = evi_long["moment_label"].dropna().unique().tolist()
@@ -688,16 +768,7 @@ async def get_sessions_projection(
             columns.append((m, int(code)))
 
     if not columns:
-        return templates.TemplateResponse(
-            "partials/projection.html",
-            {
-                "request": request,
-                "no_errors": True,
-                "site_options": site_options,
-                "selected_sites": selected_sites,
-                "hide_empty": hide_empty,
-            },
-        )
+        return {"no_errors": True}
 
     column_template = pd.MultiIndex.from_tuples(columns, names=["moment", "code"])
 
@@ -718,9 +789,9 @@ async def get_sessions_projection(
 
         if has_pdc:
             g_pdc = (
-                site_rows.groupby(["PDC", "moment_label", "code_num"]).size().rename("Nb").reset_index()
+                site_rows.groupby(["PDC", "moment_label", "code_num"], observed=True).size().rename("Nb").reset_index()
             )
-            g_tot = site_rows.groupby(["moment_label", "code_num"]).size().rename("Nb").reset_index()
+            g_tot = site_rows.groupby(["moment_label", "code_num"], observed=True).size().rename("Nb").reset_index()
             g_tot["PDC"] = "__TOTAL__"
             full = pd.concat([g_tot, g_pdc], ignore_index=True)
 
@@ -730,6 +801,7 @@ async def get_sessions_projection(
                 values="Nb",
                 fill_value=0,
                 aggfunc="sum",
+                observed=True,
             )
 
             pv = pv.reindex(columns=column_template, fill_value=0)
@@ -750,13 +822,14 @@ async def get_sessions_projection(
             else:
                 df_disp = df_disp.drop(columns=["PDC"], errors="ignore")
         else:
-            g_site = site_rows.groupby(["moment_label", "code_num"]).size().rename("Nb").reset_index()
+            g_site = site_rows.groupby(["moment_label", "code_num"], observed=True).size().rename("Nb").reset_index()
             pv = g_site.pivot_table(
                 index=pd.Index([site], name="Site"),
                 columns=["moment_label", "code_num"],
                 values="Nb",
                 fill_value=0,
                 aggfunc="sum",
+                observed=True,
             )
             pv = pv.reindex(columns=column_template, fill_value=0)
 
@@ -796,38 +869,26 @@ async def get_sessions_projection(
                 0.0,
             )
 
-        def _clean_label(val: Any) -> str:
-            if isinstance(val, pd.Series):
-                val = val.squeeze()
-            if isinstance(val, (list, np.ndarray)):
-                val = val[0] if len(val) else ""
-            return str(val)
-
-        def _get_scalar(val: Any) -> Any:
-            if isinstance(val, pd.Series):
-                val = val.iloc[0] if not val.empty else 0
-            elif isinstance(val, (list, np.ndarray)):
-                val = val[0] if len(val) else 0
-            return val
-
-        rows = []
-        for _, r in df_disp.iterrows():
-            values = [
-                int(val) if pd.notna(val) else 0
-                for val in (_get_scalar(r[col]) for col in value_cols)
-            ]
+        def _first_column(values: pd.Series | pd.DataFrame) -> pd.Series:
+            """Première colonne quand le libellé est dupliqué (sélection renvoyant un DataFrame)."""
+            return values.iloc[:, 0] if isinstance(values, pd.DataFrame) else values
 
-            total_val = _get_scalar(r["row_total"])
-            percent_val = _get_scalar(r["row_percent"])
+        if value_cols:
+            value_matrix = np.column_stack(
+                [_first_column(numeric_values[col]).to_numpy() for col in value_cols]
+            ).astype(int)
+        else:
+            value_matrix = np.zeros((len(df_disp), 0), dtype=int)
 
-            rows.append(
-                {
-                    "label": _clean_label(r["label"]),
-                    "values": values,
-                    "total": int(total_val) if pd.notna(total_val) else 0,
-                    "percent": float(percent_val) if pd.notna(percent_val) else 0.0,
-                }
-            )
+        rows = records(
+            {
+                "label": _first_column(df_disp["label"]).astype(str),
+                "values": value_matrix.tolist(),
+                "total": to_int(_first_column(df_disp["row_total"])),
+                "percent": pd.to_numeric(_first_column(df_disp["row_percent"]), errors="coerce").fillna(0.0),
+            },
+            len(df_disp),
+        )
 
         column_headers = [
             {"moment": moment, "code": code}
@@ -853,94 +914,91 @@ async def get_sessions_projection(
         )
 
     if not sites_payload:
+        return {"no_errors": True}
+
+    return {"sites": sites_payload}
+
+
+@router.get("/sessions/projection")
+async def get_sessions_projection(
+    request: Request,
+    sites: str = Query(default=""),
+    date_debut: date = Query(default=None),
+    date_fin: date = Query(default=None),
+    error_types: str = Query(default=""),
+    moments: str = Query(default=""),
+    hide_empty: bool = Query(default=False),
+):
+    error_type_list = [e.strip() for e in error_types.split(",") if e.strip()] if error_types else []
+    moment_list = [m.strip() for m in moments.split(",") if m.strip()] if moments else []
+
+    site_options = list((await get_catalog()).sites)
+
+    selected_sites = [s.strip() for s in sites.split(",") if s.strip()] if sites else []
+
+    if not selected_sites:
         return templates.TemplateResponse(
             "partials/projection.html",
             {
                 "request": request,
-                "no_errors": True,
+                "site_options": site_options,
+                "selected_sites": [],
+                "hide_empty": hide_empty,
+                "show_prompt": True,
+            },
+        )
+
+    df = await session_frames.view(
+        ["Site", "PDC", STATE_COL, "type_erreur", "moment", EVI_CODE, DS_PC, EVI_MOMENT],
+        ",".join(selected_sites),
+        date_debut,
+        date_fin,
+        error_type_list,
+        moment_list,
+    )
+
+    if df.empty:
+        return templates.TemplateResponse(
+            "partials/projection.html",
+            {
+                "request": request,
+                "no_data": True,
                 "site_options": site_options,
                 "selected_sites": selected_sites,
                 "hide_empty": hide_empty,
             },
         )
 
+    context = await run_in_thread(_projection_context, df, error_type_list, moment_list, hide_empty)
+
     return templates.TemplateResponse(
         "partials/projection.html",
         {
             "request": request,
-            "sites": sites_payload,
             "site_options": site_options,
             "selected_sites": selected_sites,
             "hide_empty": hide_empty,
+            **context,
         },
     )
 
 
-@router.get("/sessions/error-analysis")
-async def get_error_analysis(
-    request: Request,
-    sites: str = Query(default=""),
-    date_debut: date = Query(default=None),
-    date_fin: date = Query(default=None),
-    error_types: str = Query(default=""),
-    moments: str = Query(default=""),
-):
-    error_type_list = [e.strip() for e in error_types.split(",") if e.strip()] if error_types else []
-    moment_list = [m.strip() for m in moments.split(",") if m.strip()] if moments else []
-
-    where_clause, params = _build_conditions(sites, date_debut, date_fin, table_alias="k")
-
-    sql = f"""
-        SELECT
-            k.Site,
-            k.`State of charge(0:good, 1:error)` as state,
-            k.type_erreur,
-            k.moment,
-            k.moment_avancee,
-            k.`{EVI_MOMENT}`,
-            k.`{EVI_CODE}`,
-            k.`{DS_PC}`
-        FROM kpi_sessions k
-        WHERE {where_clause}
-    """
-
-    df = query_df(sql, params)
-
-    if df.empty:
-        return templates.TemplateResponse(
-            "partials/error_analysis.html",
-            {"request": request, "no_data": True},
-        )
-
-    df["is_ok"] = pd.to_numeric(df["state"], errors="coerce").fillna(0).astype(int).eq(0)
-    df = _apply_status_filters(df, error_type_list, moment_list)
-    df["Site"] = df.get("Site", "").fillna("")
+def _error_analysis_context(
+    df: pd.DataFrame, error_type_list: list[str], moment_list: list[str]
+) -> dict[str, Any]:
+    # is_ok / is_ok_filt déjà posés par session_frames.view
+    df["Site"] = df.get("Site", "").astype(object).fillna("")
 
     err = df[~df["is_ok_filt"]].copy()
 
     if err.empty:
-        return templates.TemplateResponse(
-            "partials/error_analysis.html",
-            {"request": request, "no_errors": True},
-        )
+        return {"no_errors": True}
 
     evi_step = pd.to_numeric(err.get(EVI_MOMENT, pd.Series(np.nan, index=err.index)), errors="coerce")
     evi_code = pd.to_numeric(err.get(EVI_CODE, pd.Series(np.nan, index=err.index)), errors="coerce").fillna(0).astype(int)
     ds_pc = pd.to_numeric(err.get(DS_PC, pd.Series(np.nan, index=err.index)), errors="coerce").fillna(0).astype(int)
     moment_raw = err.get("moment", pd.Series(None, index=err.index))
-
-    def resolve_moment_label(idx: int) -> str:
-        label = None
-        step_val = evi_step.loc[idx] if idx in evi_step.index else np.nan
-        raw_val = moment_raw.loc[idx] if idx in moment_raw.index else None
-
-        if pd.notna(step_val):
-            label = _map_moment_label(step_val)
-        if (not label or label == "Unknown") and isinstance(raw_val, str) and raw_val.strip():
-            label = raw_val.strip()
-        return label or "Unknown"
-
-    err["moment_label"] = [resolve_moment_label(i) for i in err.index]
+    err["moment_label"] = _moment_labels(evi_step, moment_raw)
 
     sub_evi_mask = (ds_pc.eq(8192)) | (ds_pc.eq(0) & evi_code.ne(0))
     sub_ds_mask = ds_pc.ne(0) & ds_pc.ne(8192)
@@ -959,7 +1017,7 @@ async def get_error_analysis(
     evi_moment_code_site: list[dict[str, Any]] = []
     if not sub_evi.empty:
         evi_moment_code_df = (
-            sub_evi.groupby(["moment_label", "step", "code"])
+            sub_evi.groupby(["moment_label", "step", "code"], observed=True)
             .size()
             .reset_index(name="Somme de Charge_NOK")
             .sort_values("Somme de Charge_NOK", ascending=False)
@@ -982,7 +1040,7 @@ async def get_error_analysis(
         evi_moment_code = evi_moment_code_df.to_dict("records")
 
         evi_moment_code_site_df = (
-            sub_evi.groupby(["Site", "moment_label", "step", "code"])
+            sub_evi.groupby(["Site", "moment_label", "step", "code"], observed=True)
             .size()
             .reset_index(name="Somme de Charge_NOK")
             .sort_values(["Site", "Somme de Charge_NOK"], ascending=[True, False])
@@ -996,7 +1054,7 @@ async def get_error_analysis(
     ds_moment_code_site: list[dict[str, Any]] = []
     if not sub_ds.empty:
         ds_moment_code_df = (
-            sub_ds.groupby(["moment_label", "step", "code"])
+            sub_ds.groupby(["moment_label", "step", "code"], observed=True)
             .size()
             .reset_index(name="Somme de Charge_NOK")
             .sort_values("Somme de Charge_NOK", ascending=False)
@@ -1019,7 +1077,7 @@ async def get_error_analysis(
         ds_moment_code = ds_moment_code_df.to_dict("records")
 
         ds_moment_code_site_df = (
-            sub_ds.groupby(["Site", "moment_label", "step", "code"])
+            sub_ds.groupby(["Site", "moment_label", "step", "code"], observed=True)
             .size()
             .reset_index(name="Somme de Charge_NOK")
             .sort_values(["Site", "Somme de Charge_NOK"], ascending=[True, False])
@@ -1030,7 +1088,7 @@ async def get_error_analysis(
         ds_moment_code_site = ds_moment_code_site_df.to_dict("records")
 
     by_site = (
-        df.groupby("Site", as_index=False)
+        df.groupby("Site", as_index=False, observed=True)
         .agg(Total_Charges=("is_ok_filt", "count"), Charges_OK=("is_ok_filt", "sum"))
         .assign(Charges_NOK=lambda d: d["Total_Charges"] - d["Charges_OK"])
     )
@@ -1041,7 +1099,7 @@ async def get_error_analysis(
     detail_all: list[dict[str, Any]] = []
     if not all_err.empty:
         tbl_all = (
-            all_err.groupby(["moment_label", "step", "code", "type"])
+            all_err.groupby(["moment_label", "step", "code", "type"], observed=True)
             .size()
             .reset_index(name="Occurrences")
             .sort_values("Occurrences", ascending=False)
@@ -1058,7 +1116,7 @@ async def get_error_analysis(
             all_err[["moment_label", "step", "code", "type"]].apply(tuple, axis=1).isin(top_keys)
         ]
         detail_all = (
-            detail_all_df.groupby(["moment_label", "step", "code", "type", "Site"])
+            detail_all_df.groupby(["moment_label", "step", "code", "type", "Site"], observed=True)
             .size()
             .reset_index(name="Occurrences")
             .sort_values(
@@ -1073,7 +1131,7 @@ async def get_error_analysis(
     detail_evi: list[dict[str, Any]] = []
     if not sub_evi.empty:
         tbl_evi = (
-            sub_evi.groupby(["moment_label", "step", "code"])
+            sub_evi.groupby(["moment_label", "step", "code"], observed=True)
             .size()
             .reset_index(name="Occurrences")
             .sort_values("Occurrences", ascending=False)
@@ -1087,7 +1145,7 @@ async def get_error_analysis(
             sub_evi[["moment_label", "step", "code"]].apply(tuple, axis=1).isin(top_keys_evi)
         ]
         detail_evi = (
-            detail_evi_df.groupby(["moment_label", "step", "code", "Site"])
+            detail_evi_df.groupby(["moment_label", "step", "code", "Site"], observed=True)
             .size()
             .reset_index(name="Occurrences")
             .sort_values(["moment_label", "step", "code", "Occurrences"], ascending=[True, True, True, False])
@@ -1100,7 +1158,7 @@ async def get_error_analysis(
     detail_ds: list[dict[str, Any]] = []
     if not sub_ds.empty:
         tbl_ds = (
-            sub_ds.groupby(["moment_label", "step", "code"])
+            sub_ds.groupby(["moment_label", "step", "code"], observed=True)
             .size()
             .reset_index(name="Occurrences")
             .sort_values("Occurrences", ascending=False)
@@ -1114,7 +1172,7 @@ async def get_error_analysis(
             sub_ds[["moment_label", "step", "code"]].apply(tuple, axis=1).isin(top_keys_ds)
         ]
         detail_ds = (
-            detail_ds_df.groupby(["moment_label", "step", "code", "Site"])
+            detail_ds_df.groupby(["moment_label", "step", "code", "Site"], observed=True)
             .size()
             .reset_index(name="Occurrences")
             .sort_values(["moment_label", "step", "code", "Occurrences"], ascending=[True, True, True, False])
@@ -1127,10 +1185,10 @@ async def get_error_analysis(
     detail_ds_pivot = locals().get("detail_ds_pivot", {"columns": [], "rows": []})
 
     err_phase = err.copy()
-    err_phase["Phase"] = err_phase["moment_label"].map(_map_phase_label)
+    err_phase["Phase"] = _phase_labels(err_phase["moment_label"])
 
     err_by_phase = (
-        err_phase.groupby(["Site", "Phase"])
+        err_phase.groupby(["Site", "Phase"], observed=True)
         .size()
         .unstack("Phase", fill_value=0)
         .reset_index()
@@ -1181,7 +1239,7 @@ async def get_error_analysis(
     err_nonempty = err.loc[err["type_erreur"].notna() & err["type_erreur"].ne("")].copy()
     if not err_nonempty.empty:
         counts_t = (
-            err_nonempty.groupby("type_erreur")
+            err_nonempty.groupby("type_erreur", observed=True)
             .size()
             .reset_index(name="Nb")
             .sort_values("Nb", ascending=False)
@@ -1195,7 +1253,7 @@ async def get_error_analysis(
     moment_counts: list[dict[str, Any]] = []
     if "moment" in err.columns:
         counts_moment = (
-            err.groupby("moment")
+            err.groupby("moment", observed=True)
             .size()
             .reindex(MOMENT_ORDER, fill_value=0)
             .reset_index(name="Somme de Charge_NOK")
@@ -1221,7 +1279,7 @@ async def get_error_analysis(
     moment_adv_counts: list[dict[str, Any]] = []
     if "moment_avancee" in err.columns:
         counts_av = (
-            err.groupby("moment_avancee")
+            err.groupby("moment_avancee", observed=True)
             .size()
             .reset_index(name="Somme de Charge_NOK")
             .sort_values("Somme de Charge_NOK", ascending=False)
@@ -1248,7 +1306,7 @@ async def get_error_analysis(
     evi_moment_adv_distribution: list[dict[str, Any]] = []
     if not err_evi.empty and "moment" in err_evi.columns:
         counts_moment = (
-            err_evi.groupby("moment")
+            err_evi.groupby("moment", observed=True)
             .size()
             .reindex(MOMENT_ORDER, fill_value=0)
             .reset_index(name="Nb")
@@ -1276,7 +1334,7 @@ async def get_error_analysis(
 
         if "moment_avancee" in err_evi.columns:
             counts_ma = (
-                err_evi.groupby("moment_avancee")
+                err_evi.groupby("moment_avancee", observed=True)
                 .size()
                 .reset_index(name="Nb")
                 .sort_values("Nb", ascending=False)
@@ -1298,7 +1356,7 @@ async def get_error_analysis(
     ds_moment_adv_distribution: list[dict[str, Any]] = []
     if not err_ds.empty and "moment" in err_ds.columns:
         counts_moment_ds = (
-            err_ds.groupby("moment")
+            err_ds.groupby("moment", observed=True)
             .size()
             .reindex(MOMENT_ORDER, fill_value=0)
             .reset_index(name="Nb")
@@ -1326,7 +1384,7 @@ async def get_error_analysis(
 
         if "moment_avancee" in err_ds.columns:
             counts_ma_ds = (
-                err_ds.groupby("moment_avancee")
+                err_ds.groupby("moment_avancee", observed=True)
                 .size()
                 .reset_index(name="Nb")
                 .sort_values("Nb", ascending=False)
@@ -1348,10 +1406,7 @@ async def get_error_analysis(
                 )
                 ds_moment_adv_distribution = counts_ma_ds.to_dict("records")
 
-    return templates.TemplateResponse(
-        "partials/error_analysis.html",
-        {
-            "request": request,
+    return {
         "top_all": top_all,
         "detail_all": detail_all,
         "detail_all_pivot": detail_all_pivot,
@@ -1361,24 +1416,23 @@ async def get_error_analysis(
         "top_ds": top_ds,
         "detail_ds": detail_ds,
         "detail_ds_pivot": detail_ds_pivot,
-            "evi_moment_code": evi_moment_code,
-            "evi_moment_code_site": evi_moment_code_site,
-            "ds_moment_code": ds_moment_code,
-            "ds_moment_code_site": ds_moment_code_site,
-            "site_summary": site_summary,
-            "error_type_counts": error_type_counts,
-            "moment_counts": moment_counts,
-            "moment_adv_counts": moment_adv_counts,
-            "evi_moment_distribution": evi_moment_distribution,
-            "evi_moment_adv_distribution": evi_moment_adv_distribution,
-            "ds_moment_distribution": ds_moment_distribution,
-            "ds_moment_adv_distribution": ds_moment_adv_distribution,
-        },
-    )
+        "evi_moment_code": evi_moment_code,
+        "evi_moment_code_site": evi_moment_code_site,
+        "ds_moment_code": ds_moment_code,
+        "ds_moment_code_site": ds_moment_code_site,
+        "site_summary": site_summary,
+        "error_type_counts": error_type_counts,
+        "moment_counts": moment_counts,
+        "moment_adv_counts": moment_adv_counts,
+        "evi_moment_distribution": evi_moment_distribution,
+        "evi_moment_adv_distribution": evi_moment_adv_distribution,
+        "ds_moment_distribution": ds_moment_distribution,
+        "ds_moment_adv_distribution": ds_moment_adv_distribution,
+    }
 
 
-@router.get("/sessions/general")
-async def get_sessions_general(
+@router.get("/sessions/error-analysis")
+async def get_error_analysis(
     request: Request,
     sites: str = Query(default=""),
     date_debut: date = Query(default=None),
@@ -1389,46 +1443,36 @@ async def get_sessions_general(
     error_type_list = [e.strip() for e in error_types.split(",") if e.strip()] if error_types else []
     moment_list = [m.strip() for m in moments.split(",") if m.strip()] if moments else []
 
-    where_clause, params = _build_conditions(sites, date_debut, date_fin)
-
-    sql = f"""
-        SELECT
-            Site,
-            PDC,
-            `State of charge(0:good, 1:error)` as state,
-            type_erreur,
-            moment
-        FROM kpi_sessions
-        WHERE {where_clause}
-    """
-
-    df = query_df(sql, params)
+    df = await session_frames.view(
+        ["Site", STATE_COL, "type_erreur", "moment", "moment_avancee", EVI_MOMENT, EVI_CODE, DS_PC],
+        sites,
+        date_debut,
+        date_fin,
+        error_type_list,
+        moment_list,
+    )
 
     if df.empty:
         return templates.TemplateResponse(
-            "partials/sessions_general.html",
-            {
-                "request": request,
-                "total": 0,
-                "ok": 0,
-                "nok": 0,
-                "taux_reussite": 0,
-                "taux_echec": 0,
-                "recap_columns": [],
-                "recap_rows": [],
-                "moment_distribution": [],
-                "moment_total_errors": 0,
-                "error_type_distribution": [],
-                "error_type_total": 0,
-                "site_success_cards": [],
-                "site_success_bars": [],
-            },
+            "partials/error_analysis.html",
+            {"request": request, "no_data": True},
         )
 
-    df = _apply_status_filters(df, error_type_list, moment_list)
+    context = await run_in_thread(_error_analysis_context, df, error_type_list, moment_list)
 
-    total = len(df)
-    ok = int(df["is_ok_filt"].sum())
+    return templates.TemplateResponse(
+        "partials/error_analysis.html",
+        {"request": request, **context},
+    )
+
+
+def _sessions_general_context(
+    df: pd.DataFrame, error_type_list: list[str], moment_list: list[str]
+) -> dict[str, Any]:
+    df = _apply_weighted_status_filters(df, error_type_list, moment_list)
+
+    total = int(df["nb"].sum())
+    ok = int(df["ok_nb"].sum())
     nok = total - ok
     taux_reussite = round(ok / total * 100, 1) if total else 0
     taux_echec = round(nok / total * 100, 1) if total else 0
@@ -1436,10 +1480,10 @@ async def get_sessions_general(
     df["PDC"] = df.get("PDC", "").astype(str)
 
     stats_site = (
-        df.groupby("Site")
+        df.groupby("Site", observed=True)
         .agg(
-            total=("is_ok_filt", "count"),
-            ok=("is_ok_filt", "sum"),
+            total=("nb", "sum"),
+            ok=("ok_nb", "sum"),
         )
         .reset_index()
     )
@@ -1450,30 +1494,35 @@ async def get_sessions_general(
         0,
     )
 
-    site_success_cards = [
+    # La couleur suit la position du site dans stats_site, quel que soit l'ordre d'affichage
+    site_colors = np.array(SITE_COLOR_PALETTE, dtype=object)[np.arange(len(stats_site)) % len(SITE_COLOR_PALETTE)]
+    by_name = stats_site.sort_values("Site")
+    by_rate = stats_site.sort_values("taux_ok", ascending=False)
+
+    site_success_cards = records(
         {
-            "site": row["Site"],
-            "ok": int(row["ok"]),
-            "total": int(row["total"]),
-            "taux_ok": float(row["taux_ok"]),
-            "color": SITE_COLOR_PALETTE[idx % len(SITE_COLOR_PALETTE)],
-        }
-        for idx, row in stats_site.sort_values("Site").iterrows()
-    ]
+            "site": by_name["Site"],
+            "ok": to_int(by_name["ok"]),
+            "total": to_int(by_name["total"]),
+            "taux_ok": by_name["taux_ok"].astype(float),
+            "color": site_colors[by_name.index.to_numpy()],
+        },
+        len(by_name),
+    )
 
-    site_success_bars = [
+    site_success_bars = records(
         {
-            "site": row["Site"],
-            "taux_ok": float(row["taux_ok"]),
-            "total": int(row["total"]),
-            "color": SITE_COLOR_PALETTE[idx % len(SITE_COLOR_PALETTE)],
-        }
-        for idx, row in stats_site.sort_values("taux_ok", ascending=False).iterrows()
-    ]
+            "site": by_rate["Site"],
+            "taux_ok": by_rate["taux_ok"].astype(float),
+            "total": to_int(by_rate["total"]),
+            "color": site_colors[by_rate.index.to_numpy()],
+        },
+        len(by_rate),
+    )
 
     stats_pdc = (
-        df.groupby(["Site", "PDC"])
-        .agg(total=("is_ok_filt", "count"), ok=("is_ok_filt", "sum"))
+        df.groupby(["Site", "PDC"], observed=True)
+        .agg(total=("nb", "sum"), ok=("ok_nb", "sum"))
         .reset_index()
     )
     stats_pdc["nok"] = stats_pdc["total"] - stats_pdc["ok"]
@@ -1507,8 +1556,8 @@ async def get_sessions_general(
 
     if not err.empty:
         err_grouped = (
-            err.groupby(["Site", "moment"])
-            .size()
+            err.groupby(["Site", "moment"], observed=True)["nb"]
+            .sum()
             .reset_index(name="Nb")
             .pivot(index="Site", columns="moment", values="Nb")
             .fillna(0)
@@ -1517,8 +1566,8 @@ async def get_sessions_general(
         )
 
         err_pdc_grouped = (
-            err.groupby(["Site", "PDC", "moment"])
-            .size()
+            err.groupby(["Site", "PDC", "moment"], observed=True)["nb"]
+            .sum()
             .reset_index(name="Nb")
             .pivot(index=["Site", "PDC"], columns="moment", values="Nb")
             .fillna(0)
@@ -1536,7 +1585,7 @@ async def get_sessions_general(
         recap = (
             stat_global
             .merge(err_grouped, on="Site", how="left")
-            .fillna(0)
+            .fillna(dict.fromkeys(err_moment_cols, 0))
             .sort_values("Total_NOK", ascending=False)
             .reset_index(drop=True)
         )
@@ -1569,7 +1618,7 @@ async def get_sessions_general(
             )
             .assign(**{"% NOK": lambda d: np.where(d["Total"] > 0, (d["Total_NOK"] / d["Total"] * 100).round(2), 0)})
             .merge(err_pdc_grouped, on=["Site", "PDC"], how="left")
-            .fillna(0)
+            .fillna(dict.fromkeys(err_pdc_moment_cols, 0))
         )
 
         numeric_moment_cols_pdc = [c for c in moment_cols if c in pdc_recap.columns]
@@ -1583,41 +1632,44 @@ async def get_sessions_general(
         pdc_recap["Site / PDC"] = "↳ PDC " + pdc_recap["PDC"].astype(str)
         pdc_recap_display = pdc_recap[[c for c in recap_columns if c in pdc_recap.columns]].copy()
 
+        # Lignes PDC regroupées par site en une passe, puis intercalées sous la ligne du site
+        pdc_sorted = pdc_recap.sort_values("Total_NOK", ascending=False, kind="stable")
+        pdc_rows_by_site: dict[Any, list[dict]] = {}
+        pdc_display = {col: pdc_sorted[col] for col in pdc_recap_display.columns}
+        pdc_display.update({"row_type": "pdc", "site_key": pdc_sorted["Site"]})
+        for pdc_dict in records(pdc_display, len(pdc_sorted)):
+            pdc_rows_by_site.setdefault(pdc_dict["site_key"], []).append(pdc_dict)
+
+        labels = na_to_empty(recap["Site / PDC"])
+        site_rows = recap.assign(
+            **{"Site / PDC": labels.where(labels == "", labels.astype(str) + " (Total)")},
+            row_type="site",
+            site_key=recap["Site"],
+        ).to_dict("records")
+
         recap_rows = []
-        for _, row in recap.iterrows():
-            row_dict = row.to_dict()
-            label = row_dict.get("Site / PDC", "")
-            row_dict["Site / PDC"] = f"{label} (Total)" if label else label
-            row_dict.update({"row_type": "site", "site_key": row_dict.get("Site", "")})
+        for row_dict in site_rows:
             recap_rows.append(row_dict)
-
-            site_pdcs = pdc_recap[pdc_recap["Site"].eq(row["Site"])].copy()
-            site_pdcs = site_pdcs.sort_values("Total_NOK", ascending=False)
-
-            for _, pdc_row in site_pdcs.iterrows():
-                pdc_dict = pdc_row.to_dict()
-                display_dict = {k: pdc_dict.get(k) for k in pdc_recap_display.columns}
-                display_dict.update({"row_type": "pdc", "site_key": row_dict.get("Site", "")})
-                recap_rows.append(display_dict)
+            recap_rows.extend(pdc_rows_by_site.get(row_dict["site_key"], []))
 
         counts_moment = (
-            err.groupby("moment")
-            .size()
+            err.groupby("moment", observed=True)["nb"]
+            .sum()
             .reindex(MOMENT_ORDER, fill_value=0)
             .reset_index(name="count")
         )
         counts_moment = counts_moment[counts_moment["count"] > 0]
 
-        total_err = len(err)
+        total_err = int(err["nb"].sum())
         moment_total_errors = int(total_err)
-        moment_distribution = [
+        moment_distribution = records(
             {
-                "moment": row["moment"],
-                "count": int(row["count"]),
-                "percent": round(row["count"] / total_err * 100, 1) if total_err else 0,
-            }
-            for _, row in counts_moment.iterrows()
-        ]
+                "moment": counts_moment["moment"],
+                "count": counts_moment["count"].astype(int),
+                "percent": (counts_moment["count"] / total_err * 100).round(1) if total_err else 0,
+            },
+            len(counts_moment),
+        )
 
         error_type_order = ["Erreur_EVI", "Erreur_DownStream", "Erreur_Unknow_S"]
         error_type_labels = {
@@ -1628,43 +1680,85 @@ async def get_sessions_general(
 
         type_counts = (
             err[err["type_erreur"].isin(error_type_order)]
-            .groupby("type_erreur")
-            .size()
+            .groupby("type_erreur", observed=True)["nb"]
+            .sum()
             .reindex(error_type_order, fill_value=0)
             .reset_index(name="count")
         )
 
         error_type_total = int(type_counts["count"].sum())
 
-        error_type_distribution = [
+        type_counts = type_counts[type_counts["count"] > 0]
+        error_type_distribution = records(
             {
-                "type_erreur": row["type_erreur"],
-                "label": error_type_labels.get(row["type_erreur"], row["type_erreur"]),
-                "count": int(row["count"]),
-                "percent": round(row["count"] / error_type_total * 100, 1) if error_type_total else 0,
-            }
-            for _, row in type_counts.iterrows()
-            if row["count"] > 0
-        ]
+                "type_erreur": type_counts["type_erreur"],
+                "label": type_counts["type_erreur"].astype(object).replace(error_type_labels),
+                "count": type_counts["count"].astype(int),
+                "percent": (type_counts["count"] / error_type_total * 100).round(1) if error_type_total else 0,
+            },
+            len(type_counts),
+        )
+
+    return {
+        "total": total,
+        "ok": ok,
+        "nok": nok,
+        "taux_reussite": taux_reussite,
+        "taux_echec": taux_echec,
+        "recap_columns": recap_columns,
+        "recap_rows": recap_rows,
+        "moment_distribution": moment_distribution,
+        "moment_total_errors": moment_total_errors,
+        "error_type_distribution": error_type_distribution,
+        "error_type_total": error_type_total,
+        "site_success_cards": site_success_cards,
+        "site_success_bars": site_success_bars,
+    }
+
+
+@router.get("/sessions/general")
+@coalesce
+async def get_sessions_general(
+    request: Request,
+    sites: str = Query(default=""),
+    date_debut: date = Query(default=None),
+    date_fin: date = Query(default=None),
+    error_types: str = Query(default=""),
+    moments: str = Query(default=""),
+):
+    error_type_list = [e.strip() for e in error_types.split(",") if e.strip()] if error_types else []
+    moment_list = [m.strip() for m in moments.split(",") if m.strip()] if moments else []
+
+    df = await load_session_counts(
+        ["Site", "PDC", "state", "type_erreur", "moment"], sites, date_debut, date_fin
+    )
+
+    if df.empty:
+        return templates.TemplateResponse(
+            "partials/sessions_general.html",
+            {
+                "request": request,
+                "total": 0,
+                "ok": 0,
+                "nok": 0,
+                "taux_reussite": 0,
+                "taux_echec": 0,
+                "recap_columns": [],
+                "recap_rows": [],
+                "moment_distribution": [],
+                "moment_total_errors": 0,
+                "error_type_distribution": [],
+                "error_type_total": 0,
+                "site_success_cards": [],
+                "site_success_bars": [],
+            },
+        )
+
+    context = await run_in_thread(_sessions_general_context, df, error_type_list, moment_list)
 
     return templates.TemplateResponse(
         "partials/sessions_general.html",
-        {
-            "request": request,
-            "total": total,
-            "ok": ok,
-            "nok": nok,
-            "taux_reussite": taux_reussite,
-            "taux_echec": taux_echec,
-            "recap_columns": recap_columns,
-            "recap_rows": recap_rows,
-            "moment_distribution": moment_distribution,
-            "moment_total_errors": moment_total_errors,
-            "error_type_distribution": error_type_distribution,
-            "error_type_total": error_type_total,
-            "site_success_cards": site_success_cards,
-            "site_success_bars": site_success_bars,
-        },
+        {"request": request, **context},
     )
 
 
@@ -1690,21 +1784,10 @@ async def get_sessions_comparaison(
         "moments": moments,
     }
 
-    where_clause, params = _build_conditions(sites, date_debut, date_fin)
-
-    sql = f"""
-        SELECT
-            Site,
-            `Datetime start`,
-            `State of charge(0:good, 1:error)` as state,
-            type_erreur,
-            moment
-        FROM kpi_sessions
-        WHERE {where_clause}
-    """
-
     try:
-        df = query_df(sql, params)
+        df = await load_session_counts(
+            ["Site", "day", "hour", "state", "type_erreur", "moment"], sites, date_debut, date_fin
+        )
     except Exception as exc:  # pragma: no cover - defensive fallback for UI visibility
         return templates.TemplateResponse(
             "partials/sessions_comparaison.html",
@@ -1723,18 +1806,16 @@ async def get_sessions_comparaison(
             _comparaison_base_context(request, filters),
         )
 
-    df = _apply_status_filters(df, error_type_list, moment_list)
-
-    if "Datetime start" in df.columns:
-        df["Datetime start"] = pd.to_datetime(df["Datetime start"], errors="coerce")
+    df = _apply_weighted_status_filters(df, error_type_list, moment_list)
+    df["day"] = pd.to_datetime(df["day"], errors="coerce")
 
     site_col = "Site"
 
     by_site = (
-        df.groupby(site_col, as_index=False)
+        df.groupby(site_col, as_index=False, observed=True)
         .agg(
-            Total_Charges=("is_ok_filt", "count"),
-            Charges_OK=("is_ok_filt", "sum"),
+            Total_Charges=("nb", "sum"),
+            Charges_OK=("ok_nb", "sum"),
         )
     )
     by_site["Charges_NOK"] = by_site["Total_Charges"] - by_site["Charges_OK"]
@@ -1754,32 +1835,33 @@ async def get_sessions_comparaison(
     by_site_sorted = by_site.sort_values("Total_Charges", ascending=False)
     max_total = int(by_site_sorted["Total_Charges"].max()) if not by_site_sorted.empty else 0
 
-    count_bars = [
+    count_bars = records(
         {
-            "site": row[site_col],
-            "ok": int(row["Charges_OK"]),
-            "nok": int(row["Charges_NOK"]),
-            "total": int(row["Total_Charges"]),
-        }
-        for _, row in by_site_sorted.iterrows()
-    ]
+            "site": by_site_sorted[site_col],
+            "ok": by_site_sorted["Charges_OK"].astype(int),
+            "nok": by_site_sorted["Charges_NOK"].astype(int),
+            "total": by_site_sorted["Total_Charges"].astype(int),
+        },
+        len(by_site_sorted),
+    )
 
-    percent_bars = [
+    percent_bars = records(
         {
-            "site": row[site_col],
-            "ok_pct": float(row["% Réussite"]),
-            "nok_pct": float(row["% Échec"]),
-        }
-        for _, row in by_site_sorted.iterrows()
-    ]
+            "site": by_site_sorted[site_col],
+            "ok_pct": by_site_sorted["% Réussite"].astype(float),
+            "nok_pct": by_site_sorted["% Échec"].astype(float),
+        },
+        len(by_site_sorted),
+    )
 
     base = df.copy()
-    base["hour"] = pd.to_datetime(base["Datetime start"], errors="coerce").dt.hour
+    base["hour"] = pd.to_numeric(base["hour"], errors="coerce")
 
     g = (
         base.dropna(subset=["hour"])
-        .groupby([site_col, "hour"])
-        .size()
+        .astype({"hour": int})
+        .groupby([site_col, "hour"], observed=True)["nb"]
+        .sum()
         .reset_index(name="Nb")
     )
 
@@ -1789,7 +1871,7 @@ async def get_sessions_comparaison(
     heatmap_max = 0
 
     if not g.empty:
-        peak = g.loc[g.groupby(site_col)["Nb"].idxmax()][[site_col, "hour", "Nb"]].rename(
+        peak = g.loc[g.groupby(site_col, observed=True)["Nb"].idxmax()][[site_col, "hour", "Nb"]].rename(
             columns={"hour": "Heure de pic", "Nb": "Nb au pic"}
         )
 
@@ -1800,32 +1882,33 @@ async def get_sessions_comparaison(
             return int(s.loc[c >= half, "hour"].iloc[0])
 
         med = (
-            g.groupby(site_col)[["hour", "Nb"]]
+            g.groupby(site_col, observed=True)[["hour", "Nb"]]
             .apply(_w_median_hours)
             .reset_index(name="Heure médiane")
         )
         summ = peak.merge(med, on=site_col, how="left")
 
-        for _, row in summ.sort_values(site_col).iterrows():
-            peak_rows.append(
-                {
-                    "site": row[site_col],
-                    "peak_hour": f"{int(row['Heure de pic']):02d}:00",
-                    "peak_nb": int(row["Nb au pic"]),
-                    "median_hour": f"{int(row['Heure médiane']):02d}:00",
-                }
-            )
+        summ = summ.sort_values(site_col)
+        peak_rows = records(
+            {
+                "site": summ[site_col],
+                "peak_hour": summ["Heure de pic"].astype(int).astype(str).str.zfill(2) + ":00",
+                "peak_nb": summ["Nb au pic"].astype(int),
+                "median_hour": summ["Heure médiane"].astype(int).astype(str).str.zfill(2) + ":00",
+            },
+            len(summ),
+        )
 
         heatmap = g.pivot(index=site_col, columns="hour", values="Nb").fillna(0)
         heatmap_hours = sorted(heatmap.columns.tolist())
         heatmap_max = int(heatmap.values.max()) if heatmap.size else 0
-        for idx in heatmap.index:
-            heatmap_rows.append(
-                {
-                    "site": idx,
-                    "values": [int(heatmap.at[idx, h]) if h in heatmap.columns else 0 for h in heatmap_hours],
-                }
-            )
+        heatmap_rows = records(
+            {
+                "site": heatmap.index,
+                "values": heatmap[heatmap_hours].astype(int).to_numpy().tolist(),
+            },
+            len(heatmap),
+        )
 
     site_options = by_site_sorted[site_col].tolist()
     site_focus_value = site_focus if site_focus and site_focus in site_options else (site_options[0] if site_options else "")
@@ -1840,11 +1923,11 @@ async def get_sessions_comparaison(
         ok_focus = base_site[base_site["is_ok_filt"]].copy()
         nok_focus = base_site[~base_site["is_ok_filt"]].copy()
 
-        ok_focus["month"] = pd.to_datetime(ok_focus["Datetime start"], errors="coerce").dt.to_period("M").astype(str)
-        nok_focus["month"] = pd.to_datetime(nok_focus["Datetime start"], errors="coerce").dt.to_period("M").astype(str)
+        ok_focus["month"] = ok_focus["day"].dt.to_period("M").astype(str)
+        nok_focus["month"] = nok_focus["day"].dt.to_period("M").astype(str)
 
-        g_ok_m = ok_focus.groupby("month").size().reset_index(name="Nb").assign(Status="OK")
-        g_nok_m = nok_focus.groupby("month").size().reset_index(name="Nb").assign(Status="NOK")
+        g_ok_m = ok_focus.groupby("month", observed=True)["nb"].sum().reset_index(name="Nb").assign(Status="OK")
+        g_nok_m = nok_focus.groupby("month", observed=True)["nb"].sum().reset_index(name="Nb").assign(Status="NOK")
 
         g_both_m = pd.concat([g_ok_m, g_nok_m], ignore_index=True)
         g_both_m["month"] = pd.to_datetime(g_both_m["month"], errors="coerce")
@@ -1875,16 +1958,16 @@ async def get_sessions_comparaison(
                 ok_month = ok_focus[ok_focus["month"] == month_focus_value].copy()
                 nok_month = nok_focus[nok_focus["month"] == month_focus_value].copy()
 
-                ok_month["day"] = pd.to_datetime(ok_month["Datetime start"], errors="coerce").dt.strftime("%Y-%m-%d")
-                nok_month["day"] = pd.to_datetime(nok_month["Datetime start"], errors="coerce").dt.strftime("%Y-%m-%d")
+                ok_month["day"] = ok_month["day"].dt.strftime("%Y-%m-%d")
+                nok_month["day"] = nok_month["day"].dt.strftime("%Y-%m-%d")
 
                 per = pd.Period(month_focus_value, freq="M")
                 days = pd.date_range(per.to_timestamp(how="start"), per.to_timestamp(how="end"), freq="D").strftime("%Y-%m-%d")
 
-                g_ok_d = ok_month.groupby("day").size().reindex(days, fill_value=0).reset_index()
+                g_ok_d = ok_month.groupby("day", observed=True)["nb"].sum().reindex(days, fill_value=0).reset_index()
                 g_ok_d.columns = ["day", "Nb"]
                 g_ok_d["Status"] = "OK"
-                g_nok_d = nok_month.groupby("day").size().reindex(days, fill_value=0).reset_index()
+                g_nok_d = nok_month.groupby("day", observed=True)["nb"].sum().reindex(days, fill_value=0).reset_index()
                 g_nok_d.columns = ["day", "Nb"]
                 g_nok_d["Status"] = "NOK"
 
@@ -1932,15 +2015,6 @@ async def get_sessions_comparaison(
     return templates.TemplateResponse("partials/sessions_comparaison.html", context)
 
 
-def _format_soc(s0, s1):
-    if pd.notna(s0) and pd.notna(s1):
-        try:
-            return f"{int(round(s0))}% → {int(round(s1))}%"
-        except Exception:
-            return ""
-    return ""
-
-
 def _prepare_query_params(request: Request) -> str:
     allowed = {"sites", "date_debut", "date_fin", "error_types", "moments"}
     data = {k: v for k, v in request.query_params.items() if k in allowed and v}
@@ -1961,31 +2035,31 @@ async def get_sessions_site_details(
     error_type_list = [e.strip() for e in error_types.split(",") if e.strip()] if error_types else []
     moment_list = [m.strip() for m in moments.split(",") if m.strip()] if moments else []
 
-    where_clause, params = _build_conditions(sites, date_debut, date_fin)
-
-    sql = f"""
-        SELECT
-            Site,
-            PDC,
-            ID,
-            `Datetime start`,
-            `Datetime end`,
-            `Energy (Kwh)`,
-            `MAC Address`,
-            Vehicle,
-            type_erreur,
-            moment,
-            moment_avancee, 
-            `SOC Start`,
-            `SOC End`,
-            `Downstream Code PC`,
-            `EVI Error Code`,
-            `State of charge(0:good, 1:error)` as state
-        FROM kpi_sessions
-        WHERE {where_clause}
-    """
-
-    df = query_df(sql, params)
+    df = await session_frames.view(
+        [
+            "Site",
+            "PDC",
+            "ID",
+            "Datetime start",
+            "Datetime end",
+            "Energy (Kwh)",
+            "MAC Address",
+            "Vehicle",
+            "type_erreur",
+            "moment",
+            "moment_avancee",
+            "SOC Start",
+            "SOC End",
+            DS_PC,
+            EVI_CODE,
+            STATE_COL,
+        ],
+        sites,
+        date_debut,
+        date_fin,
+        error_type_list,
+        moment_list,
+    )
 
     if df.empty:
         return templates.TemplateResponse(
@@ -2001,13 +2075,6 @@ async def get_sessions_site_details(
         )
 
     df["PDC"] = df["PDC"].astype(str)
-    df["is_ok"] = pd.to_numeric(df["state"], errors="coerce").fillna(0).astype(int).eq(0)
-
-    mask_type = df["type_erreur"].isin(error_type_list) if error_type_list and "type_erreur" in df.columns else True
-    mask_moment = df["moment"].isin(moment_list) if moment_list and "moment" in df.columns else True
-    mask_nok = ~df["is_ok"]
-    mask_filtered_error = mask_nok & mask_type & mask_moment
-    df["is_ok_filt"] = np.where(mask_filtered_error, False, True)
 
     site_options = sorted(df["Site"].dropna().unique().tolist())
     site_value = site_focus if site_focus in site_options else (site_options[0] if site_options else "")
@@ -2047,16 +2114,9 @@ async def get_sessions_site_details(
     )
     df_filtered = df_site[mask_type_site & mask_moment_site].copy()
 
-    for col in ["Datetime start", "Datetime end"]:
-        if col in df_filtered.columns:
-            df_filtered[col] = pd.to_datetime(df_filtered[col], errors="coerce")
-    for col in ["Energy (Kwh)", "SOC Start", "SOC End"]:
-        if col in df_filtered.columns:
-            df_filtered[col] = pd.to_numeric(df_filtered[col], errors="coerce")
-
     err_rows = df_filtered[~df_filtered["is_ok"]].copy()
-    err_rows["evolution_soc"] = err_rows.apply(lambda r: _format_soc(r.get("SOC Start"), r.get("SOC End")), axis=1)
-    err_rows["elto"] = err_rows["ID"].apply(lambda x: f"https://elto.nidec-asi-online.com/Charge/detail?id={str(x).strip()}" if pd.notna(x) else "") if "ID" in err_rows.columns else ""
+    err_rows["evolution_soc"] = format_soc(column(err_rows, "SOC Start", None), column(err_rows, "SOC End", None))
+    err_rows["elto"] = build_url(err_rows["ID"]) if "ID" in err_rows.columns else ""
     err_display_cols = [
         "ID",
         "Datetime start",
@@ -2075,8 +2135,8 @@ async def get_sessions_site_details(
         err_table = err_table.sort_values("Datetime start", ascending=False)
 
     ok_rows = df_filtered[df_filtered["is_ok"]].copy()
-    ok_rows["evolution_soc"] = ok_rows.apply(lambda r: _format_soc(r.get("SOC Start"), r.get("SOC End")), axis=1)
-    ok_rows["elto"] = ok_rows["ID"].apply(lambda x: f"https://elto.nidec-asi-online.com/Charge/detail?id={str(x).strip()}" if pd.notna(x) else "") if "ID" in ok_rows.columns else ""
+    ok_rows["evolution_soc"] = format_soc(column(ok_rows, "SOC Start", None), column(ok_rows, "SOC End", None))
+    ok_rows["elto"] = build_url(ok_rows["ID"]) if "ID" in ok_rows.columns else ""
     ok_display_cols = [
         "ID",
         "Datetime start",
@@ -2097,7 +2157,7 @@ async def get_sessions_site_details(
     site_success_rate = round(site_charges_ok / site_total_charges * 100, 2) if site_total_charges else 0.0
 
     by_pdc = (
-        df_site.groupby("PDC", as_index=False)
+        df_site.groupby("PDC", as_index=False, observed=True)
         .agg(Total_Charges=("is_ok_filt", "count"), Charges_OK=("is_ok_filt", "sum"))
         .assign(Charges_NOK=lambda d: d["Total_Charges"] - d["Charges_OK"])
     )
@@ -2115,7 +2175,7 @@ async def get_sessions_site_details(
     error_type_total = 0
     if not err_rows.empty:
         if "moment" in err_rows.columns:
-            counts = err_rows.groupby("moment").size().reset_index(name="Nb")
+            counts = err_rows.groupby("moment", observed=True).size().reset_index(name="Nb")
             total = counts["Nb"].sum()
             if total:
                 error_moment = (
@@ -2127,7 +2187,7 @@ async def get_sessions_site_details(
 
         if "moment_avancee" in err_rows.columns:
             counts_adv = (
-                err_rows.groupby("moment_avancee")
+                err_rows.groupby("moment_avancee", observed=True)
                 .size()
                 .reset_index(name="Nb")
                 .sort_values("Nb", ascending=False)
@@ -2149,7 +2209,7 @@ async def get_sessions_site_details(
 
         type_counts = (
             err_rows[err_rows["type_erreur"].isin(error_type_order)]
-            .groupby("type_erreur")
+            .groupby("type_erreur", observed=True)
             .size()
             .reindex(error_type_order, fill_value=0)
             .reset_index(name="count")
@@ -2157,16 +2217,16 @@ async def get_sessions_site_details(
 
         error_type_total = int(type_counts["count"].sum())
 
-        error_type_distribution = [
+        type_counts = type_counts[type_counts["count"] > 0]
+        error_type_distribution = records(
             {
-                "type_erreur": row["type_erreur"],
-                "label": error_type_labels.get(row["type_erreur"], row["type_erreur"]),
-                "count": int(row["count"]),
-                "percent": round(row["count"] / error_type_total * 100, 1) if error_type_total else 0,
-            }
-            for _, row in type_counts.iterrows()
-            if row["count"] > 0
-        ]
+                "type_erreur": type_counts["type_erreur"],
+                "label": type_counts["type_erreur"].astype(object).replace(error_type_labels),
+                "count": type_counts["count"].astype(int),
+                "percent": (type_counts["count"] / error_type_total * 100).round(1) if error_type_total else 0,
+            },
+            len(type_counts),
+        )
 
     downstream_occ: list[dict] = []
     downstream_moments: list[str] = []
@@ -2179,7 +2239,7 @@ async def get_sessions_site_details(
 
             if not sub.empty:
                 sub["Code_PC"] = pd.to_numeric(sub["Downstream Code PC"], errors="coerce").fillna(0).astype(int)
-                tmp = sub.groupby(["Code_PC", "moment"]).size().reset_index(name="Occurrences")
+                tmp = sub.groupby(["Code_PC", "moment"], observed=True).size().reset_index(name="Occurrences")
                 downstream_moments = [m for m in MOMENT_ORDER if m in tmp["moment"].unique()]
                 downstream_moments += [m for m in sorted(tmp["moment"].unique()) if m not in downstream_moments]
 
@@ -2227,7 +2287,7 @@ async def get_sessions_site_details(
 
             if not sub.empty:
                 sub["EVI_Code"] = pd.to_numeric(sub["EVI Error Code"], errors="coerce").astype(int)
-                tmp = sub.groupby(["EVI_Code", "moment"]).size().reset_index(name="Occurrences")
+                tmp = sub.groupby(["EVI_Code", "moment"], observed=True).size().reset_index(name="Occurrences")
                 evi_occ_moments = [m for m in MOMENT_ORDER if m in tmp["moment"].unique()]
                 evi_occ_moments += [m for m in sorted(tmp["moment"].unique()) if m not in evi_occ_moments]
 
@@ -2262,7 +2322,7 @@ async def get_sessions_site_details(
 
                 evi_occ = table.to_dict("records") + [total_row]
 
-    return templates.TemplateResponse(
+    return templates.StreamingTemplateResponse(
         "partials/sessions_site_details.html",
         {
             "request": request,
@@ -2270,8 +2330,8 @@ async def get_sessions_site_details(
             "site_focus": site_value,
             "pdc_options": pdc_options,
             "selected_pdc": selected_pdc,
-            "err_rows": err_table.to_dict("records"),
-            "ok_rows": ok_table.to_dict("records"),
+            "err_rows": RowStream(err_table),
+            "ok_rows": RowStream(ok_table),
             "by_pdc": by_pdc.to_dict("records"),
             "site_success_rate": site_success_rate,
             "site_total_charges": site_total_charges,
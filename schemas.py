@@ -0,0 +1,88 @@
+"""
+Schéma déclaratif des colonnes des tables KPI
+
+Les types sont appliqués une seule fois au chargement (query_df / query_df_async) :
+- catégories pour les chaînes à faible cardinalité (site, PDC, type d'erreur, moment, véhicule)
+- datetime64 pour les horodatages
+- entiers et booléens nullables pour les codes et l'état de charge
+"""
+
+import pandas as pd
+
+DATETIME = "datetime"
+FLOAT = "float"
+CATEGORY = "category"
+BOOLEAN = "boolean"
+INT8 = "Int8"
+INT32 = "Int32"
+
+_SESSION_DIMENSIONS = {
+    "Site": CATEGORY,
+    "PDC": CATEGORY,
+    "type_erreur": CATEGORY,
+    "moment": CATEGORY,
+    "Vehicle": CATEGORY,
+}
+
+TABLE_SCHEMAS: dict[str, dict[str, str]] = {
+    "kpi_sessions": {
+        **_SESSION_DIMENSIONS,
+        "Datetime start": DATETIME,
+        "Datetime end": DATETIME,
+        "Energy (Kwh)": FLOAT,
+        "Mean Power (Kw)": FLOAT,
+        "Max Power (Kw)": FLOAT,
+        "SOC Start": FLOAT,
+        "SOC End": FLOAT,
+        "EVI Status during error": FLOAT,
+        "EVI Error Code": INT32,
+        "Downstream Code PC": INT32,
+        "State of charge(0:good, 1:error)": INT8,
+        "state": INT8,
+        "is_ok": BOOLEAN,
+    },
+    "kpi_sessions_rollup": {
+        **_SESSION_DIMENSIONS,
+        "day": DATETIME,
+        "hour": INT8,
+        "state": INT8,
+        "energy_kwh": FLOAT,
+        "duration_min": FLOAT,
+    },
+}
+
+
+def schema_for(tables) -> dict[str, str]:
+    """Fusionne les schémas des tables lues par une requête."""
+    schema: dict[str, str] = {}
+    for table in tables:
+        schema.update(TABLE_SCHEMAS.get(table, {}))
+    return schema
+
+
+def _convert(series: pd.Series, kind: str) -> pd.Series:
+    if kind == DATETIME:
+        if pd.api.types.is_datetime64_any_dtype(series):
+            return series
+        return pd.to_datetime(series, errors="coerce")
+    if kind == CATEGORY:
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            return series
+        return series.astype("category")
+
+    numeric = pd.to_numeric(series, errors="coerce")
+    if kind == FLOAT:
+        return numeric.astype("float64")
+    try:
+        return numeric.astype(kind)
+    except (TypeError, ValueError):
+        # Valeurs hors domaine (décimales, codes inattendus) : on garde la version numérique
+        return numeric
+
+
+def apply_schema(df: pd.DataFrame, tables) -> pd.DataFrame:
+    """Applique en place les types déclarés aux colonnes présentes dans le DataFrame."""
+    schema = schema_for(tables)
+    for column in df.columns.intersection(list(schema)):
+        df[column] = _convert(df[column], schema[column])
+    return df
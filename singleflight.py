@@ -0,0 +1,74 @@
+"""
+Regroupement des calculs identiques concurrents (single-flight)
+
+Le premier appelant d'une clé lance le calcul dans une tâche ; les appelants suivants, tant
+que ce calcul est en cours, attendent la même tâche au lieu d'en lancer un autre.
+Deux niveaux : query_df_async (même SQL et paramètres) et résultat d'endpoint (mêmes filtres).
+"""
+
+import asyncio
+import functools
+from typing import Any, Awaitable, Callable, Hashable
+
+from fastapi import Request
+from fastapi.responses import Response
+
+from metrics import record_coalesced
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._in_flight: dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> tuple[Any, bool]:
+        """Retourne (résultat, partagé) ; `partagé` vaut True si le calcul d'un autre appelant a été réutilisé."""
+        task = self._in_flight.get(key)
+        shared = task is not None
+        if shared:
+            record_coalesced(self.name)
+        else:
+            # Tâche indépendante : l'annulation du premier appelant n'interrompt pas les autres
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(functools.partial(self._done, key))
+        return await asyncio.shield(task), shared
+
+    def _done(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            task.exception()  # marque l'exception comme lue si tous les appelants sont partis
+
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+
+query_flight = SingleFlight("query")
+endpoint_flight = SingleFlight("endpoint")
+
+
+def _clone_response(response: Response) -> Response:
+    """Réponse indépendante (en-têtes modifiables par les middlewares) sur le même corps."""
+    clone = Response(content=response.body, status_code=response.status_code)
+    clone.raw_headers = list(response.raw_headers)
+    return clone
+
+
+def coalesce(endpoint):
+    """
+    Décorateur d'endpoint : les requêtes concurrentes avec les mêmes paramètres partagent la
+    même réponse rendue. Seuls les paramètres déclarés (filtres) forment la clé, pas la requête.
+    """
+
+    @functools.wraps(endpoint)
+    async def wrapper(**kwargs):
+        key = (
+            endpoint.__module__,
+            endpoint.__qualname__,
+            tuple(sorted((k, v) for k, v in kwargs.items() if not isinstance(v, Request))),
+        )
+        response, _ = await endpoint_flight.do(key, lambda: endpoint(**kwargs))
+        return _clone_response(response)
+
+    return wrapper
@@ -0,0 +1,486 @@
+"""
+Copie locale en Parquet de kpi_sessions, partitionnée par mois
+
+- la copie est complétée de façon incrémentale (watermark sur `Datetime start`/ID) et
+  reconstruite intégralement toutes les SNAPSHOT_REBUILD_SECONDS (lignes corrigées par l'ETL)
+- les jeux de données sont ouverts en lecture mémoire-mappée au démarrage ; read_snapshot
+  permet aux routers de lire la copie locale plutôt que d'interroger MySQL à distance, tant
+  que la dernière synchronisation date de moins de SNAPSHOT_MAX_LAG_SECONDS
+
+Usage : python snapshots.py [--full] [table ...]
+"""
+
+import asyncio
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Callable, Iterable, Iterator, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs
+from sqlalchemy import text
+
+from compute import run_in_thread
+from db import engine, iter_query_chunks
+from metrics import record_query, stage
+from schemas import apply_schema
+from sql_filters import KPI_TABLES, parse_list
+
+SNAPSHOT_ENABLED = os.getenv("SNAPSHOT_ENABLED", "0") == "1"
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.join("data", "snapshots"))
+SNAPSHOT_SYNC_SECONDS = int(os.getenv("SNAPSHOT_SYNC_SECONDS", "0"))
+SNAPSHOT_CHUNK_ROWS = int(os.getenv("SNAPSHOT_CHUNK_ROWS", "50000"))
+# Au-delà, la copie est ignorée et les lectures repassent par MySQL
+SNAPSHOT_MAX_LAG_SECONDS = int(os.getenv("SNAPSHOT_MAX_LAG_SECONDS", str(2 * SNAPSHOT_SYNC_SECONDS)))
+SNAPSHOT_REBUILD_SECONDS = int(os.getenv("SNAPSHOT_REBUILD_SECONDS", "86400"))
+
+PARTITION_COL = "month"
+NO_DATE_PARTITION = "none"
+WATERMARK_FILE = "_watermark.json"
+
+
+@dataclass(frozen=True)
+class SnapshotSpec:
+    table: str
+    date_col: str
+    id_col: str
+
+
+# Seule table lue depuis la copie locale (routers/sessions.py)
+SNAPSHOT_TABLES = {
+    "kpi_sessions": SnapshotSpec("kpi_sessions", date_col="Datetime start", id_col="ID"),
+}
+
+_local_fs = fs.LocalFileSystem(use_mmap=True)
+_datasets: dict[str, ds.Dataset] = {}
+# Heure (time.time) de la dernière synchronisation réussie de chaque jeu ouvert
+_synced_at: dict[str, float] = {}
+_datasets_lock = threading.Lock()
+
+
+def _table_dir(table: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, table)
+
+
+# ============================================================
+# Synchronisation MySQL -> Parquet
+# ============================================================
+
+def _read_watermark(root: str) -> dict | None:
+    path = os.path.join(root, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_watermark(root: str, payload: dict) -> None:
+    path = os.path.join(root, WATERMARK_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(payload, f)
+    os.replace(tmp_path, path)
+
+
+def _write_watermark(root: str, last_value, last_id, batch: tuple[str, int], full_at: float) -> None:
+    _save_watermark(
+        root,
+        {
+            "last_value": str(last_value),
+            "last_id": str(last_id),
+            "batch": list(batch),
+            "synced_at": time.time(),
+            "full_at": full_at,
+        },
+    )
+
+
+def _batch_of(filename: str) -> tuple[str, int] | None:
+    """(horodatage, numéro de lot) d'un fichier part-{stamp}-{n}-{i}.parquet."""
+    parts = filename.split("-")
+    if len(parts) != 4 or parts[0] != "part" or not parts[2].isdigit():
+        return None
+    return parts[1], int(parts[2])
+
+
+def _discard_uncommitted(root: str, watermark: dict) -> int:
+    """
+    Supprime les fichiers des lots postérieurs au watermark : ils viennent d'une synchronisation
+    interrompue et seraient sinon réécrits en double. Retourne le nombre de fichiers supprimés.
+    """
+    if "batch" not in watermark:
+        return 0
+    committed = (watermark["batch"][0], int(watermark["batch"][1]))
+    removed = 0
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            batch = _batch_of(name)
+            if batch is not None and batch > committed:
+                os.remove(os.path.join(dirpath, name))
+                removed += 1
+    return removed
+
+
+# Type MySQL (information_schema.COLUMNS.DATA_TYPE) -> type Arrow ; texte par défaut
+_ARROW_TYPES = {
+    **dict.fromkeys(("tinyint", "smallint", "mediumint", "int", "integer", "bigint", "year", "bit"), pa.int64()),
+    **dict.fromkeys(("decimal", "numeric", "float", "double", "real"), pa.float64()),
+    **dict.fromkeys(("datetime", "timestamp"), pa.timestamp("ns")),
+    "date": pa.date32(),
+    "time": pa.duration("ns"),
+    **dict.fromkeys(("binary", "varbinary", "tinyblob", "blob", "mediumblob", "longblob"), pa.binary()),
+}
+
+
+def _mysql_schema(table: str) -> pa.Schema:
+    """
+    Schéma Arrow dérivé des types des colonnes MySQL : il ne dépend pas des valeurs du premier
+    lot (une colonne entièrement NULL garde son type numérique ou date pour les lots suivants).
+    """
+    with engine.connect() as conn:
+        columns = conn.execute(
+            text(
+                """
+                SELECT COLUMN_NAME, DATA_TYPE
+                FROM information_schema.COLUMNS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table
+                ORDER BY ORDINAL_POSITION
+                """
+            ),
+            {"table": table},
+        ).fetchall()
+    return pa.schema([pa.field(name, _ARROW_TYPES.get(str(data_type).lower(), pa.string())) for name, data_type in columns])
+
+
+def _existing_schema(root: str) -> pa.Schema | None:
+    if not os.path.isdir(root) or not any(name.startswith(f"{PARTITION_COL}=") for name in os.listdir(root)):
+        return None
+    schema = ds.dataset(root, format="parquet", partitioning="hive").schema
+    return schema.remove(schema.get_field_index(PARTITION_COL))
+
+
+def _to_arrow(chunk: pd.DataFrame, spec: SnapshotSpec, schema: pa.Schema) -> pa.Table:
+    if spec.date_col and spec.date_col in chunk.columns:
+        dates = pd.to_datetime(chunk[spec.date_col], errors="coerce")
+        month = dates.dt.strftime("%Y-%m").fillna(NO_DATE_PARTITION)
+    else:
+        month = pd.Series(NO_DATE_PARTITION, index=chunk.index)
+
+    table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+    return table.append_column(PARTITION_COL, pa.array(month.to_numpy(dtype=object), pa.string()))
+
+
+def _write_chunks(
+    chunks: Iterable[pd.DataFrame],
+    spec: SnapshotSpec,
+    root: str,
+    schema: pa.Schema,
+    on_chunk: Callable[[tuple[str, int], pd.DataFrame], None] | None = None,
+) -> int:
+    """
+    Écrit les lots dans `root` (un fichier par mois et par lot). `on_chunk(lot, chunk)` est
+    appelé une fois chaque lot entièrement écrit. Retourne le nombre de lignes.
+    """
+    # Microsecondes : deux synchronisations dans la même seconde n'écrasent pas leurs fichiers
+    stamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    rows = 0
+
+    for n, chunk in enumerate(chunks):
+        if chunk.empty:
+            continue
+        table = _to_arrow(chunk, spec, schema)
+        pq.write_to_dataset(
+            table,
+            root_path=root,
+            partition_cols=[PARTITION_COL],
+            basename_template=f"part-{stamp}-{n}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+        rows += len(chunk)
+        if on_chunk is not None:
+            on_chunk((stamp, n), chunk)
+
+    return rows
+
+
+def _sync(spec: SnapshotSpec, full: bool) -> dict:
+    root = _table_dir(spec.table)
+    schema = _mysql_schema(spec.table)
+    watermark = None if full else _read_watermark(root)
+    if watermark is not None and time.time() - watermark.get("full_at", 0) >= SNAPSHOT_REBUILD_SECONDS:
+        # Reconstruction périodique : l'incrémental ne voit pas les lignes corrigées par l'ETL
+        watermark = None
+    existing = _existing_schema(root)
+    if watermark is not None and existing is not None and not existing.equals(schema, check_metadata=False):
+        # Fichiers écrits avec un autre schéma (type figé sur un premier lot, colonne modifiée) :
+        # on ne peut pas les compléter, resynchronisation complète
+        watermark = None
+    if watermark is None:
+        # Copie complète écrite à côté puis substituée : les lectures gardent l'ancienne jusque-là
+        target = f"{root}.tmp"
+        full_at = time.time()
+        shutil.rmtree(target, ignore_errors=True)
+        os.makedirs(target, exist_ok=True)
+    else:
+        target = root
+        full_at = watermark.get("full_at", 0)
+        _discard_uncommitted(root, watermark)
+
+    date_col, id_col = f"`{spec.date_col}`", f"`{spec.id_col}`"
+    sql = f"SELECT * FROM {spec.table} WHERE {date_col} IS NOT NULL"
+    params: dict = {}
+    if watermark is not None:
+        sql += f" AND ({date_col} > :wm_value OR ({date_col} = :wm_value AND {id_col} > :wm_id))"
+        params = {"wm_value": watermark["last_value"], "wm_id": watermark["last_id"]}
+    sql += f" ORDER BY {date_col}, {id_col}"
+
+    def commit(batch: tuple[str, int], chunk: pd.DataFrame) -> None:
+        # Watermark avancé lot par lot : une synchronisation interrompue reprend après le
+        # dernier lot complet, les fichiers d'un lot partiel sont écartés par _discard_uncommitted
+        _write_watermark(target, chunk[spec.date_col].iloc[-1], chunk[spec.id_col].iloc[-1], batch, full_at)
+
+    chunks = iter_query_chunks(sql, params, chunksize=SNAPSHOT_CHUNK_ROWS, typed=False)
+    rows = _write_chunks(chunks, spec, target, schema, on_chunk=commit)
+
+    latest = _read_watermark(target)
+    if latest is not None:
+        # Synchronisation terminée, même sans nouvelle ligne : la copie est à jour à cette heure
+        latest["synced_at"] = time.time()
+        _save_watermark(target, latest)
+    if target != root:
+        shutil.rmtree(root, ignore_errors=True)
+        os.replace(target, root)
+    return {"mode": "incremental" if watermark else "full", "rows": rows}
+
+
+def sync_table(table: str, full: bool = False) -> dict:
+    spec = SNAPSHOT_TABLES[table]
+    started = time.monotonic()
+    result = _sync(spec, full)
+    _open_dataset(table)
+    result["seconds"] = round(time.monotonic() - started, 3)
+    return result
+
+
+def sync_snapshots(tables: Iterable[str] | None = None, full: bool = False) -> dict[str, dict]:
+    """Synchronise les tables demandées (toutes par défaut) depuis MySQL."""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    return {table: sync_table(table, full=full) for table in (tables or SNAPSHOT_TABLES)}
+
+
+async def snapshot_sync_loop() -> None:
+    """Synchronisation périodique en tâche de fond (SNAPSHOT_SYNC_SECONDS > 0)."""
+    while True:
+        try:
+            await asyncio.to_thread(sync_snapshots)
+        except Exception as exc:
+            print(f"Synchronisation des snapshots en échec : {exc}")
+        await asyncio.sleep(SNAPSHOT_SYNC_SECONDS)
+
+
+# ============================================================
+# Lecture
+# ============================================================
+
+def _open_dataset(table: str) -> Optional[ds.Dataset]:
+    root = _table_dir(table)
+    dataset = None
+    watermark = _read_watermark(root)
+    if watermark is not None and any(name.startswith(f"{PARTITION_COL}=") for name in os.listdir(root)):
+        dataset = ds.dataset(root, format="parquet", partitioning="hive", filesystem=_local_fs)
+    with _datasets_lock:
+        if dataset is None:
+            _datasets.pop(table, None)
+            _synced_at.pop(table, None)
+        else:
+            _datasets[table] = dataset
+            _synced_at[table] = watermark.get("synced_at", 0)
+    return dataset
+
+
+def _fresh_dataset(table: str) -> Optional[ds.Dataset]:
+    """Jeu ouvert de `table`, ou None s'il n'existe pas ou date de plus de SNAPSHOT_MAX_LAG_SECONDS."""
+    if not SNAPSHOT_ENABLED:
+        return None
+    with _datasets_lock:
+        dataset = _datasets.get(table)
+        synced_at = _synced_at.get(table, 0)
+    if dataset is None or time.time() - synced_at > SNAPSHOT_MAX_LAG_SECONDS:
+        return None
+    return dataset
+
+
+def open_snapshots() -> list[str]:
+    """Ouvre (mémoire-mappés) les snapshots présents sur disque. Retourne les tables disponibles."""
+    if not SNAPSHOT_ENABLED:
+        return []
+    return [table for table in SNAPSHOT_TABLES if _open_dataset(table) is not None]
+
+
+def snapshot_available(table: str) -> bool:
+    return _fresh_dataset(table) is not None
+
+
+def _month_bounds(date_debut: date | None, date_fin: date | None):
+    expr = None
+    if date_debut:
+        expr = ds.field(PARTITION_COL) >= date_debut.strftime("%Y-%m")
+    if date_fin:
+        upper = ds.field(PARTITION_COL) <= date_fin.strftime("%Y-%m")
+        expr = upper if expr is None else expr & upper
+    return expr
+
+
+def _build_filter(table: str, sites: str, date_debut: date | None, date_fin: date | None):
+    spec = KPI_TABLES.get(table)
+    expr = None
+
+    def add(condition):
+        nonlocal expr
+        expr = condition if expr is None else expr & condition
+
+    if spec is not None and spec.date_col and (date_debut or date_fin):
+        add(_month_bounds(date_debut, date_fin))
+        if date_debut:
+            add(ds.field(spec.date_col) >= pd.Timestamp(date_debut))
+        if date_fin:
+            add(ds.field(spec.date_col) < pd.Timestamp(date_fin + timedelta(days=1)))
+
+    site_list = parse_list(sites)
+    if spec is not None and site_list:
+        add(ds.field(spec.site_col).isin(site_list))
+    return expr
+
+
+def _read(
+    dataset: ds.Dataset,
+    table: str,
+    columns: list[str],
+    rename: dict[str, str],
+    sites: str,
+    date_debut: date | None,
+    date_fin: date | None,
+) -> pd.DataFrame:
+    started = time.perf_counter()
+    available = [c for c in columns if c in dataset.schema.names]
+    arrow_table = dataset.to_table(columns=available, filter=_build_filter(table, sites, date_debut, date_fin))
+    df = arrow_table.to_pandas()
+    if rename:
+        df = df.rename(columns=rename)
+    df = apply_schema(df, [table])
+    record_query(
+        len(df),
+        int(df.memory_usage(index=True, deep=True).sum()),
+        "snapshot",
+        f"snapshot:{table}",
+        time.perf_counter() - started,
+    )
+    return df
+
+
+async def read_snapshot(
+    table: str,
+    columns: Iterable[str],
+    *,
+    sites: str = "",
+    date_debut: date | None = None,
+    date_fin: date | None = None,
+    rename: dict[str, str] | None = None,
+) -> Optional[pd.DataFrame]:
+    """
+    Lit `columns` depuis le snapshot local avec les filtres site/dates du dashboard.
+    Retourne None si aucun snapshot à jour n'est disponible : l'appelant interroge alors MySQL.
+    """
+    dataset = _fresh_dataset(table)
+    if dataset is None:
+        return None
+    with stage("fetch"):
+        return await run_in_thread(_read, dataset, table, list(columns), rename or {}, sites, date_debut, date_fin)
+
+
+def _iter_batches(
+    dataset: ds.Dataset,
+    table: str,
+    columns: list[str],
+    rename: dict[str, str],
+    sites: str,
+    date_debut: date | None,
+    date_fin: date | None,
+    batch_rows: int,
+) -> Iterator[pd.DataFrame]:
+    started = time.perf_counter()
+    rows = peak_bytes = 0
+    available = [c for c in columns if c in dataset.schema.names]
+    batches = dataset.to_batches(
+        columns=available,
+        filter=_build_filter(table, sites, date_debut, date_fin),
+        batch_size=batch_rows,
+    )
+    for batch in batches:
+        if batch.num_rows == 0:
+            continue
+        df = batch.to_pandas()
+        if rename:
+            df = df.rename(columns=rename)
+        apply_schema(df, [table])
+        rows += len(df)
+        peak_bytes = max(peak_bytes, int(df.memory_usage(index=True, deep=True).sum()))
+        yield df
+    record_query(rows, peak_bytes, "snapshot", f"snapshot:{table}", time.perf_counter() - started)
+
+
+def iter_snapshot_chunks(
+    table: str,
+    columns: Iterable[str],
+    *,
+    sites: str = "",
+    date_debut: date | None = None,
+    date_fin: date | None = None,
+    rename: dict[str, str] | None = None,
+    batch_rows: int = SNAPSHOT_CHUNK_ROWS,
+) -> Optional[Iterator[pd.DataFrame]]:
+    """
+    Variante de read_snapshot par lots de `batch_rows` lignes (mémoire bornée).
+    Retourne None si aucun snapshot à jour n'est disponible ; l'itérateur est synchrone.
+    """
+    dataset = _fresh_dataset(table)
+    if dataset is None:
+        return None
+    return _iter_batches(dataset, table, list(columns), rename or {}, sites, date_debut, date_fin, batch_rows)
+
+
+def get_snapshot_stats() -> dict:
+    stats = {}
+    for table in SNAPSHOT_TABLES:
+        watermark = _read_watermark(_table_dir(table))
+        stats[table] = {
+            "open": table in _datasets,
+            "fresh": snapshot_available(table),
+            "watermark": watermark["last_value"] if watermark else None,
+            "age_seconds": round(time.time() - watermark["synced_at"], 1) if watermark else None,
+        }
+    return stats
+
+
+def main():
+    args = sys.argv[1:]
+    full = "--full" in args
+    tables = [a for a in args if not a.startswith("--")] or None
+    print("=" * 50)
+    print(f"🗄️  Synchronisation des snapshots dans {SNAPSHOT_DIR} ({'complète' if full else 'incrémentale'})")
+    print("=" * 50)
+    for table, result in sync_snapshots(tables, full=full).items():
+        print(f"✅ {table} : {result['mode']}, {result['rows']} lignes en {result['seconds']} s")
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
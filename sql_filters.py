@@ -0,0 +1,128 @@
+"""
+Compilation des filtres du dashboard (dates, sites, type d'erreur, moment) en SQL paramétré
+pour les tables KPI lues par les routers
+"""
+
+from dataclasses import dataclass
+from datetime import date
+from typing import Iterable, Optional
+
+
+@dataclass(frozen=True)
+class KpiTable:
+    name: str
+    site_col: str
+    date_col: Optional[str] = None
+    type_col: Optional[str] = None
+    moment_col: Optional[str] = None
+
+
+KPI_TABLES = {
+    "kpi_sessions": KpiTable(
+        "kpi_sessions", site_col="Site", date_col="Datetime start", type_col="type_erreur", moment_col="moment"
+    ),
+    "kpi_alertes": KpiTable(
+        "kpi_alertes", site_col="Site", date_col="detection", type_col="type_erreur", moment_col="moment"
+    ),
+    "kpi_suspicious_under_1kwh": KpiTable(
+        "kpi_suspicious_under_1kwh", site_col="Site", date_col="Datetime start"
+    ),
+    "kpi_multi_attempts_hour": KpiTable("kpi_multi_attempts_hour", site_col="Site", date_col="Date_heure"),
+    "kpi_defauts_log": KpiTable("kpi_defauts_log", site_col="site"),
+}
+
+
+def parse_list(values: str | None) -> list[str]:
+    """Découpe un filtre 'a,b,c' de l'interface en liste nettoyée."""
+    if not values:
+        return []
+    return [v.strip() for v in values.split(",") if v.strip()]
+
+
+def quote(column: str) -> str:
+    return f"`{column}`"
+
+
+def _in_clause(column: str, values: list, prefix: str, params: dict) -> str:
+    placeholders = ",".join(f":{prefix}_{i}" for i in range(len(values)))
+    params.update({f"{prefix}_{i}": v for i, v in enumerate(values)})
+    return f"{quote(column)} IN ({placeholders})"
+
+
+def compile_conditions(
+    table: str,
+    *,
+    sites: str = "",
+    date_debut: date | None = None,
+    date_fin: date | None = None,
+    error_types: str = "",
+    moments: str = "",
+    available: Optional[set[str]] = None,
+    extra: Iterable[str] = (),
+) -> tuple[str, dict]:
+    """
+    Retourne (clause WHERE, paramètres) pour une table KPI.
+    Un filtre sur une colonne absente de `available` est ignoré, comme le faisaient les filtres pandas.
+    """
+    spec = KPI_TABLES[table]
+    conditions = list(extra)
+    params: dict = {}
+
+    def has(column: Optional[str]) -> bool:
+        return bool(column) and (available is None or column in available)
+
+    if has(spec.date_col):
+        if date_debut:
+            conditions.append(f"{quote(spec.date_col)} >= :date_debut")
+            params["date_debut"] = str(date_debut)
+        if date_fin:
+            conditions.append(f"{quote(spec.date_col)} < DATE_ADD(:date_fin, INTERVAL 1 DAY)")
+            params["date_fin"] = str(date_fin)
+
+    site_list = parse_list(sites)
+    if site_list and has(spec.site_col):
+        conditions.append(_in_clause(spec.site_col, site_list, "site", params))
+
+    type_list = parse_list(error_types)
+    if type_list and has(spec.type_col):
+        conditions.append(_in_clause(spec.type_col, type_list, "type", params))
+
+    moment_list = parse_list(moments)
+    if moment_list and has(spec.moment_col):
+        conditions.append(_in_clause(spec.moment_col, moment_list, "moment", params))
+
+    return " AND ".join(conditions) if conditions else "1=1", params
+
+
+def compile_select(
+    table: str,
+    columns: Iterable[str],
+    *,
+    order_by: str = "",
+    sort: Iterable[tuple[str, bool]] = (),
+    available: Optional[set[str]] = None,
+    **filters,
+) -> tuple[str, dict]:
+    """
+    SELECT avec projection explicite ; les colonnes absentes de `available` sont omises.
+    `sort` : couples (colonne, décroissant) ; les colonnes absentes sont ignorées et les NULL
+    sont placés en dernier, comme sort_values de pandas. `order_by` est une clause brute.
+    """
+    projected = [c for c in columns if available is None or c in available]
+    where_clause, params = compile_conditions(table, available=available, **filters)
+    sql = f"SELECT {', '.join(quote(c) for c in projected)} FROM {table} WHERE {where_clause}"
+    sort_keys = [
+        f"{quote(c)} IS NULL, {quote(c)}{' DESC' if descending else ''}"
+        for c, descending in sort
+        if available is None or c in available
+    ]
+    if order_by:
+        sort_keys.insert(0, order_by)
+    if sort_keys:
+        sql += f" ORDER BY {', '.join(sort_keys)}"
+    return sql, params
+
+
+def compile_count(table: str, *, available: Optional[set[str]] = None, **filters) -> tuple[str, dict]:
+    where_clause, params = compile_conditions(table, available=available, **filters)
+    return f"SELECT COUNT(*) AS nb FROM {table} WHERE {where_clause}", params
@@ -0,0 +1,95 @@
+"""
+Moteur de templates partagé : Jinja2Templates instrumenté (temps de rendu par requête)
+
+StreamingTemplateResponse rend le template avec Jinja `generate()` et envoie le HTML par
+blocs au fil du rendu : l'en-tête et le résumé partent avant les lignes des tableaux, et le
+document complet n'est jamais assemblé en mémoire.
+"""
+
+import os
+import time
+from typing import Iterator
+
+from fastapi.responses import Response, StreamingResponse
+from fastapi.templating import Jinja2Templates
+from jinja2 import Template
+
+from metrics import record_render, stage
+
+TEMPLATE_STREAM_CHUNK_BYTES = int(os.getenv("TEMPLATE_STREAM_CHUNK_BYTES", "16384"))
+
+
+def _template_name(args, kwargs) -> str:
+    if "name" in kwargs:
+        return str(kwargs["name"])
+    # Signatures acceptées par Starlette : (name, context, ...) ou (request, name, ...)
+    return next((arg for arg in args[:2] if isinstance(arg, str)), "?")
+
+
+def _render_chunks(template: Template, context: dict, name: str) -> Iterator[str]:
+    """Fragments de `generate()` regroupés par blocs d'au moins TEMPLATE_STREAM_CHUNK_BYTES."""
+    # Le corps part après la réponse de l'endpoint : sans cette étape, MetricsMiddleware
+    # compterait tout le flux (rendu et envoi) en transform
+    with stage("render"):
+        rendering = 0.0
+        buffer: list[str] = []
+        size = 0
+        started = time.perf_counter()
+        for piece in template.generate(context):
+            buffer.append(piece)
+            size += len(piece)
+            if size >= TEMPLATE_STREAM_CHUNK_BYTES:
+                # Seul le rendu est compté par template, pas l'attente de l'envoi au client
+                rendering += time.perf_counter() - started
+                yield "".join(buffer)
+                buffer.clear()
+                size = 0
+                started = time.perf_counter()
+        rendering += time.perf_counter() - started
+        if buffer:
+            yield "".join(buffer)
+        record_render(name, rendering)
+
+
+class StreamingTemplateResponse(StreamingResponse):
+    """Réponse HTML rendue au fil de l'envoi (Jinja `generate()`), sans Content-Length."""
+
+    def __init__(self, template: Template, context: dict, status_code: int = 200, headers: dict | None = None):
+        self.template = template
+        self.context = context
+        # Générateur synchrone : Starlette le parcourt dans le pool de threads, hors de la boucle
+        super().__init__(
+            _render_chunks(template, context, template.name or "?"),
+            status_code=status_code,
+            headers=headers,
+            media_type="text/html",
+        )
+
+
+async def response_text(response: Response) -> str:
+    """Corps d'une réponse HTML, qu'elle soit rendue d'un bloc ou en flux."""
+    if isinstance(response, StreamingResponse):
+        parts = [
+            chunk if isinstance(chunk, str) else chunk.decode(response.charset)
+            async for chunk in response.body_iterator
+        ]
+        return "".join(parts)
+    return response.body.decode(response.charset)
+
+
+class TimedTemplates(Jinja2Templates):
+    """Jinja2Templates dont le rendu est compté dans l'étape `render` de la requête en cours."""
+
+    def TemplateResponse(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            with stage("render"):
+                return super().TemplateResponse(*args, **kwargs)
+        finally:
+            record_render(_template_name(args, kwargs), time.perf_counter() - started)
+
+    def StreamingTemplateResponse(
+        self, name: str, context: dict, status_code: int = 200, headers: dict | None = None
+    ) -> StreamingTemplateResponse:
+        """Comme TemplateResponse(name, context), mais rendu et envoyé par blocs ; `context` contient `request`."""
+        return StreamingTemplateResponse(self.get_template(name), context, status_code=status_code, headers=headers)